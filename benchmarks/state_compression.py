@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# Compare the time taken to save and load rawdog's state, and its size on
+# disk, with each statecompression format, using a generated state that
+# looks like a real one: feeds with HTML articles full of markup and links.
+# Run from the top of the source tree:
+#   python3 benchmarks/state_compression.py [number of articles] [level]
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from rawdoglib.persister import Persister
+from rawdoglib.rawdog import Article, Config, Feed, Rawdog
+
+ARTICLES_PER_FEED = 50
+WORDS = ("the of and to in is that for it as with was on be by this are from "
+         "feed article rawdog python release server update people about "
+         "which their would there could other after first new years").split()
+
+def make_paragraph(rand):
+	words = [rand.choice(WORDS) for i in range(rand.randint(20, 80))]
+	for i in range(rand.randint(0, 3)):
+		pos = rand.randrange(len(words))
+		words[pos] = '<a href="https://www.example.com/%s/%d.html">%s</a>' % (rand.choice(WORDS), rand.randint(1, 100000), words[pos])
+	return "<p>" + " ".join(words) + ".</p>"
+
+def make_state(num_articles):
+	rand = random.Random(42)
+	rawdog = Rawdog()
+	now = 1700000000.0
+	for i in range(num_articles):
+		site = "https://blog%d.example.com" % (i // ARTICLES_PER_FEED)
+		url = site + "/feed.xml"
+		if url not in rawdog.feeds:
+			rawdog.feeds[url] = Feed(url)
+		link = "%s/%d/%s-%d.html" % (site, 2000 + i % 25, rand.choice(WORDS), i)
+		body = "\n".join(make_paragraph(rand) for j in range(rand.randint(1, 6)))
+		entry_info = {
+			"id": link,
+			"link": link,
+			"title_detail": {"type": "text/plain", "value": " ".join(rand.choice(WORDS) for j in range(6))},
+			"summary_detail": {"type": "text/html", "value": body},
+			"author": "Author %d" % (i % 37),
+			}
+		rawdog.articles.add(Article(url, entry_info, now - i, i % ARTICLES_PER_FEED))
+	return rawdog
+
+def get_size(dirname):
+	return sum(os.path.getsize(os.path.join(dirname, name)) for name in os.listdir(dirname))
+
+def timed(func):
+	start = time.time()
+	result = func()
+	return (time.time() - start, result)
+
+def bench(rawdog, format, level, dirname):
+	config = Config(False)
+	config["statecompression"] = format
+	config["statecompressionlevel"] = level
+	persister = Persister(config)
+	filename = os.path.join(dirname, "state")
+
+	persisted = persister.get(Rawdog, filename)
+	persisted.open()
+	persisted.object = rawdog
+	rawdog.modified()
+	(save_time, _) = timed(persisted.close)
+
+	persisted = persister.get(Rawdog, filename)
+	(feeds_time, loaded) = timed(persisted.open)
+	def load_all():
+		for article in loaded.articles.values():
+			article.load_body()
+	(articles_time, _) = timed(load_all)
+	persisted.close()
+	return (save_time, feeds_time, feeds_time + articles_time, get_size(dirname))
+
+def main(argv):
+	num_articles = 20000
+	level = 6
+	if len(argv) > 0:
+		num_articles = int(argv[0])
+	if len(argv) > 1:
+		level = int(argv[1])
+
+	results = []
+	stdout = sys.stdout
+	sys.stdout = open(os.devnull, "w")
+	try:
+		for format in ("none", "gzip", "bz2", "lzma"):
+			# Make the state again each time, since saving it
+			# stores the articles' bodies in the first file.
+			rawdog = make_state(num_articles)
+			dirname = tempfile.mkdtemp()
+			try:
+				results.append((format, bench(rawdog, format, level, dirname)))
+			finally:
+				shutil.rmtree(dirname)
+	finally:
+		sys.stdout.close()
+		sys.stdout = stdout
+
+	print("%d articles, compression level %d" % (num_articles, level))
+	print("%-6s %8s %12s %10s %12s %6s" % ("format", "save", "load feeds", "load all", "size", "ratio"))
+	base_size = results[0][1][3]
+	for (format, (save_time, feeds_time, load_time, size)) in results:
+		print("%-6s %7.2fs %11.2fs %9.2fs %12d %5.1f:1" % (format, save_time, feeds_time, load_time, size, base_size / size))
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# Compare the time taken to save and load rawdog's state, and its size on
+# disk, using a plain pickle and the sectioned format that rawdog uses.
+# Run from the top of the source tree:
+#   python3 benchmarks/state_format.py [number of articles ...]
+
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from rawdoglib.persister import Persister
+from rawdoglib.rawdog import Article, Config, Feed, Rawdog
+
+ARTICLES_PER_FEED = 100
+
+def make_state(num_articles):
+	rawdog = Rawdog()
+	now = 1700000000.0
+	for i in range(num_articles):
+		url = "http://example.com/feed%d.rss" % (i // ARTICLES_PER_FEED)
+		if url not in rawdog.feeds:
+			rawdog.feeds[url] = Feed(url)
+		link = "http://example.com/article%d" % i
+		entry_info = {
+			"id": link,
+			"link": link,
+			"title_detail": {"type": "text/plain", "value": "Article %d" % i},
+			"summary_detail": {"type": "text/html", "value": "<p>This is the text of article %d.</p>" % i},
+			}
+		rawdog.articles.add(Article(url, entry_info, now - i, i))
+	return rawdog
+
+def get_size(dirname):
+	return sum(os.path.getsize(os.path.join(dirname, name)) for name in os.listdir(dirname))
+
+def timed(func):
+	start = time.time()
+	result = func()
+	return (time.time() - start, result)
+
+def bench_pickle(rawdog, dirname):
+	filename = os.path.join(dirname, "state")
+	def save():
+		with open(filename, "wb") as f:
+			pickle.dump(rawdog, f, pickle.HIGHEST_PROTOCOL)
+	def load():
+		with open(filename, "rb") as f:
+			return pickle.load(f)
+	(save_time, _) = timed(save)
+	(load_time, _) = timed(load)
+	return (save_time, load_time, load_time, get_size(dirname))
+
+def bench_sectioned(rawdog, dirname):
+	config = Config(False)
+	persister = Persister(config)
+	filename = os.path.join(dirname, "state")
+	devnull = open(os.devnull, "w")
+	stdout = sys.stdout
+	sys.stdout = devnull
+	try:
+		persisted = persister.get(Rawdog, filename)
+		persisted.open()
+		persisted.object = rawdog
+		rawdog.modified()
+		(save_time, _) = timed(persisted.close)
+
+		persisted = persister.get(Rawdog, filename)
+		(feeds_time, loaded) = timed(persisted.open)
+		(articles_time, _) = timed(lambda: loaded.articles)
+		persisted.object.modified(False)
+		persisted.close()
+	finally:
+		sys.stdout = stdout
+		devnull.close()
+	return (save_time, feeds_time, feeds_time + articles_time, get_size(dirname))
+
+def main(argv):
+	sizes = [int(arg) for arg in argv] or [10000, 100000, 1000000]
+	print("%-10s %-10s %8s %12s %11s %12s" % ("articles", "format", "save", "load feeds", "load all", "size"))
+	for num_articles in sizes:
+		rawdog = make_state(num_articles)
+		for (name, func) in (("pickle", bench_pickle), ("sectioned", bench_sectioned)):
+			dirname = tempfile.mkdtemp()
+			try:
+				(save_time, feeds_time, load_time, size) = func(rawdog, dirname)
+			finally:
+				shutil.rmtree(dirname)
+			print("%-10d %-10s %7.2fs %11.2fs %10.2fs %12d" % (num_articles, name, save_time, feeds_time, load_time, size))
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]))
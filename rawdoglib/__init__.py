@@ -1,5 +1,7 @@
 __all__ = [
+    'asynchttp',
     'feedscanner',
+    'httppool',
     'persister',
     'rawdog',
     ]
@@ -0,0 +1,282 @@
+# asynchttp: a small asyncio HTTP client for fetching feeds
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""A minimal HTTP/1.1 client built on asyncio streams. It only does what
+rawdog needs to fetch feeds: GET requests, following redirects, chunked
+and gzip/deflate-encoded responses, keeping connections open to be
+reused, and limits on the number of connections open in total and to
+each host, and on how often requests are made to each host."""
+
+import asyncio
+import collections
+import gzip
+import socket
+import ssl
+import time
+import urllib.parse
+import zlib
+
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 10
+
+class HTTPError(Exception):
+	"""The server sent something that isn't a valid HTTP response."""
+	pass
+
+class Response:
+	"""An HTTP response. Header names are lowercased; repeated headers
+	are joined with commas."""
+
+	def __init__(self, url, status, headers, body):
+		self.url = url
+		self.status = status
+		self.headers = headers
+		self.body = body
+
+def decode_body(body, headers):
+	"""Undo any Content-Encoding applied to a response body."""
+	encoding = headers.get("content-encoding", "").lower()
+	if body and "gzip" in encoding:
+		body = gzip.decompress(body)
+	elif body and "deflate" in encoding:
+		try:
+			body = zlib.decompress(body)
+		except zlib.error:
+			# Some servers send raw deflate data with no header.
+			body = zlib.decompress(body, -15)
+	else:
+		return body
+	del headers["content-encoding"]
+	return body
+
+class Client:
+	"""An HTTP client that limits the number of requests in progress,
+	both in total and for each host, and starts requests to each host
+	at least host_interval seconds apart. If timeout is given, each
+	request fails with TimeoutError if connecting to the server and
+	reading its response takes longer than that; time spent waiting
+	for the limits doesn't count."""
+
+	def __init__(self, max_connections, host_connections, host_interval=0, timeout=None):
+		self.host_connections = max(host_connections, 1)
+		self.host_interval = host_interval
+		self.timeout = timeout
+		self.connections = asyncio.Semaphore(max(max_connections, 1))
+		self.hosts = {}
+		# Host -> the earliest time the next request can start.
+		self.next_start = {}
+		# Host -> total time spent on requests to it.
+		self.host_times = collections.Counter()
+		self.ssl_context = ssl.create_default_context()
+		# (scheme, host, port) -> idle connections, as (reader,
+		# writer) pairs.
+		self.idle = {}
+		# (host, port) -> the addresses it resolves to.
+		self.addresses = {}
+
+	def close(self):
+		"""Close all the idle connections."""
+		for connections in self.idle.values():
+			for (reader, writer) in connections:
+				writer.close()
+		self.idle = {}
+
+	def get_host_limit(self, host):
+		if host not in self.hosts:
+			self.hosts[host] = asyncio.Semaphore(self.host_connections)
+		return self.hosts[host]
+
+	async def get(self, url, headers):
+		"""Fetch a URL, following redirects. Returns the list of
+		responses received, the last of which is the final one."""
+		responses = []
+		while True:
+			response = await self.request(url, headers)
+			responses.append(response)
+			location = response.headers.get("location")
+			if (response.status not in REDIRECT_STATUSES
+			    or location is None
+			    or len(responses) > MAX_REDIRECTS):
+				return responses
+			url = urllib.parse.urljoin(url, location)
+
+	async def request(self, url, headers):
+		"""Make a single GET request."""
+		parsed = urllib.parse.urlsplit(url)
+		if parsed.scheme not in ("http", "https") or parsed.hostname is None:
+			raise HTTPError("Unsupported URL: " + url)
+		host = parsed.hostname.lower()
+
+		async with self.get_host_limit(host):
+			await self.wait_for_host(host)
+			async with self.connections:
+				start = time.monotonic()
+				try:
+					return await asyncio.wait_for(self._request(url, parsed, headers),
+					                              self.timeout)
+				finally:
+					self.host_times[host] += time.monotonic() - start
+
+	async def wait_for_host(self, host):
+		"""Wait until host_interval has passed since the last request
+		to a host was started."""
+		now = time.monotonic()
+		start = max(now, self.next_start.get(host, now))
+		self.next_start[host] = start + self.host_interval
+		if start > now:
+			await asyncio.sleep(start - now)
+
+	async def resolve(self, host, port):
+		"""Return the addresses that a host resolves to, looking them
+		up only the first time."""
+		key = (host, port)
+		if key not in self.addresses:
+			loop = asyncio.get_running_loop()
+			infos = await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+			self.addresses[key] = [info[4][0] for info in infos]
+		return self.addresses[key]
+
+	async def connect(self, key, context):
+		"""Return a connection to a host, and whether it's been used
+		before."""
+		connections = self.idle.get(key, [])
+		while connections:
+			(reader, writer) = connections.pop()
+			if not writer.is_closing() and not reader.at_eof():
+				return (reader, writer, True)
+			writer.close()
+
+		(scheme, host, port) = key
+		err = None
+		for address in await self.resolve(host, port):
+			try:
+				(reader, writer) = await asyncio.open_connection(address, port, ssl=context,
+					server_hostname=(host if context is not None else None))
+				return (reader, writer, False)
+			except OSError as e:
+				err = e
+		if err is None:
+			err = OSError("No addresses found for " + host)
+		raise err
+
+	async def _request(self, url, parsed, headers):
+		if parsed.scheme == "https":
+			port = parsed.port or 443
+			context = self.ssl_context
+		else:
+			port = parsed.port or 80
+			context = None
+		key = (parsed.scheme, parsed.hostname, port)
+
+		path = parsed.path or "/"
+		if parsed.query:
+			path += "?" + parsed.query
+		lines = ["GET " + path + " HTTP/1.1",
+		         "Host: " + parsed.netloc.rpartition("@")[2],
+		         "Connection: keep-alive"]
+		for name, value in headers.items():
+			lines.append(name + ": " + value)
+		request = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+		while True:
+			(reader, writer, reused) = await self.connect(key, context)
+			try:
+				writer.write(request)
+				await writer.drain()
+				(status, response_headers) = await self.read_head(reader)
+				body = await self.read_body(reader, status, response_headers)
+			except (OSError, asyncio.IncompleteReadError):
+				writer.close()
+				if reused:
+					# The server may have closed the connection
+					# while it was idle; try a new one.
+					continue
+				raise
+			except BaseException:
+				writer.close()
+				raise
+			break
+
+		# The connection can only be used again if the end of the
+		# body was marked by its length, not by closing it.
+		reusable = (status in (204, 304)
+		            or "chunked" in response_headers.get("transfer-encoding", "").lower()
+		            or "content-length" in response_headers)
+		if reusable and "close" not in response_headers.get("connection", "").lower():
+			self.idle.setdefault(key, []).append((reader, writer))
+		else:
+			writer.close()
+
+		body = decode_body(body, response_headers)
+		return Response(url, status, response_headers, body)
+
+	async def read_head(self, reader):
+		"""Read the status line and headers of a response, skipping
+		any 1xx responses."""
+		while True:
+			line = (await reader.readline()).decode("latin-1")
+			parts = line.split(None, 2)
+			if len(parts) < 2 or not parts[0].startswith("HTTP/"):
+				raise HTTPError("Bad status line: " + repr(line))
+			try:
+				status = int(parts[1])
+			except ValueError:
+				raise HTTPError("Bad status line: " + repr(line))
+
+			headers = {}
+			while True:
+				line = (await reader.readline()).decode("latin-1")
+				if line in ("\r\n", "\n", ""):
+					break
+				(name, sep, value) = line.partition(":")
+				if sep == "":
+					raise HTTPError("Bad header line: " + repr(line))
+				name = name.strip().lower()
+				value = value.strip()
+				if name in headers:
+					headers[name] += ", " + value
+				else:
+					headers[name] = value
+
+			if status >= 200:
+				return (status, headers)
+
+	async def read_body(self, reader, status, headers):
+		if status in (204, 304):
+			return b""
+		if "chunked" in headers.get("transfer-encoding", "").lower():
+			chunks = []
+			while True:
+				line = await reader.readline()
+				try:
+					size = int(line.split(b";")[0].strip(), 16)
+				except ValueError:
+					raise HTTPError("Bad chunk size: " + repr(line))
+				if size == 0:
+					break
+				chunks.append(await reader.readexactly(size))
+				await reader.readline()
+			# Skip any trailers.
+			while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+				pass
+			return b"".join(chunks)
+		elif "content-length" in headers:
+			try:
+				length = int(headers["content-length"])
+			except ValueError:
+				raise HTTPError("Bad Content-Length: " + headers["content-length"])
+			return await reader.readexactly(length)
+		else:
+			return await reader.read()
@@ -0,0 +1,181 @@
+# httppool: persistent HTTP connections for urllib
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""urllib handlers that keep HTTP connections open and reuse them for
+later requests to the same host, from any thread, and a cache of DNS
+lookups, so that fetching lots of feeds from the same server doesn't
+need a new connection (and TLS handshake) for each one.
+
+Requests made through a proxy, either plain HTTP or HTTPS tunnelled
+with CONNECT, bypass the pool and use a new connection each time."""
+
+import http.client
+import io
+import socket
+import threading
+import urllib.error
+import urllib.request
+import urllib.response
+
+class DNSCache:
+	"""Remembers the addresses that host names resolve to."""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.addresses = {}
+
+	def getaddrinfo(self, host, port):
+		key = (host, port)
+		with self.lock:
+			if key in self.addresses:
+				return self.addresses[key]
+		addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+		with self.lock:
+			self.addresses[key] = addresses
+		return addresses
+
+	def create_connection(self, address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+	                      source_address=None):
+		"""As socket.create_connection, but using the cache."""
+		(host, port) = address
+		err = None
+		for (family, type, proto, canonname, sockaddr) in self.getaddrinfo(host, port):
+			sock = None
+			try:
+				sock = socket.socket(family, type, proto)
+				if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+					sock.settimeout(timeout)
+				if source_address:
+					sock.bind(source_address)
+				sock.connect(sockaddr)
+				return sock
+			except OSError as e:
+				err = e
+				if sock is not None:
+					sock.close()
+		if err is not None:
+			raise err
+		raise OSError("getaddrinfo returned an empty list")
+
+class Response(urllib.response.addinfourl):
+	"""A response whose body has already been read. Unlike addinfourl,
+	its status can be changed (as feedparser's handlers do)."""
+
+	status = None
+
+	def __init__(self, body, headers, url, status, reason):
+		urllib.response.addinfourl.__init__(self, io.BytesIO(body), headers, url, status)
+		self.status = status
+		self.msg = reason
+
+class ConnectionPool:
+	"""A set of idle HTTP connections, by scheme and host, that can be
+	shared between threads. A connection is only used by one request
+	at a time."""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.idle = {}
+		self.dns = DNSCache()
+
+	def get(self, key, http_class, host, timeout, **http_conn_args):
+		"""Return an idle connection for key, and whether it's been
+		used before."""
+		with self.lock:
+			connections = self.idle.get(key)
+			if connections:
+				return (connections.pop(), True)
+		conn = http_class(host, timeout=timeout, **http_conn_args)
+		conn._create_connection = self.dns.create_connection
+		return (conn, False)
+
+	def put(self, key, conn):
+		with self.lock:
+			self.idle.setdefault(key, []).append(conn)
+
+	def close(self):
+		"""Close all the idle connections."""
+		with self.lock:
+			for connections in self.idle.values():
+				for conn in connections:
+					conn.close()
+			self.idle = {}
+
+	def open(self, handler, http_class, req, **http_conn_args):
+		"""Make a request, reusing a connection if there's one
+		available. The response is read completely, so that the
+		connection can be used again straight away."""
+		if req._tunnel_host or req.has_proxy():
+			# Connections to a proxy aren't shared, since feeds
+			# can use different proxies and credentials.
+			return urllib.request.AbstractHTTPHandler.do_open(handler, http_class, req,
+			                                                  **http_conn_args)
+		host = req.host
+		if not host:
+			raise urllib.error.URLError("no host given")
+		key = (req.type, host)
+
+		headers = dict(req.unredirected_hdrs)
+		headers.update({k: v for k, v in req.headers.items()
+		                if k not in headers})
+		headers["Connection"] = "keep-alive"
+		headers = {name.title(): val for name, val in headers.items()}
+
+		while True:
+			(conn, reused) = self.get(key, http_class, host, req.timeout, **http_conn_args)
+			try:
+				conn.request(req.get_method(), req.selector, req.data, headers,
+				             encode_chunked=req.has_header("Transfer-encoding"))
+				r = conn.getresponse()
+				body = r.read()
+			except (OSError, http.client.HTTPException) as err:
+				conn.close()
+				if reused and not isinstance(err, socket.timeout):
+					# The server may have closed the connection
+					# while it was idle; try a new one.
+					continue
+				if isinstance(err, OSError):
+					raise urllib.error.URLError(err)
+				raise
+			break
+
+		if r.will_close:
+			conn.close()
+		else:
+			self.put(key, conn)
+
+		return Response(body, r.msg, req.get_full_url(), r.status, r.reason)
+
+class PooledHTTPHandler(urllib.request.HTTPHandler):
+	"""urllib handler that makes HTTP requests using a ConnectionPool."""
+
+	def __init__(self, pool):
+		urllib.request.HTTPHandler.__init__(self)
+		self.pool = pool
+
+	def http_open(self, req):
+		return self.pool.open(self, http.client.HTTPConnection, req)
+
+class PooledHTTPSHandler(urllib.request.HTTPSHandler):
+	"""urllib handler that makes HTTPS requests using a
+	ConnectionPool."""
+
+	def __init__(self, pool):
+		urllib.request.HTTPSHandler.__init__(self)
+		self.pool = pool
+
+	def https_open(self, req):
+		return self.pool.open(self, http.client.HTTPSConnection, req,
+		                      context=self._context)
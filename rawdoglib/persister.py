@@ -1,4 +1,4 @@
-# persister: persist Python objects safely to pickle files
+# persister: persist Python objects safely to pickle files or SQLite databases
 # Copyright 2003-2014 Adam Sampson <ats@offog.org>
 #
 # This program is free software: you can redistribute it and/or modify
@@ -15,10 +15,18 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import six.moves.cPickle as pickle
+import bz2
 import errno
 import fcntl
+import glob
+import gzip
+import io
+import lzma
 import os
+import struct
+import sqlite3
 import sys
+import zlib
 
 class Persistable:
 	"""An object which can be persisted."""
@@ -33,6 +41,325 @@ class Persistable:
 	def is_modified(self):
 		return self._modified
 
+	def get_changes(self):
+		"""Return a picklable description of the changes made to the
+		object since it was loaded, to be appended to its journal, or
+		None if the whole object must be saved instead."""
+		return None
+
+	def apply_changes(self, changes):
+		"""Make changes returned by get_changes again, when loading
+		the object from its journal. Objects that override get_changes
+		must override this too."""
+		pass
+
+	def load_db(self, db):
+		"""Load the object's contents from an SQLite database
+		connection, for objects stored using SQLitePersisted. By
+		default, the whole object is kept pickled in one row;
+		objects can override this and save_db to use their own
+		tables."""
+		db.execute("CREATE TABLE IF NOT EXISTS persisted (data BLOB NOT NULL)")
+		row = db.execute("SELECT data FROM persisted").fetchone()
+		if row is not None:
+			self.__dict__.update(pickle.loads(row[0]).__dict__)
+
+	def save_db(self, db):
+		"""Save the object's contents to an SQLite database
+		connection."""
+		db.execute("DELETE FROM persisted")
+		db.execute("INSERT INTO persisted (data) VALUES (?)",
+		           (pickle.dumps(self, pickle.HIGHEST_PROTOCOL),))
+
+# Each compression format that can be used for state files, with the
+# bytes its data starts with, so that compressed data can be recognised
+# when it's loaded. Data that doesn't start with any of these isn't
+# compressed.
+COMPRESSION_MAGIC = {
+	"gzip": b"\x1f\x8b",
+	"bz2": b"BZh",
+	"lzma": b"\xfd7zXZ\x00",
+	}
+
+# The range of compression levels that each format accepts.
+COMPRESSION_LEVELS = {
+	"gzip": (0, 9),
+	"bz2": (1, 9),
+	"lzma": (0, 9),
+	}
+
+def compress(data, compression):
+	"""Compress data. compression is a (format, level) tuple; the
+	format may be "none". If compressing doesn't make the data any
+	smaller (as with many short blobs), it's left alone."""
+	(format, level) = compression
+	if format == "gzip":
+		compressed = gzip.compress(data, level, mtime=0)
+	elif format == "bz2":
+		compressed = bz2.compress(data, level)
+	elif format == "lzma":
+		compressed = lzma.compress(data, preset=level)
+	else:
+		return data
+	if len(compressed) < len(data):
+		return compressed
+	else:
+		return data
+
+def decompress(data):
+	"""Decompress data produced by compress, in any format."""
+	if data.startswith(COMPRESSION_MAGIC["gzip"]):
+		return gzip.decompress(data)
+	elif data.startswith(COMPRESSION_MAGIC["bz2"]):
+		return bz2.decompress(data)
+	elif data.startswith(COMPRESSION_MAGIC["lzma"]):
+		return lzma.decompress(data)
+	else:
+		return data
+
+def open_compressor(f, compression):
+	"""Return a file object that writes compressed data to f, which
+	must be closed when finished with (without closing f), or None if
+	compression is turned off."""
+	(format, level) = compression
+	if format == "gzip":
+		return gzip.GzipFile(fileobj=f, mode="wb", compresslevel=level, mtime=0)
+	elif format == "bz2":
+		return bz2.BZ2File(f, "wb", compresslevel=level)
+	elif format == "lzma":
+		return lzma.LZMAFile(f, "wb", preset=level)
+	else:
+		return None
+
+def open_decompressor(f):
+	"""Return a file object that reads data written by a compressor
+	opened with open_compressor (in any format) from f's current
+	position."""
+	start = f.tell()
+	head = f.read(max(len(magic) for magic in COMPRESSION_MAGIC.values()))
+	f.seek(start)
+	if head.startswith(COMPRESSION_MAGIC["gzip"]):
+		return gzip.GzipFile(fileobj=f, mode="rb")
+	elif head.startswith(COMPRESSION_MAGIC["bz2"]):
+		return bz2.BZ2File(f, "rb")
+	elif head.startswith(COMPRESSION_MAGIC["lzma"]):
+		return lzma.LZMAFile(f, "rb")
+	else:
+		return f
+
+class Blob:
+	"""Base class for parts of a persisted object that should be kept
+	in a separate file rather than in the object's pickle, so that they
+	needn't be loaded until they're used. When a Blob has been stored,
+	its ref is set to the BlobRef that will load it again; the owner
+	should store the BlobRef rather than the Blob until it changes."""
+
+	__slots__ = ("ref",)
+
+class BlobRef:
+	"""A reference to a Blob stored in a BlobFile."""
+
+	__slots__ = ("blobs", "gen", "offset", "length")
+
+	def __init__(self, blobs, gen, offset, length):
+		self.blobs = blobs
+		self.gen = gen
+		self.offset = offset
+		self.length = length
+
+	def load(self):
+		"""Load the Blob."""
+		blob = pickle.loads(decompress(self.blobs.read(self.gen, self.offset, self.length)))
+		blob.ref = self
+		return blob
+
+class BlobFile:
+	"""The blobs belonging to a persisted file. New blobs are appended
+	to a file named after it; when that's mostly full of blobs that are
+	no longer used, the ones still in use are copied into a new
+	generation of the file, and the old one is removed once the
+	persisted file that refers to the new one has been saved."""
+
+	def __init__(self, filename):
+		self.prefix = filename + ".blobs."
+		self.files = {}
+		gens = self.generations()
+		if gens == []:
+			self.gen = 0
+		else:
+			self.gen = max(gens)
+
+	def generations(self):
+		gens = []
+		for name in glob.glob(glob.escape(self.prefix) + "*"):
+			try:
+				gens.append(int(name[len(self.prefix):]))
+			except ValueError:
+				pass
+		return gens
+
+	def get_file(self, gen):
+		f = self.files.get(gen)
+		if f is None:
+			if gen == self.gen:
+				f = open(self.prefix + str(gen), "a+b")
+			else:
+				f = open(self.prefix + str(gen), "rb")
+			self.files[gen] = f
+		return f
+
+	def read(self, gen, offset, length):
+		f = self.get_file(gen)
+		f.seek(offset)
+		return f.read(length)
+
+	def append(self, data):
+		"""Append data to the current generation. Returns (generation,
+		offset, length)."""
+		f = self.get_file(self.gen)
+		f.seek(0, os.SEEK_END)
+		offset = f.tell()
+		f.write(data)
+		return (self.gen, offset, len(data))
+
+	def size(self):
+		size = 0
+		for gen in self.generations():
+			size += os.path.getsize(self.prefix + str(gen))
+		return size
+
+	def flush(self):
+		for f in self.files.values():
+			f.flush()
+
+	def new_generation(self):
+		self.gen += 1
+
+	def remove_unused(self, used):
+		"""Remove all generations apart from the current one and those
+		in used."""
+		for gen in self.generations():
+			if gen != self.gen and gen not in used:
+				f = self.files.pop(gen, None)
+				if f is not None:
+					f.close()
+				os.unlink(self.prefix + str(gen))
+
+	def remove_all(self):
+		for gen in self.generations():
+			os.unlink(self.prefix + str(gen))
+
+	def rename(self, new_filename):
+		new_prefix = new_filename + ".blobs."
+		for gen in self.generations():
+			os.rename(self.prefix + str(gen), new_prefix + str(gen))
+		self.prefix = new_prefix
+
+class BlobPickler(pickle.Pickler):
+	"""A Pickler that stores Blobs in a BlobFile, compressed as
+	specified by compression. If compact is True, all the blobs are
+	copied into a new generation."""
+
+	def __init__(self, file, blobs, compact, compression):
+		pickle.Pickler.__init__(self, file, pickle.HIGHEST_PROTOCOL)
+		self.blobs = blobs
+		self.compact = compact
+		self.compression = compression
+		self.used = set()
+		self.used_size = 0
+		# Sections to be written after this pickle.
+		self.sections = []
+
+	def persistent_id(self, obj):
+		if isinstance(obj, (Section, SectionRef)):
+			self.sections.append(obj)
+			return ("section", len(self.sections) - 1)
+		elif isinstance(obj, BlobRef):
+			ref = obj
+			if ref.blobs is not self.blobs or self.compact:
+				# Copy it into this file's current generation.
+				data = ref.blobs.read(ref.gen, ref.offset, ref.length)
+				(ref.gen, ref.offset, ref.length) = self.blobs.append(data)
+				ref.blobs = self.blobs
+		elif isinstance(obj, Blob):
+			data = compress(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL), self.compression)
+			ref = BlobRef(self.blobs, *self.blobs.append(data))
+			obj.ref = ref
+		else:
+			return None
+		self.used.add(ref.gen)
+		self.used_size += ref.length
+		return (ref.gen, ref.offset, ref.length)
+
+class BlobUnpickler(pickle.Unpickler):
+	"""An Unpickler that loads references to Blobs stored by
+	BlobPickler, and to the SectionRefs in sections."""
+
+	def __init__(self, file, blobs, sections=()):
+		pickle.Unpickler.__init__(self, file)
+		self.blobs = blobs
+		self.sections = sections
+
+	def persistent_load(self, pid):
+		if pid[0] == "section":
+			return self.sections[pid[1]]
+		(gen, offset, length) = pid
+		return BlobRef(self.blobs, gen, offset, length)
+
+class Section:
+	"""Wraps part of a persisted object that should be kept in its own
+	section of the file, so that the rest of the object can be loaded
+	without it. It's loaded as a SectionRef, which reads the section
+	when its load method is called."""
+
+	def __init__(self, value):
+		self.value = value
+
+	def load(self):
+		return self.value
+
+class SectionRef:
+	"""A reference to a section of a persisted file."""
+
+	__slots__ = ("file", "blobs", "offset", "length", "used", "used_size")
+
+	def __init__(self, file, blobs, offset, length, used, used_size):
+		self.file = file
+		self.blobs = blobs
+		self.offset = offset
+		self.length = length
+		self.used = used
+		self.used_size = used_size
+
+	def load(self):
+		self.file.seek(self.offset)
+		return BlobUnpickler(open_decompressor(self.file), self.blobs).load()
+
+	def read(self):
+		self.file.seek(self.offset)
+		return self.file.read(self.length)
+
+# A persisted file starts with this, followed by the pickled object, the
+# pickled sections, the table of contents -- a pickled tuple of the
+# journal ID and a list of (offset, length, blob generations used, size
+# of blobs used) for each section -- and finally the offset of the table
+# of contents. Files without it are just a pickle.
+SECTIONED_MAGIC = b"rawdog sectioned state 1\n"
+
+# A journal starts with this and the ID of the persisted file it applies
+# to, followed by records, each of which is the length and CRC32 of a
+# pickle of the changes made by one save. The ID changes each time the
+# persisted file is rewritten, so a journal left behind by an
+# interrupted rewrite is ignored.
+JOURNAL_MAGIC = b"rawdog journal 1\n"
+JOURNAL_ID_SIZE = 16
+JOURNAL_RECORD = struct.Struct(">II")
+
+# Copy the blobs that are in use into a new generation once more than
+# this much space is being wasted, and more than is being used (or once
+# none are being used at all).
+BLOB_WASTE_LIMIT = 1024 * 1024
+
 class Persisted:
 	"""Context manager for a persistent object.  The object being persisted
 	must implement the Persistable interface."""
@@ -43,6 +370,12 @@ class Persisted:
 		self.persister = persister
 		self.lock_file = None
 		self.object = None
+		self.blobs = None
+		self.section_file = None
+		self.journal_id = None
+		# The length of the valid part of the journal, or None if
+		# there isn't a journal for this file yet.
+		self.journal_end = None
 		self.refcount = 0
 
 	def rename(self, new_filename):
@@ -50,7 +383,11 @@ class Persisted:
 		currently open or not."""
 
 		self.persister._rename(self.filename, new_filename)
-		for ext in ("", ".lock"):
+		if self.blobs is None:
+			BlobFile(self.filename).rename(new_filename)
+		else:
+			self.blobs.rename(new_filename)
+		for ext in ("", ".lock", ".journal"):
 			try:
 				os.rename(self.filename + ext,
 				          new_filename + ext)
@@ -119,6 +456,7 @@ class Persisted:
 		if not self._get_lock(no_block):
 			return None
 
+		self.blobs = BlobFile(self.filename)
 		try:
 			f = open(self.filename, "rb")
 		except IOError:
@@ -128,9 +466,135 @@ class Persisted:
 			self.object.modified()
 			return
 
-		self.object = pickle.load(f)
+		if f.read(len(SECTIONED_MAGIC)) != SECTIONED_MAGIC:
+			f.seek(0)
+			self.object = BlobUnpickler(f, self.blobs).load()
+			f.close()
+		else:
+			f.seek(-8, os.SEEK_END)
+			(toc_offset,) = struct.unpack(">Q", f.read(8))
+			f.seek(toc_offset)
+			(self.journal_id, toc) = pickle.load(f)
+			sections = [SectionRef(f, self.blobs, *entry) for entry in toc]
+			f.seek(len(SECTIONED_MAGIC))
+			self.object = BlobUnpickler(open_decompressor(f), self.blobs, sections).load()
+			# Keep the file open so that sections can be read
+			# from it later.
+			self.section_file = f
+			self._read_journal()
 		self.object.modified(False)
+
+	def _read_journal(self):
+		"""Apply the changes recorded in the journal to the object."""
+		try:
+			f = open(self.filename + ".journal", "rb")
+		except IOError:
+			return
+
+		with f:
+			header = f.read(len(JOURNAL_MAGIC) + JOURNAL_ID_SIZE)
+			if header != JOURNAL_MAGIC + self.journal_id:
+				# Left over from before the file was last
+				# rewritten.
+				return
+			self.journal_end = f.tell()
+			while True:
+				head = f.read(JOURNAL_RECORD.size)
+				if len(head) < JOURNAL_RECORD.size:
+					break
+				(length, crc) = JOURNAL_RECORD.unpack(head)
+				data = f.read(length)
+				if len(data) < length or zlib.crc32(data) != crc:
+					# An incomplete record written by a
+					# save that was interrupted.
+					break
+				changes = BlobUnpickler(io.BytesIO(decompress(data)), self.blobs).load()
+				self.object.apply_changes(changes)
+				self.journal_end = f.tell()
+
+	def _append_journal(self):
+		"""Try to save the object's changes by appending them to the
+		journal. Returns False if the whole object must be saved
+		instead."""
+		ratio = self.persister.journal_ratio
+		if self.journal_id is None or ratio <= 0:
+			return False
+		changes = self.object.get_changes()
+		if changes is None:
+			return False
+
+		compression = self.persister.compression
+		buf = io.BytesIO()
+		BlobPickler(buf, self.blobs, False, compression).dump(changes)
+		data = compress(buf.getvalue(), compression)
+		if self.journal_end is None:
+			start = len(JOURNAL_MAGIC) + JOURNAL_ID_SIZE
+		else:
+			start = self.journal_end
+		end = start + JOURNAL_RECORD.size + len(data)
+		if end > ratio * os.path.getsize(self.filename):
+			# The journal's got too big; rewrite the file.
+			return False
+
+		print("Saving changes to state journal.")
+		self.blobs.flush()
+		if self.journal_end is None:
+			f = open(self.filename + ".journal", "wb")
+			f.write(JOURNAL_MAGIC + self.journal_id)
+		else:
+			f = open(self.filename + ".journal", "r+b")
+			# Throw away any incomplete record.
+			f.seek(start)
+			f.truncate()
+		f.write(JOURNAL_RECORD.pack(len(data), zlib.crc32(data)))
+		f.write(data)
 		f.close()
+		self.journal_end = end
+		return True
+
+	def _pickle(self, f, obj, compact):
+		"""Write a pickle of obj to f, compressed if the persister
+		says so. Returns the BlobPickler used."""
+		compression = self.persister.compression
+		out = open_compressor(f, compression)
+		pickler = BlobPickler(out or f, self.blobs, compact, compression)
+		pickler.dump(obj)
+		if out is not None:
+			out.close()
+		return pickler
+
+	def _dump(self, f, compact):
+		"""Write the object to f. Returns (blob generations used, size
+		of blobs used, sections written, table of contents)."""
+		f.seek(0)
+		f.truncate()
+		if compact:
+			self.blobs.new_generation()
+		f.write(SECTIONED_MAGIC)
+		pickler = self._pickle(f, self.object, compact)
+		used = pickler.used
+		used_size = pickler.used_size
+
+		toc = []
+		for section in pickler.sections:
+			offset = f.tell()
+			if (isinstance(section, SectionRef)
+			    and section.blobs is self.blobs
+			    and not compact):
+				# It hasn't been loaded, so just copy it.
+				f.write(section.read())
+				entry = (section.used, section.used_size)
+			else:
+				section_pickler = self._pickle(f, section.load(), compact)
+				entry = (section_pickler.used, section_pickler.used_size)
+			toc.append((offset, f.tell() - offset) + entry)
+			used = used | entry[0]
+			used_size += entry[1]
+
+		toc_offset = f.tell()
+		pickle.dump((self.journal_id, toc), f, pickle.HIGHEST_PROTOCOL)
+		f.write(struct.pack(">Q", toc_offset))
+		return (used, used_size, pickler.sections, toc)
 
 	def close(self):
 		"""Reduce the reference count of the persisted object, saving
@@ -141,34 +605,129 @@ class Persisted:
 			# Still in use.
 			return
 
-		if self.object.is_modified():
+		self.save()
+		if self.section_file is not None:
+			self.section_file.close()
+		if self.lock_file is not None:
+			self.lock_file.close()
+		self.persister._remove(self.filename)
+
+	def save(self):
+		"""Save the object back to its file if it's been modified,
+		keeping it open."""
+
+		if not self.object.is_modified():
+			return
+		if not self._append_journal():
 			print("Saving state file.")
+			self.journal_id = os.urandom(JOURNAL_ID_SIZE)
 			newname = "%s.new-%d" % (self.filename, os.getpid())
-			newfile = open(newname, "wb")
-			pickle.dump(self.object, newfile, pickle.HIGHEST_PROTOCOL)
-			newfile.close()
+			newfile = open(newname, "w+b")
+			(used, used_size, sections, toc) = self._dump(newfile, False)
+			waste = self.blobs.size() - used_size
+			if ((waste > BLOB_WASTE_LIMIT or used_size == 0)
+			    and waste > used_size):
+				print("Compacting " + self.blobs.prefix + "*.")
+				(used, used_size, sections, toc) = self._dump(newfile, True)
+			newfile.flush()
+			self.blobs.flush()
 			os.rename(newname, self.filename)
 
+			# Sections that haven't been loaded must now be read
+			# from the new file, since the old one (and the blobs
+			# it refers to) are going away.
+			for (section, entry) in zip(sections, toc):
+				if isinstance(section, SectionRef):
+					section.file = newfile
+					section.blobs = self.blobs
+					(section.offset, section.length, section.used, section.used_size) = entry
+			if self.section_file is not None:
+				self.section_file.close()
+			self.section_file = newfile
+
+			self.blobs.remove_unused(used)
+			try:
+				os.unlink(self.filename + ".journal")
+			except OSError as e:
+				if e.errno != errno.ENOENT:
+					raise e
+			self.journal_end = None
+		self.object.modified(False)
+
+class SQLitePersisted(Persisted):
+	"""Context manager for a persistent object stored in an SQLite
+	database rather than a pickle file. The object is responsible for
+	reading and writing its own tables using load_db and save_db; it
+	may also keep the connection and make changes to the database while
+	it's open. Changes are committed when the object is saved or
+	closed, so a run that's interrupted leaves the database as it was
+	when it was last saved."""
+
+	def __init__(self, klass, filename, persister):
+		Persisted.__init__(self, klass, filename, persister)
+		self.db = None
+
+	def _open(self, no_block):
+		print("Loading state database.")
+
+		if not self._get_lock(no_block):
+			return None
+
+		self.db = sqlite3.connect(self.filename)
+		self.object = self.klass()
+		self.object.load_db(self.db)
+		self.object.modified(False)
+
+	def close(self):
+		"""Reduce the reference count of the persisted object, saving
+		it back to its database if necessary."""
+
+		self.refcount -= 1
+		if self.refcount > 0:
+			# Still in use.
+			return
+
+		self.save()
+		self.db.close()
+		self.db = None
+
 		if self.lock_file is not None:
 			self.lock_file.close()
 		self.persister._remove(self.filename)
 
+	def save(self):
+		"""Save the object and commit the database, keeping it
+		open."""
+
+		if self.object.is_modified():
+			print("Saving state database.")
+			self.object.save_db(self.db)
+			self.object.modified(False)
+		self.db.commit()
+
 class Persister:
 	"""Manage the collection of persisted files."""
 
 	def __init__(self, config):
 		self.files = {}
 		self.use_locking = config.locking
+		self.configure(config)
+
+	def configure(self, config):
+		"""Read the settings for saving files from config."""
+		self.journal_ratio = config["journalratio"]
+		self.compression = (config["statecompression"], config["statecompressionlevel"])
 
-	def get(self, klass, filename):
+	def get(self, klass, filename, persisted_class=Persisted):
 		"""Get a context manager for a persisted file.
 		If the file is already open, this will return
-		the existing context manager."""
+		the existing context manager. persisted_class
+		selects how the file is stored."""
 
 		if filename in self.files:
 			return self.files[filename]
 
-		p = Persisted(klass, filename, self)
+		p = persisted_class(klass, filename, self)
 		self.files[filename] = p
 		return p
 
@@ -180,10 +739,11 @@ class Persister:
 		del self.files[filename]
 
 	def delete(self, filename):
-		"""Delete a persisted file, along with its lock file,
-		if they exist."""
-		for ext in ("", ".lock"):
+		"""Delete a persisted file, along with its lock file and
+		journal, if they exist."""
+		for ext in ("", ".lock", ".journal"):
 			try:
 				os.unlink(filename + ext)
 			except OSError:
 				pass
+		BlobFile(filename).remove_all()
@@ -23,22 +23,39 @@ import six
 from six.moves import range
 VERSION = "3.3"
 HTTP_AGENT = "rawdog/" + VERSION
+# The version of the state file's contents. State from older versions
+# that can't be converted is refused. Changes that can be converted when
+# the state is loaded, such as the move from pickling articles as dicts,
+# don't need a new version. (Older versions of rawdog can't read the
+# sectioned state file format at all, so they don't need one either.)
 STATE_VERSION = 2
 
+import rawdoglib.asynchttp
 import rawdoglib.feedscanner
-from rawdoglib.persister import Persistable, Persister
+import rawdoglib.httppool
+from rawdoglib.persister import Blob, BlobRef, COMPRESSION_LEVELS, Persistable, Persister, Section, SectionRef, SQLitePersisted
 
-from io import StringIO
+from io import BytesIO, StringIO
+import asyncio
 import base64
 import calendar
 import cgi
+import collections
+import concurrent.futures
+import email.utils
 import feedparser
 import getopt
 import hashlib
+import heapq
 import html
+import itertools
 import locale
+import multiprocessing
 import os
+import six.moves.cPickle as pickle
+import queue
 import re
+import signal
 import socket
 import string
 import sys
@@ -62,6 +79,17 @@ try:
 	_HTMLSanitizer = feedparser.sanitizer._HTMLSanitizer
 except AttributeError:
 	_HTMLSanitizer = feedparser._HTMLSanitizer
+try:
+	_ACCEPT_HEADER = feedparser.http.ACCEPT_HEADER
+except AttributeError:
+	_ACCEPT_HEADER = feedparser.ACCEPT_HEADER
+
+# Turn off content-cleaning, as we need the original content
+# for hashing and we'll do this ourselves afterwards.
+PARSE_ARGS = {}
+if hasattr(feedparser, "api"):
+	PARSE_ARGS["sanitize_html"] = False
+	PARSE_ARGS["resolve_relative_uris"] = False
 
 persister = None
 system_encoding = None
@@ -90,6 +118,19 @@ def format_time(secs, config):
 		format = config["dayformat"] + " " + config["timeformat"]
 	return safe_ftime(format, t)
 
+def format_period(secs):
+	"""Format a length of time using the units accepted in the config
+	file."""
+	secs = int(secs)
+	parts = []
+	for (unit, size) in (("w", 604800), ("d", 86400), ("h", 3600), ("m", 60), ("s", 1)):
+		if secs >= size:
+			parts.append("%d%s" % (secs // size, unit))
+			secs %= size
+	if parts == []:
+		return "0s"
+	return " ".join(parts)
+
 def encode_references(s):
 	"""Encode characters in a Unicode string using HTML references."""
 
@@ -245,38 +286,133 @@ def string_to_html(s, config):
 	"""Convert a string to HTML."""
 	return sanitise_html(html.escape(s), "", True, config)
 
+def get_render_fingerprint(feed):
+	"""Return a string describing everything apart from the article
+	itself that affects the output of article_to_html."""
+	return "%s %s %s %s" % (VERSION, feedparser.__version__,
+	                        mxtidy is not None,
+	                        feed.args.get("format", "default"))
+
+def article_to_html(article, feed, config):
+	"""Convert the parts of an article that came from its feed into
+	sanitised HTML. Returns a dict containing the title, description,
+	author, url and guid; any that the article doesn't have are None."""
+	entry_info = article.entry_info
+	bits = {}
+
+	bits["title"] = detail_to_html(entry_info.get("title_detail"), True, config)
+
+	key = None
+	for k in ["content", "summary_detail"]:
+		if k in entry_info:
+			key = k
+			break
+	if key is None:
+		bits["description"] = None
+	else:
+		force_preformatted = (feed.args.get("format", "default") == "text")
+		bits["description"] = detail_to_html(entry_info[key], False, config, force_preformatted)
+
+	bits["author"] = author_to_html(entry_info, feed.url, config)
+
+	for (name, key) in (("url", "link"), ("guid", "id")):
+		value = entry_info.get(key)
+		if value is None or value == "":
+			bits[name] = None
+		else:
+			bits[name] = string_to_html(value, config)
+
+	return bits
+
 template_re = re.compile(r'(__[^_].*?__)')
+
+class Template:
+	"""A template that has been split into a list of operations, so that
+	it can be filled in many times without parsing it again. Each
+	operation is one of:
+
+	("text", s, None) -- output s
+	("key", x, None) -- output bits["x"], if it exists
+	("if", x, (expected, target)) -- if whether bits["x"] is not ""
+	                                 doesn't match expected, jump to
+	                                 operation number target"""
+
+	def __init__(self, template):
+		self.ops = []
+		# For each __if_x__ that hasn't been closed yet, the
+		# position of the operation that tests it.
+		if_stack = []
+		# The last position that a conditional jumps to.
+		last_target = None
+
+		def set_target(i, target):
+			(op, key, (expected, old_target)) = self.ops[i]
+			self.ops[i] = (op, key, (expected, target))
+
+		for part in template_re.split(template):
+			if part.startswith("__") and part.endswith("__"):
+				key = part[2:-2]
+				if key.startswith("if_"):
+					if_stack.append(len(self.ops))
+					self.ops.append(("if", key[3:], (True, None)))
+				elif key == "endif":
+					if if_stack != []:
+						last_target = len(self.ops)
+						set_target(if_stack.pop(), last_target)
+				elif key == "else":
+					if if_stack != []:
+						i = if_stack.pop()
+						last_target = len(self.ops)
+						set_target(i, last_target)
+						(op, k, (expected, target)) = self.ops[i]
+						if_stack.append(len(self.ops))
+						self.ops.append(("if", k, (not expected, None)))
+				else:
+					self.ops.append(("key", key, None))
+			elif part != "":
+				if (self.ops != []
+				    and self.ops[-1][0] == "text"
+				    and last_target != len(self.ops)):
+					self.ops[-1] = ("text", self.ops[-1][1] + part, None)
+				else:
+					self.ops.append(("text", part, None))
+
+		# Any conditionals left open run to the end.
+		for i in if_stack:
+			set_target(i, len(self.ops))
+
+	def fill(self, bits):
+		"""Expand the template using the given bits."""
+		out = []
+		ops = self.ops
+		num_ops = len(ops)
+		i = 0
+		while i < num_ops:
+			(op, arg, jump) = ops[i]
+			i += 1
+			if op == "text":
+				out.append(arg)
+			elif op == "key":
+				if arg in bits:
+					out.append(bits[arg])
+			elif (arg in bits and bits[arg] != "") != jump[0]:
+				i = jump[1]
+		return "".join(out)
+
+template_cache = {}
+def compile_template(template):
+	"""Return a Template for the given template string, reusing the one
+	made last time if the same template is used again."""
+	if template not in template_cache:
+		template_cache[template] = Template(template)
+	return template_cache[template]
+
 def fill_template(template, bits):
 	"""Expand a template, replacing __x__ with bits["x"], and only
 	including sections bracketed by __if_x__ .. [__else__ ..]
 	__endif__ if bits["x"] is not "". If not bits.has_key("x"),
 	__x__ expands to ""."""
-
-	f = StringIO()
-	if_stack = []
-	def write(s):
-		if not False in if_stack:
-			f.write(s)
-
-	for part in template_re.split(template):
-		if part.startswith("__") and part.endswith("__"):
-			key = part[2:-2]
-			if key.startswith("if_"):
-				k = key[3:]
-				if_stack.append(k in bits and bits[k] != "")
-			elif key == "endif":
-				if if_stack != []:
-					if_stack.pop()
-			elif key == "else":
-				if if_stack != []:
-					if_stack.append(not if_stack.pop())
-			elif key in bits:
-				write(bits[key])
-		else:
-			write(part)
-	v = f.getvalue()
-	f.close()
-	return v
+	return compile_template(template).fill(bits)
 
 file_cache = {}
 def load_file(name):
@@ -308,6 +444,14 @@ def short_hash(s):
 	b = s.encode('utf-8')
 	return hashlib.sha1(b).hexdigest()[-8:]
 
+def iter_sorted(items):
+	"""Yield the items from a list in sorted order, consuming the list.
+	This uses a heap, so getting the first few items from a long list
+	is much quicker than sorting all of it."""
+	heapq.heapify(items)
+	while items:
+		yield heapq.heappop(items)
+
 def ensure_unicode(value, encoding):
 	"""Convert a structure returned by feedparser into an equivalent where
 	all strings are represented as fully-decoded unicode objects."""
@@ -329,12 +473,94 @@ def ensure_unicode(value, encoding):
 	else:
 		return value
 
+def parse_feed_data(data, headers, url):
+	"""Parse a feed that has already been fetched from url, returning
+	the same result that feedparser.parse would if it had fetched the
+	feed itself."""
+	headers = dict(headers)
+	# This tells feedparser the base URL for relative links.
+	headers["content-location"] = six.moves.urllib.parse.urljoin(url, headers.get("content-location", ""))
+
+	result = feedparser.parse(BytesIO(data), response_headers=headers, **PARSE_ARGS)
+	if headers.get("etag"):
+		result["etag"] = headers["etag"]
+	if headers.get("last-modified"):
+		result["modified"] = headers["last-modified"]
+	result["href"] = url
+	return result
+
+def needs_parsing(download):
+	"""Return True if the result of Feed.download has content that
+	needs to be parsed."""
+	if "data" not in download or download["data"] == b"":
+		return False
+	if "rawdog_body_match" in download:
+		return False
+	return download["status"] // 100 == 2
+
+def parse_download(download):
+	"""Turn the result of Feed.download into the feedparser result that
+	Feed.update expects. This is CPU-bound, and can be run in another
+	process, so it also does the conversion that Feed.update would
+	otherwise do with ensure_unicode."""
+
+	if "data" not in download:
+		# The download failed; just pass the error on.
+		return dict(download)
+
+	if needs_parsing(download):
+		try:
+			result = parse_feed_data(download["data"], download["headers"], download["url"])
+			# Exceptions describing problems with the feed's
+			# content can't necessarily be pickled.
+			if "bozo_exception" in result:
+				result["bozo_exception"] = str(result["bozo_exception"])
+			result = ensure_unicode(result, result.get("encoding") or "UTF-8")
+			result["rawdog_unicode"] = True
+		except Exception as e:
+			result = {"rawdog_exception": e}
+	else:
+		# An error, or nothing to parse; Feed.update will look at
+		# the status in the response log.
+		result = {"feed": {}, "entries": []}
+	result["status"] = download["status"]
+	result["rawdog_responses"] = download["rawdog_responses"]
+	for key in ("rawdog_body_digest", "rawdog_body_match"):
+		if key in download:
+			result[key] = download[key]
+	return result
+
+def get_parse_result(future, download):
+	"""Get the result of a parse_download call that was run in a
+	ProcessPoolExecutor."""
+	try:
+		return future.result()
+	except Exception as e:
+		return get_error_result(e, download)
+
+def get_error_result(e, download=None):
+	"""Return a result for Feed.update that reports an exception raised
+	while fetching or parsing a feed, keeping the response log from
+	download if there is one."""
+	responses = []
+	if download is not None:
+		responses = download.get("rawdog_responses", [])
+	return {
+		"rawdog_exception": e,
+		"rawdog_traceback": sys.exc_info()[2],
+		"rawdog_responses": responses,
+		}
+
+def basic_auth(user, password):
+	"""Return the credentials for HTTP basic authentication."""
+	return base64.b64encode((user + ":" + password).encode("UTF-8")).decode("ascii")
+
 class BasicAuthProcessor(six.moves.urllib.request.BaseHandler):
 	"""urllib2 handler that does HTTP basic authentication
 	or proxy authentication with a fixed username and password."""
 
 	def __init__(self, user, password, proxy=False):
-		self.auth = base64.b64encode(user + ":" + password)
+		self.auth = basic_auth(user, password)
 		if proxy:
 			self.header = "Proxy-Authorization"
 		else:
@@ -357,6 +583,62 @@ class DisableIMProcessor(six.moves.urllib.request.BaseHandler):
 
 	https_request = http_request
 
+# The response headers kept in the response log, as well as the status.
+LOGGED_HEADERS = ("Location", "Date", "Age", "Cache-Control", "Expires", "Retry-After")
+
+def parse_http_date(value):
+	"""Parse a date in an HTTP header into a time in seconds, or return
+	None if it can't be parsed."""
+	try:
+		parsed = email.utils.parsedate_tz(value)
+	except (TypeError, ValueError):
+		return None
+	if parsed is None:
+		return None
+	return email.utils.mktime_tz(parsed)
+
+def get_server_delay(entry, now):
+	"""Return the time before which the server that sent a response
+	has asked not to be asked again, either because it's limiting
+	requests (with Retry-After) or because the response will stay
+	fresh (with Cache-Control or Expires), or None if it didn't say."""
+	# Allow for the server's clock being wrong when it gives a date.
+	date = parse_http_date(entry.get("date", ""))
+	if date is None:
+		date = now
+
+	status = entry["status"]
+	if status in (429, 503) and "retry-after" in entry:
+		value = entry["retry-after"].strip()
+		if value.isdigit():
+			return now + int(value)
+		retry_after = parse_http_date(value)
+		if retry_after is None:
+			return None
+		return now + retry_after - date
+	if status not in (200, 203, 226, 304):
+		return None
+
+	directives = {}
+	for directive in entry.get("cache-control", "").lower().split(","):
+		(name, sep, value) = directive.partition("=")
+		directives[name.strip()] = value.strip().strip('"')
+	if "no-cache" in directives or "no-store" in directives:
+		return None
+	if "max-age" in directives:
+		try:
+			max_age = int(directives["max-age"])
+			age = int(entry.get("age", "0"))
+		except ValueError:
+			return None
+		return now + max_age - age
+	if "expires" in entry:
+		expires = parse_http_date(entry["expires"])
+		if expires is None:
+			return None
+		return now + expires - date
+	return None
+
 class ResponseLogProcessor(six.moves.urllib.request.BaseHandler):
 	"""urllib2 handler that maintains a log of HTTP responses."""
 
@@ -372,9 +654,10 @@ class ResponseLogProcessor(six.moves.urllib.request.BaseHandler):
 			"url": req.get_full_url(),
 			"status": response.getcode(),
 			}
-		location = response.info().get("Location")
-		if location is not None:
-			entry["location"] = location
+		for name in LOGGED_HEADERS:
+			value = response.info().get(name)
+			if value is not None:
+				entry[name.lower()] = value
 		self.log.append(entry)
 		return response
 
@@ -383,6 +666,60 @@ class ResponseLogProcessor(six.moves.urllib.request.BaseHandler):
 	def get_log(self):
 		return self.log
 
+class BodyCache:
+	"""A copy of the last response body received from each feed, kept
+	in the bodycache directory. Once the files add up to more than
+	max_size bytes, the least recently used are removed."""
+
+	def __init__(self, max_size, dirname="bodycache"):
+		self.max_size = max_size
+		self.dirname = dirname
+		if not os.path.isdir(dirname):
+			os.mkdir(dirname)
+
+	def get_filename(self, url):
+		return os.path.join(self.dirname, short_hash(url))
+
+	def get(self, url):
+		"""Return the last body saved for a feed, or None."""
+		filename = self.get_filename(url)
+		try:
+			with open(filename, "rb") as f:
+				data = f.read()
+			os.utime(filename)
+		except OSError:
+			return None
+		return data
+
+	def save(self, url, data):
+		filename = self.get_filename(url)
+		with open(filename + ".new", "wb") as f:
+			f.write(data)
+		os.replace(filename + ".new", filename)
+
+	def trim(self):
+		"""Remove the least recently used bodies until the cache is
+		no bigger than max_size."""
+		entries = []
+		total = 0
+		for entry in os.scandir(self.dirname):
+			st = entry.stat()
+			entries.append((st.st_mtime, st.st_size, entry.path))
+			total += st.st_size
+		entries.sort()
+		for (mtime, size, path) in entries:
+			if total <= self.max_size:
+				break
+			os.unlink(path)
+			total -= size
+
+# The number of times at which new articles appeared that are kept for
+# each feed, to estimate how often it changes.
+CHANGE_HISTORY = 10
+
+# The shortest time to wait before trying a feed that's failed again.
+MIN_BACKOFF = 5 * 60
+
 class Feed:
 	"""An RSS feed."""
 
@@ -396,6 +733,28 @@ class Feed:
 		self.modified = None
 		self.last_update = 0
 		self.feed_info = {}
+		# When using split state, the (hash, sequence, added, date)
+		# of each of this feed's articles.
+		self.article_keys = None
+		# The most recent times at which new articles appeared in the
+		# feed, oldest first.
+		self.change_times = []
+		# The time before which the server has asked not to be
+		# asked for the feed again, or None.
+		self.not_before = None
+		# The number of times in a row that fetching the feed has
+		# failed, and the time of the first of those failures.
+		self.failures = 0
+		self.failing_since = None
+		# The digest of the last response body that the feed was
+		# updated from.
+		self.body_digest = None
+
+	def __setstate__(self, state):
+		# Fill in defaults for attributes added since the state was
+		# saved.
+		self.__init__(state["url"])
+		self.__dict__.update(state)
 
 	def is_timeout_exception(self, exc):
 		"""Return True if the exception suggests a timeout occurred."""
@@ -415,25 +774,114 @@ class Feed:
 		#   <urlopen error _ssl.c:495: The handshake operation timed out>
 		return timeout_re.search(str(exc)) is not None
 
-	def needs_update(self, now):
+	def get_changed_fields(self, old_state):
+		"""Return the names of the attributes that have changed since
+		old_state, a copy of the feed's __dict__, was taken."""
+		return [name for (name, value) in self.__dict__.items()
+		        if name not in old_state or old_state[name] != value]
+
+	def get_update_offset(self, config):
+		"""Return how far into each period this feed should be
+		updated, which is between 0 and updatespread times the period.
+		This is derived from the URL, so it's the same for every
+		update, but different for feeds with the same period."""
+		spread = config["updatespread"] * self.get_period(config)
+		if spread <= 0:
+			return 0
+		h = int(short_hash(self.url), 16)
+		return spread * h / 0x100000000
+
+	def record_changes(self, times):
+		"""Add the times at which new articles appeared to the feed's
+		change history."""
+		history = sorted(set(self.change_times) | set(times))
+		self.change_times = history[-CHANGE_HISTORY:]
+
+	def get_period(self, config):
+		"""Return the time to wait between updates of this feed. If
+		maxperiod is set, this is half the time the feed usually goes
+		between changes, or since it last changed if that's longer,
+		but no shorter than the feed's period or longer than
+		maxperiod."""
+		maxperiod = config["maxperiod"]
+		if maxperiod <= self.period or self.change_times == []:
+			return self.period
+		times = self.change_times
+		interval = self.last_update - times[-1]
+		if len(times) > 1:
+			interval = max(interval, (times[-1] - times[0]) / (len(times) - 1))
+		return min(max(interval / 2, self.period), maxperiod)
+
+	def get_next_update(self, config):
+		"""Return the time at which this feed should next be
+		updated."""
+		period = self.get_period(config)
+		due = self.last_update + period
+		if config["updatespread"] > 0 and period > 0:
+			# Move the update to the nearest time that's the feed's
+			# offset into a period, so that feeds with the same
+			# period are updated at different times. Once a feed's
+			# in step, it stays there, rather than drifting later
+			# by however late each run was.
+			offset = self.get_update_offset(config)
+			due = offset + round((due - offset) / period) * period
+		if self.not_before is not None and config["maxserverdelay"] > 0:
+			due = max(due, min(self.not_before,
+			                   self.last_update + config["maxserverdelay"]))
+		if self.failures > 0 and config["maxbackoff"] > 0:
+			if self.is_quarantined(config):
+				backoff = config["maxbackoff"]
+			else:
+				backoff = (max(self.get_period(config), MIN_BACKOFF)
+				           * 2 ** min(self.failures - 1, 30))
+			due = max(due, self.last_update + min(backoff, config["maxbackoff"]))
+		return due
+
+	def is_quarantined(self, config):
+		"""Return True if the feed has failed too many times in a row,
+		and is only being tried every maxbackoff until it works."""
+		return config["quarantine"] > 0 and self.failures >= config["quarantine"]
+
+	def needs_update(self, now, config):
 		"""Return True if it's time to update this feed, or False if
 		its update period has not yet elapsed."""
-		return (now - self.last_update) >= self.period
+		return now >= self.get_next_update(config)
 
 	def get_state_filename(self):
 		return "feeds/%s.state" % (short_hash(self.url),)
 
-	def fetch(self, rawdog, config):
-		"""Fetch the current set of articles from the feed."""
+	def get_proxies(self):
+		"""Return the proxies set in the feed's arguments, by
+		protocol."""
+		proxies = {}
+		for name, value in list(self.args.items()):
+			if name.endswith("_proxy"):
+				proxies[name[:-6]] = value
+		return proxies
+
+	def disable_im(self, config):
+		"""Return True if RFC 3229 mustn't be used for this feed.
+
+		If RFC 3229 and "A-IM: feed" is used, then there's
+		no way to tell when an article has been removed.
+		So if we only want to keep articles that are still
+		being published by the feed, we have to turn it off."""
+		return self.get_keepmin(config) == 0 or config["currentonly"]
+
+	def get_handlers(self, config, pool=None):
+		"""Return the urllib2 handlers to use when fetching this feed,
+		and the ResponseLogProcessor among them. If pool is a
+		ConnectionPool, HTTP requests are made using its connections."""
 
 		handlers = []
 		logger = ResponseLogProcessor()
 		handlers.append(logger)
 
-		proxies = {}
-		for name, value in list(self.args.items()):
-			if name.endswith("_proxy"):
-				proxies[name[:-6]] = value
+		if pool is not None:
+			handlers.append(rawdoglib.httppool.PooledHTTPHandler(pool))
+			handlers.append(rawdoglib.httppool.PooledHTTPSHandler(pool))
+
+		proxies = self.get_proxies()
 		if len(proxies) != 0:
 			handlers.append(six.moves.urllib.request.ProxyHandler(proxies))
 
@@ -443,53 +891,145 @@ class Feed:
 		if "user" in self.args and "password" in self.args:
 			handlers.append(BasicAuthProcessor(self.args["user"], self.args["password"]))
 
-		if self.get_keepmin(config) == 0 or config["currentonly"]:
-			# If RFC 3229 and "A-IM: feed" is used, then there's
-			# no way to tell when an article has been removed.
-			# So if we only want to keep articles that are still
-			# being published by the feed, we have to turn it off.
+		if self.disable_im(config):
 			handlers.append(DisableIMProcessor())
 
+		return (handlers, logger)
+
+	def get_fetch_url(self):
 		url = self.url
 		# Turn plain filenames into file: URLs. (feedparser will open
 		# plain filenames itself, but we want it to open the file with
 		# urllib2 so we get a URLError if something goes wrong.)
 		if not ":" in url:
 			url = "file:" + url
+		return url
 
-		parse_args = {
-			"etag": self.etag,
-			"modified": self.modified,
-			"agent": HTTP_AGENT,
-			"handlers": handlers,
-			}
-		# Turn off content-cleaning, as we need the original content
-		# for hashing and we'll do this ourselves afterwards.
-		if hasattr(feedparser, "api"):
-			parse_args["sanitize_html"] = False
-			parse_args["resolve_relative_uris"] = False
+	def download(self, rawdog, config, pool=None):
+		"""Fetch the feed's contents without parsing them. The result
+		can be turned into a parsed feed using parse_download."""
 
-		try:
-			result = feedparser.parse(url, **parse_args)
+		(handlers, logger) = self.get_handlers(config, pool)
 
-			# Older versions of feedparser return some kinds of
-			# download errors in bozo_exception rather than raising
-			# them from feedparser.parse. Normalise this.
-			e = result.get("bozo_exception")
+		try:
+			info = {}
+			data = feedparser.http.get(self.get_fetch_url(), self.etag, self.modified,
+			                           HTTP_AGENT, None, handlers, None, info)
+			# After a redirect, feedparser gives the status of the
+			# redirect rather than the final response.
+			responses = logger.get_log()
+			if responses:
+				status = responses[-1]["status"]
+			else:
+				status = info["status"]
+			download = {
+				"data": data or b"",
+				"headers": info["headers"],
+				"url": info["href"],
+				"status": status,
+				}
+		except Exception as e:
 			if self.is_timeout_exception(e):
-				result = {"rawdog_timeout": e}
-			elif isinstance(e, six.moves.urllib.error.URLError):
-				result = {"rawdog_exception": e}
+				download = {"rawdog_timeout": e}
+			else:
+				download = {
+					"rawdog_exception": e,
+					"rawdog_traceback": sys.exc_info()[2],
+					}
+		download["rawdog_responses"] = logger.get_log()
+		return download
+
+	def get_request_headers(self, config):
+		"""Return the HTTP request headers that feedparser would send
+		when fetching this feed."""
+		headers = {
+			"User-Agent": HTTP_AGENT,
+			"Accept": _ACCEPT_HEADER,
+			"Accept-Encoding": "gzip, deflate",
+			}
+		if self.etag:
+			headers["If-None-Match"] = self.etag
+		if self.modified:
+			headers["If-Modified-Since"] = self.modified
+		if "user" in self.args and "password" in self.args:
+			headers["Authorization"] = "Basic " + basic_auth(self.args["user"], self.args["password"])
+		if self.disable_im(config):
+			headers["A-IM"] = "identity"
+		else:
+			headers["A-IM"] = "feed"
+		return headers
+
+	def get_body_digest(self, data, config):
+		"""Return a digest of a response body, together with the
+		settings that affect how it's turned into articles."""
+		h = hashlib.sha1(data)
+		settings = (sorted(self.args.items()), sorted(config["keepfields"]),
+		            config["sanitiseonupdate"])
+		h.update(repr(settings).encode("UTF-8"))
+		return h.hexdigest()
+
+	def check_download(self, download, config, cache=None):
+		"""If the result of download has a body to parse, add its
+		digest, and mark it if it's the same as the body the feed was
+		last updated from, so that it isn't parsed again. If cache is
+		a BodyCache, the bodies are also compared byte for byte, and
+		new bodies are saved in it."""
+		if not needs_parsing(download):
+			return download
+		data = download["data"]
+		digest = self.get_body_digest(data, config)
+		download["rawdog_body_digest"] = digest
+		if cache is None:
+			if digest == self.body_digest:
+				download["rawdog_body_match"] = True
+		else:
+			cached = cache.get(self.url)
+			if digest == self.body_digest and cached in (None, data):
+				download["rawdog_body_match"] = True
+			elif cached != data:
+				cache.save(self.url, data)
+		return download
+
+	async def download_async(self, rawdog, config, client):
+		"""As download, but using an asynchttp.Client. Feeds that the
+		client can't fetch (local files, or feeds that use a proxy) are
+		fetched using download in a separate thread."""
+
+		if not self.url.startswith(("http:", "https:")) or len(self.get_proxies()) != 0:
+			loop = asyncio.get_running_loop()
+			return await loop.run_in_executor(None, self.download, rawdog, config)
+
+		log = []
+		try:
+			responses = await client.get(self.url, self.get_request_headers(config))
+			for response in responses:
+				entry = {
+					"url": response.url,
+					"status": response.status,
+					}
+				for name in LOGGED_HEADERS:
+					name = name.lower()
+					if name in response.headers:
+						entry[name] = response.headers[name]
+				log.append(entry)
+
+			final = responses[-1]
+			download = {
+				"data": final.body,
+				"headers": final.headers,
+				"url": final.url,
+				"status": final.status,
+				}
 		except Exception as e:
 			if self.is_timeout_exception(e):
-				result = {"rawdog_timeout": e}
+				download = {"rawdog_timeout": e}
 			else:
-				result = {
+				download = {
 					"rawdog_exception": e,
 					"rawdog_traceback": sys.exc_info()[2],
 					}
-		result["rawdog_responses"] = logger.get_log()
-		return result
+		download["rawdog_responses"] = log
+		return download
 
 	def update(self, rawdog, now, config, articles, p):
 		"""Add new articles from a feed to the collection.
@@ -515,6 +1055,10 @@ class Feed:
 			version = ""
 
 		self.last_update = now
+		if len(responses) > 0:
+			self.not_before = get_server_delay(responses[-1], now)
+		else:
+			self.not_before = None
 		errors = []
 		fatal = False
 		old_url = self.url
@@ -558,7 +1102,10 @@ class Feed:
 			fatal = True
 		elif last_status == 304:
 			# The feed hasn't changed.
-			return False
+			pass
+		elif "rawdog_body_match" in p:
+			# The server sent the same body as last time.
+			pass
 		elif last_status in [403, 410]:
 			# The feed is disallowed or gone.
 			errors.append("The feed has gone.")
@@ -580,17 +1127,41 @@ class Feed:
 
 		old_error = "\n".join(errors)
 
+		was_quarantined = self.is_quarantined(config)
+		if fatal:
+			if self.failures == 0:
+				self.failing_since = now
+			self.failures += 1
+		elif self.failures > 0:
+			print("Feed recovered after", self.failures, "failures:", old_url)
+			self.failures = 0
+			self.failing_since = None
+
 		if len(errors) != 0:
-			print("Feed:        ", old_url)
-			if last_status != 0:
-				print("HTTP Status: ", last_status)
-			for line in errors:
-				print(line)
+			if fatal and was_quarantined:
+				print("Quarantined feed failed again:", old_url)
+			else:
+				print("Feed:        ", old_url)
+				if last_status != 0:
+					print("HTTP Status: ", last_status)
+				for line in errors:
+					print(line)
 			if fatal:
+				if self.is_quarantined(config) and not was_quarantined:
+					print("This feed has failed", self.failures, "times in a row, so it will only be")
+					print("tried every", format_period(config["maxbackoff"]), "until it works again.")
+					print("")
 				return False
 
+		if last_status == 304 or "rawdog_body_match" in p:
+			# There's nothing new to parse.
+			return False
+
 		# From here, assume a complete feedparser response.
-		p = ensure_unicode(p, p.get("encoding") or "UTF-8")
+		if not p.get("rawdog_unicode"):
+			p = ensure_unicode(p, p.get("encoding") or "UTF-8")
+
+		self.body_digest = p.get("rawdog_body_digest")
 
 		# No entries means the feed hasn't changed, but for some reason
 		# we didn't get a 304 response. Handle it the same way.
@@ -602,14 +1173,15 @@ class Feed:
 		self.feed_info = p["feed"]
 		feed = self.url
 
-		article_ids = {}
-		# Find IDs for existing articles.
-		for (hash, a) in list(articles.items()):
-			id = a.entry_info.get("id")
-			if a.feed == feed and id is not None:
-				article_ids[id] = a
+		# Find IDs for existing articles. Take a copy, so that articles
+		# added below can't be matched by ID during this update.
+		article_ids = dict(articles.ids_for_feed(feed))
+
+		if config["sanitiseonupdate"]:
+			fingerprint = get_render_fingerprint(self)
 
 		seen_articles = set()
+		change_times = []
 		sequence = 0
 		for entry_info in p["entries"]:
 			article = Article(feed, entry_info, now, sequence)
@@ -618,24 +1190,41 @@ class Feed:
 
 			id = entry_info.get("id")
 			if id in article_ids:
-				existing_article = article_ids[id]
+				existing_article = articles[article_ids[id]]
 			elif article.hash in articles:
 				existing_article = articles[article.hash]
 			else:
 				existing_article = None
 
+			if config["sanitiseonupdate"]:
+				article.render_html(existing_article, self, fingerprint, config)
+
 			if existing_article is not None:
-				existing_article.update_from(article, now)
+				articles.update(existing_article, article, now)
 			else:
-				articles[article.hash] = article
+				articles.add(article)
+				if article.date is not None and article.date < now:
+					change_times.append(article.date)
+				else:
+					change_times.append(now)
+
+		if change_times != []:
+			self.record_changes(change_times)
 
 		if config["currentonly"]:
-			for (hash, a) in list(articles.items()):
-				if a.feed == feed and hash not in seen_articles:
-					del articles[hash]
+			for hash in list(articles.hashes_for_feed(feed)):
+				if hash not in seen_articles:
+					articles.remove(hash)
 
 		return True
 
+	def index_articles(self, articles):
+		"""Record the information needed to choose articles from this
+		feed for output, so that its state file need not be loaded
+		unless some of its articles are going to be written."""
+		self.article_keys = [(a.hash, a.sequence, a.added, a.date)
+		                     for a in articles.values()]
+
 	def get_html_name(self, config):
 		if "title_detail" in self.feed_info:
 			r = detail_to_html(self.feed_info["title_detail"], True, config)
@@ -664,12 +1253,79 @@ class Feed:
 	def get_keepmin(self, config):
 		return self.args.get("keepmin", config["keepmin"])
 
+# The parts of a feedparser entry that rawdog uses once an article has
+# been created, and "title", which templates and plugins often use. The
+# keepfields option adds to this.
+ENTRY_INFO_KEYS = frozenset(["id", "link", "title", "title_detail", "content",
+                             "summary_detail", "author", "author_detail"])
+entry_info_keys = ENTRY_INFO_KEYS
+
+def compact_detail(detail):
+	"""Return a copy of a feedparser detail dict with its metadata
+	strings interned, since the same few values appear in many
+	articles."""
+	d = {}
+	for (k, v) in detail.items():
+		if k != "value" and isinstance(v, str):
+			v = sys.intern(v)
+		d[sys.intern(k)] = v
+	return d
+
+def compact_entry_info(entry_info):
+	"""Return a copy of a feedparser entry containing only the keys in
+	entry_info_keys."""
+	d = {}
+	for (k, v) in entry_info.items():
+		if k not in entry_info_keys:
+			continue
+		if isinstance(v, dict):
+			v = compact_detail(v)
+		elif isinstance(v, list):
+			v = [compact_detail(x) if isinstance(x, dict) else x for x in v]
+		elif k == "author" and isinstance(v, str):
+			v = sys.intern(v)
+		d[sys.intern(k)] = v
+	return d
+
+class ArticleBody(Blob):
+	"""The parts of an article that are only needed to write it out:
+	its entry_info and the HTML stored by sanitiseonupdate. These are
+	kept out of the state file, and only loaded when they're used."""
+
+	__slots__ = ("entry_info", "html")
+
+	def __init__(self, entry_info, html):
+		self.entry_info = entry_info
+		self.html = html
+		self.ref = None
+
+	def __getstate__(self):
+		return (self.entry_info, self.html)
+
+	def __setstate__(self, state):
+		(self.entry_info, self.html) = state
+		self.ref = None
+
+def get_entry_digest(entry_info):
+	"""Return a digest of an article's entry_info, so it can be compared
+	with another without loading either."""
+	return hashlib.sha1(repr(entry_info).encode("UTF-8", "backslashreplace")).digest()
+
 class Article:
 	"""An article retrieved from an RSS feed."""
 
+	# New attributes must be added at the end, so that articles pickled
+	# by __getstate__ can still be loaded. body is an ArticleBody, or a
+	# BlobRef if it hasn't been loaded; id, link and digest are copied
+	# from it so they're always available. html_key is the fingerprint
+	# of the stored HTML, if there is any.
+	__slots__ = ("feed", "body", "sequence", "date", "hash",
+	             "last_seen", "added", "last_changed", "html_key",
+	             "id", "link", "digest")
+
 	def __init__(self, feed, entry_info, now, sequence):
-		self.feed = feed
-		self.entry_info = entry_info
+		self.feed = sys.intern(feed)
+		self.body = ArticleBody(entry_info, None)
 		self.sequence = sequence
 		self.date = None
 
@@ -687,6 +1343,59 @@ class Article:
 		self.hash = self.compute_initial_hash()
 		self.last_seen = now
 		self.added = now
+		self.last_changed = now
+
+		# The date and hash have been worked out, so the rest of the
+		# entry can go.
+		self.set_body(compact_entry_info(entry_info), None)
+
+	def __getstate__(self):
+		state = [getattr(self, name) for name in self.__slots__]
+		if isinstance(self.body, ArticleBody) and self.body.ref is not None:
+			# It's already been stored and hasn't changed since.
+			state[1] = self.body.ref
+		return tuple(state)
+
+	def __setstate__(self, state):
+		if isinstance(state, dict):
+			# A dict of attributes, as pickled by older versions
+			# (which didn't have the last few).
+			self.last_changed = None
+			state = dict(state)
+			entry_info = state.pop("entry_info")
+			html = state.pop("html", None)
+			for (name, value) in state.items():
+				setattr(self, name, value)
+			self.feed = sys.intern(self.feed)
+			self.set_body(compact_entry_info(entry_info), html)
+		else:
+			for (name, value) in zip(self.__slots__, state):
+				setattr(self, name, value)
+
+	def set_body(self, entry_info, html):
+		"""Replace the article's body."""
+		self.body = ArticleBody(entry_info, html)
+		self.id = entry_info.get("id")
+		self.link = entry_info.get("link")
+		self.digest = get_entry_digest(entry_info)
+		if html is None:
+			self.html_key = None
+		else:
+			self.html_key = html[0]
+
+	def load_body(self):
+		"""Return the article's body, loading it if necessary."""
+		if isinstance(self.body, BlobRef):
+			self.body = self.body.load()
+		return self.body
+
+	@property
+	def entry_info(self):
+		return self.load_body().entry_info
+
+	@property
+	def html(self):
+		return self.load_body().html
 
 	def compute_initial_hash(self):
 		"""Compute an initial unique hash for an article."""
@@ -710,19 +1419,478 @@ class Article:
 
 	def update_from(self, new_article, now):
 		"""Update contents from a newer identical article."""
-		self.entry_info = new_article.entry_info
+		if new_article.digest != self.digest:
+			self.last_changed = now
+			self.set_body(new_article.entry_info, new_article.html)
+		elif new_article.html_key != self.html_key:
+			self.set_body(self.entry_info, new_article.html)
 		self.sequence = new_article.sequence
 		self.date = new_article.date
 		self.last_seen = now
 
+	def render_html(self, old_article, feed, fingerprint, config):
+		"""Sanitise the parts of the article that will be written, so
+		that it needn't be done when writing. If old_article, the
+		version already stored, has the same contents and HTML for
+		the same fingerprint, just mark this one as having it too, so
+		that update_from keeps it."""
+		if (old_article is not None
+		    and old_article.html_key == fingerprint
+		    and old_article.digest == self.digest):
+			self.html_key = fingerprint
+		else:
+			self.set_body(self.entry_info, (fingerprint, article_to_html(self, feed, config)))
+
 	def can_expire(self, now, config):
-		return (now - self.last_seen) > config["expireage"]
+		return can_expire(self.last_seen, now, config)
 
 	def get_sort_date(self, config):
+		return get_sort_date(self.added, self.date, config)
+
+def can_expire(last_seen, now, config):
+	"""As Article.can_expire, for an article that isn't loaded."""
+	return (now - last_seen) > config["expireage"]
+
+def get_sort_date(added, date, config):
+	"""As Article.get_sort_date, for an article that isn't loaded."""
+	if config["sortbyfeeddate"]:
+		return date or added
+	else:
+		return added
+
+class ArticleStore:
+	"""The collection of articles, keyed by hash, with a secondary index
+	by feed so that per-feed operations don't need to look at every
+	article in the collection."""
+
+	def __init__(self):
+		self.articles = {}
+		# Feed URL -> {entry ID: article hash}.
+		self.feed_ids = {}
+		# Feed URL -> hashes of the feed's articles. This is a dict
+		# used as an ordered set, so that it preserves the order in
+		# which articles were added.
+		self.feed_hashes = {}
+		# Feed URL -> hashes of the feed's articles, ordered by
+		# last_seen, so the ones that might expire come first.
+		self.feed_seen = {}
+		# URLs of feeds whose feed_seen entries have had articles
+		# added out of order, and need sorting before they're used.
+		self.unsorted_seen = set()
+		# The changes made since the store was loaded, as (method
+		# name, arguments...) tuples that replay can call again.
+		self.changes = []
+
+	def __getstate__(self):
+		for url in list(self.unsorted_seen):
+			self._get_seen(url)
+		state = dict(self.__dict__)
+		del state["changes"]
+		del state["unsorted_seen"]
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self.changes = []
+		self.unsorted_seen = set()
+		if "feed_seen" not in state:
+			# Saved by an older version.
+			self.feed_seen = {}
+			for url, hashes in self.feed_hashes.items():
+				self._sort_seen(url, hashes)
+
+	def __len__(self):
+		return len(self.articles)
+
+	def __contains__(self, hash):
+		return hash in self.articles
+
+	def __getitem__(self, hash):
+		return self.articles[hash]
+
+	def get(self, hash, default=None):
+		return self.articles.get(hash, default)
+
+	def keys(self):
+		return self.articles.keys()
+
+	def values(self):
+		return self.articles.values()
+
+	def items(self):
+		return self.articles.items()
+
+	def feeds(self):
+		"""Return the URLs of the feeds that have articles."""
+		return self.feed_hashes.keys()
+
+	def ids_for_feed(self, url):
+		"""Return a dict mapping entry IDs to article hashes for a
+		feed. The caller must not modify it."""
+		return self.feed_ids.get(url, {})
+
+	def hashes_for_feed(self, url):
+		"""Return the hashes of a feed's articles, in the order they
+		were added."""
+		return self.feed_hashes.get(url, {}).keys()
+
+	def count_for_feed(self, url):
+		return len(self.feed_hashes.get(url, {}))
+
+	def expiry_candidates(self, url, now, config):
+		"""Return (added, sequence, hash) for each of a feed's articles
+		that can be expired, in the order they should be expired."""
+		candidates = []
+		for hash in self._get_seen(url):
+			article = self.articles[hash]
+			if not can_expire(article.last_seen, now, config):
+				# Nor can any of the rest.
+				break
+			candidates.append((article.added, article.sequence, hash))
+		candidates.sort()
+		return candidates
+
+	def iter_sorted_keys(self, config):
+		"""Yield (-sort date, feed, sequence, hash) for each article,
+		in the order they should be written."""
+		keys = [(-a.get_sort_date(config), a.feed, a.sequence, a.hash)
+		        for a in self.articles.values()]
+		return iter_sorted(keys)
+
+	def _reindex_id(self, url, id, ignore=None):
+		"""Point an ID at the most recently added article in a feed
+		that has it (excluding the article ignore), as if the index
+		had been built by scanning all the articles in order."""
+		if id is None:
+			return
+		ids = self.feed_ids.setdefault(url, {})
+		ids.pop(id, None)
+		for hash in reversed(self.feed_hashes.get(url, {})):
+			if hash != ignore and self.articles[hash].id == id:
+				ids[id] = hash
+				break
+		if len(ids) == 0:
+			del self.feed_ids[url]
+
+	def _sort_seen(self, url, hashes):
+		"""Rebuild a feed's last_seen order from scratch."""
+		articles = self.articles
+		self.feed_seen[url] = dict.fromkeys(sorted(hashes, key=lambda hash: articles[hash].last_seen))
+
+	def _get_seen(self, url):
+		"""Return a feed's hashes in last_seen order, sorting them if
+		necessary."""
+		if url in self.unsorted_seen:
+			self.unsorted_seen.discard(url)
+			self._sort_seen(url, self.feed_seen[url])
+		return self.feed_seen.get(url, {})
+
+	def _mark_seen(self, article):
+		"""Move an article to the end of its feed's last_seen order."""
+		seen = self.feed_seen.setdefault(article.feed, {})
+		seen.pop(article.hash, None)
+		last = next(reversed(seen), None)
+		seen[article.hash] = None
+		if last is not None and self.articles[last].last_seen > article.last_seen:
+			# The clock must have gone backwards, or articles are
+			# being added in bulk. Sort the feed's order once
+			# it's needed, rather than every time this happens.
+			self.unsorted_seen.add(article.feed)
+
+	def count_changes(self):
+		"""Return a Counter of the kinds of change that have been
+		made."""
+		return collections.Counter(change[0] for change in self.changes)
+
+	def clear_changes(self):
+		"""Forget the changes that have been made, once they've been
+		saved."""
+		self.changes = []
+
+	def replay(self, changes):
+		"""Make changes recorded by another instance of the store."""
+		for change in changes:
+			getattr(self, change[0])(*change[1:])
+		self.changes = []
+
+	def add(self, article):
+		"""Add a new article to the collection."""
+		self.articles[article.hash] = article
+		self.feed_hashes.setdefault(article.feed, {})[article.hash] = None
+		self._mark_seen(article)
+		id = article.id
+		if id is not None:
+			self.feed_ids.setdefault(article.feed, {})[id] = article.hash
+		self.changes.append(("add", article))
+
+	def update(self, article, new_article, now):
+		"""Update an article in the collection from a newer version
+		of it."""
+		old_id = article.id
+		old_body = article.body
+		article.update_from(new_article, now)
+		if article.body is old_body:
+			# Only the fields that seen sets have changed, so
+			# record the change more compactly.
+			self._mark_seen(article)
+			self.changes.append(("seen", article.hash, article.sequence, article.date, now))
+		else:
+			self._updated(article, old_id)
+
+	def seen(self, hash, sequence, date, now):
+		"""Record that an article's been seen again unchanged."""
+		article = self.articles[hash]
+		article.sequence = sequence
+		article.date = date
+		article.last_seen = now
+		self._mark_seen(article)
+		self.changes.append(("seen", hash, sequence, date, now))
+
+	def replace(self, article):
+		"""Replace an article with another version of it that has the
+		same hash."""
+		old_id = self.articles[article.hash].id
+		self.articles[article.hash] = article
+		self._updated(article, old_id)
+
+	def _updated(self, article, old_id):
+		self._mark_seen(article)
+		new_id = article.id
+		if new_id != old_id:
+			self._reindex_id(article.feed, old_id)
+			self._reindex_id(article.feed, new_id)
+		self.changes.append(("replace", article))
+
+	def remove(self, hash):
+		"""Remove an article from the collection."""
+		article = self.articles[hash]
+		id = article.id
+		if self.feed_ids.get(article.feed, {}).get(id) == hash:
+			self._reindex_id(article.feed, id, hash)
+		hashes = self.feed_hashes[article.feed]
+		del hashes[hash]
+		if len(hashes) == 0:
+			del self.feed_hashes[article.feed]
+			del self.feed_seen[article.feed]
+			self.unsorted_seen.discard(article.feed)
+		else:
+			del self.feed_seen[article.feed][hash]
+		del self.articles[hash]
+		self.changes.append(("remove", hash))
+
+	def remove_feed(self, url):
+		"""Remove all the articles belonging to a feed."""
+		for hash in self.feed_hashes.pop(url, {}):
+			del self.articles[hash]
+		self.feed_ids.pop(url, None)
+		self.feed_seen.pop(url, None)
+		self.unsorted_seen.discard(url)
+		self.changes.append(("remove_feed", url))
+
+	def rename_feed(self, oldurl, newurl):
+		"""Move all the articles belonging to a feed to a new URL."""
+		self.changes.append(("rename_feed", oldurl, newurl))
+		hashes = self.feed_hashes.pop(oldurl, None)
+		if hashes is None:
+			return
+		for hash in hashes:
+			self.articles[hash].feed = newurl
+		self.feed_hashes[newurl] = hashes
+		self.feed_seen[newurl] = self.feed_seen.pop(oldurl)
+		if oldurl in self.unsorted_seen:
+			self.unsorted_seen.discard(oldurl)
+			self.unsorted_seen.add(newurl)
+		ids = self.feed_ids.pop(oldurl, None)
+		if ids is not None:
+			self.feed_ids[newurl] = ids
+
+class SQLiteArticleStore:
+	"""An ArticleStore that keeps articles in an SQLite database, only
+	loading the ones that are asked for."""
+
+	# Article attributes that have their own columns; the rest are
+	# pickled into the data column.
+	columns = ("hash", "feed", "sequence", "added", "date", "last_seen")
+
+	schema = """
+CREATE TABLE IF NOT EXISTS articles (
+	hash TEXT PRIMARY KEY,
+	feed TEXT NOT NULL,
+	id TEXT,
+	sequence INTEGER NOT NULL,
+	added REAL NOT NULL,
+	date REAL,
+	last_seen REAL NOT NULL,
+	data BLOB NOT NULL);
+CREATE INDEX IF NOT EXISTS articles_feed
+	ON articles (feed, added, sequence);
+CREATE INDEX IF NOT EXISTS articles_id
+	ON articles (feed, id);
+CREATE INDEX IF NOT EXISTS articles_last_seen
+	ON articles (feed, last_seen);
+CREATE INDEX IF NOT EXISTS articles_added
+	ON articles (added DESC, feed, sequence, hash);
+CREATE INDEX IF NOT EXISTS articles_date
+	ON articles (COALESCE(NULLIF(date, 0), added) DESC, feed, sequence, hash);
+"""
+
+	def __init__(self, db):
+		self.db = db
+		db.executescript(self.schema)
+		# Articles that have been loaded, so that each article is
+		# only represented by one object.
+		self.loaded = {}
+		# The number of each kind of change made, named as in
+		# ArticleStore.
+		self.change_counts = collections.Counter()
+
+	def _load(self, row):
+		hash = row[0]
+		article = self.loaded.get(hash)
+		if article is None:
+			# The entry_info was compacted before it was saved, so
+			# it can be used as it is.
+			data = pickle.loads(row[6])
+			article = Article.__new__(Article)
+			for (name, value) in zip(self.columns, row):
+				setattr(article, name, value)
+			article.feed = sys.intern(article.feed)
+			article.last_changed = data.get("last_changed")
+			article.set_body(data["entry_info"], data.get("html"))
+			self.loaded[hash] = article
+		return article
+
+	def _save(self, article, new):
+		data = {
+			"entry_info": article.entry_info,
+			"html": article.html,
+			"last_changed": article.last_changed,
+			}
+		values = (article.feed, article.id,
+		          article.sequence, article.added, article.date, article.last_seen,
+		          pickle.dumps(data, pickle.HIGHEST_PROTOCOL), article.hash)
+		if new:
+			self.db.execute("INSERT INTO articles"
+			                " (feed, id, sequence, added, date, last_seen, data, hash)"
+			                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)", values)
+		else:
+			# Update the row in place, so that the articles stay
+			# in the order they were added.
+			self.db.execute("UPDATE articles SET feed = ?, id = ?,"
+			                " sequence = ?, added = ?, date = ?, last_seen = ?, data = ?"
+			                " WHERE hash = ?", values)
+
+	def _select(self, where, args=()):
+		return self.db.execute("SELECT hash, feed, sequence, added, date, last_seen, data"
+		                       " FROM articles " + where, args)
+
+	def __len__(self):
+		return self.db.execute("SELECT COUNT(*) FROM articles").fetchone()[0]
+
+	def __contains__(self, hash):
+		if hash in self.loaded:
+			return True
+		return self.db.execute("SELECT 1 FROM articles WHERE hash = ?", (hash,)).fetchone() is not None
+
+	def __getitem__(self, hash):
+		article = self.get(hash)
+		if article is None:
+			raise KeyError(hash)
+		return article
+
+	def get(self, hash, default=None):
+		if hash in self.loaded:
+			return self.loaded[hash]
+		row = self._select("WHERE hash = ?", (hash,)).fetchone()
+		if row is None:
+			return default
+		return self._load(row)
+
+	def keys(self):
+		return [row[0] for row in self.db.execute("SELECT hash FROM articles")]
+
+	def values(self):
+		return [self._load(row) for row in self._select("")]
+
+	def items(self):
+		return [(a.hash, a) for a in self.values()]
+
+	def feeds(self):
+		return [row[0] for row in self.db.execute("SELECT DISTINCT feed FROM articles")]
+
+	def ids_for_feed(self, url):
+		# Where several articles have the same ID, the one added last
+		# wins, as with ArticleStore.
+		return dict(self.db.execute("SELECT id, hash FROM articles"
+		                            " WHERE feed = ? AND id IS NOT NULL ORDER BY rowid",
+		                            (url,)))
+
+	def hashes_for_feed(self, url):
+		return [row[0] for row in self.db.execute("SELECT hash FROM articles"
+		                                          " WHERE feed = ? ORDER BY rowid", (url,))]
+
+	def count_for_feed(self, url):
+		return self.db.execute("SELECT COUNT(*) FROM articles WHERE feed = ?", (url,)).fetchone()[0]
+
+	def expiry_candidates(self, url, now, config):
+		# The index finds the articles that might be old enough; the
+		# exact test is the same as ArticleStore's.
+		rows = self.db.execute("SELECT added, sequence, hash, last_seen FROM articles"
+		                       " WHERE feed = ? AND last_seen < ?"
+		                       " ORDER BY added, sequence, hash",
+		                       (url, now - config["expireage"] + 1))
+		return [(added, seq, hash) for (added, seq, hash, last_seen) in rows
+		        if can_expire(last_seen, now, config)]
+
+	def iter_sorted_keys(self, config):
 		if config["sortbyfeeddate"]:
-			return self.date or self.added
+			sort_date = "COALESCE(NULLIF(date, 0), added)"
 		else:
-			return self.added
+			sort_date = "added"
+		return self.db.execute("SELECT -" + sort_date + ", feed, sequence, hash FROM articles"
+		                       " ORDER BY " + sort_date + " DESC, feed, sequence, hash")
+
+	def count_changes(self):
+		return self.change_counts
+
+	def clear_changes(self):
+		self.change_counts = collections.Counter()
+
+	def add(self, article):
+		self.loaded[article.hash] = article
+		self._save(article, True)
+		self.change_counts["add"] += 1
+
+	def update(self, article, new_article, now):
+		old_body = article.body
+		article.update_from(new_article, now)
+		if article.body is old_body:
+			# Only the columns need changing.
+			self.db.execute("UPDATE articles SET sequence = ?, date = ?, last_seen = ?"
+			                " WHERE hash = ?",
+			                (article.sequence, article.date, article.last_seen, article.hash))
+			self.change_counts["seen"] += 1
+		else:
+			self._save(article, False)
+			self.change_counts["replace"] += 1
+
+	def remove(self, hash):
+		self.loaded.pop(hash, None)
+		self.db.execute("DELETE FROM articles WHERE hash = ?", (hash,))
+		self.change_counts["remove"] += 1
+
+	def remove_feed(self, url):
+		for hash in self.hashes_for_feed(url):
+			self.loaded.pop(hash, None)
+		self.db.execute("DELETE FROM articles WHERE feed = ?", (url,))
+		self.change_counts["remove_feed"] += 1
+
+	def rename_feed(self, oldurl, newurl):
+		for article in self.loaded.values():
+			if article.feed == oldurl:
+				article.feed = newurl
+		self.db.execute("UPDATE articles SET feed = ? WHERE feed = ?", (newurl, oldurl))
+		self.change_counts["rename_feed"] += 1
 
 class DayWriter:
 	"""Utility for writing day sections into a series of articles."""
@@ -854,6 +2022,29 @@ class Config:
 			"currentonly" : False,
 			"newfeedperiod" : "3h",
 			"numthreads": 4,
+			"splitstate" : False,
+			"statebackend" : "pickle",
+			"fetchengine" : "threads",
+			"maxconnections" : 100,
+			"hostconnections" : 2,
+			"hostinterval" : 0,
+			"parseprocesses" : 0,
+			"maxpending" : 200,
+			"rendercache" : 0,
+			"sanitiseonupdate" : False,
+			"keepfields" : [],
+			"journalratio" : 0.5,
+			"statecompression" : "none",
+			"statecompressionlevel" : 6,
+			"writedelay" : 30,
+			"maxwritedelay" : 5 * 60,
+			"updatespread" : 0.0,
+			"maxupdatefeeds" : 0,
+			"maxperiod" : 0,
+			"maxserverdelay" : 24 * 60 * 60,
+			"maxbackoff" : 24 * 60 * 60,
+			"quarantine" : 10,
+			"bodycache" : 0,
 			}
 
 	def __getitem__(self, key):
@@ -947,12 +2138,83 @@ class Config:
 			self["newfeedperiod"] = l[1]
 		elif l[0] == "numthreads":
 			self["numthreads"] = int(l[1])
+		elif l[0] == "splitstate":
+			self["splitstate"] = self.parse_bool(l[1])
+		elif l[0] == "fetchengine":
+			if l[1] not in ("threads", "async"):
+				raise ConfigError("Unknown fetch engine: " + l[1])
+			self["fetchengine"] = l[1]
+		elif l[0] == "maxconnections":
+			self["maxconnections"] = int(l[1])
+		elif l[0] == "hostconnections":
+			self["hostconnections"] = int(l[1])
+		elif l[0] == "hostinterval":
+			self["hostinterval"] = self.parse_time(l[1], "s")
+		elif l[0] == "parseprocesses":
+			if l[1] == "auto":
+				self["parseprocesses"] = os.cpu_count() or 1
+			else:
+				self["parseprocesses"] = int(l[1])
+		elif l[0] == "maxpending":
+			self["maxpending"] = int(l[1])
+		elif l[0] == "rendercache":
+			self["rendercache"] = int(l[1])
+		elif l[0] == "sanitiseonupdate":
+			self["sanitiseonupdate"] = self.parse_bool(l[1])
+		elif l[0] == "keepfields":
+			self["keepfields"] = self.parse_list(l[1])
+		elif l[0] == "journalratio":
+			self["journalratio"] = float(l[1])
+		elif l[0] == "statecompression":
+			if l[1] != "none" and l[1] not in COMPRESSION_LEVELS:
+				raise ConfigError("Unknown state compression format: " + l[1])
+			self["statecompression"] = l[1]
+			self.check_compression_level()
+		elif l[0] == "statecompressionlevel":
+			self["statecompressionlevel"] = int(l[1])
+			self.check_compression_level()
+		elif l[0] == "writedelay":
+			self["writedelay"] = self.parse_time(l[1], "s")
+		elif l[0] == "maxwritedelay":
+			self["maxwritedelay"] = self.parse_time(l[1], "s")
+		elif l[0] == "updatespread":
+			spread = float(l[1])
+			if spread < 0 or spread > 1:
+				raise ConfigError("updatespread must be between 0 and 1")
+			self["updatespread"] = spread
+		elif l[0] == "maxupdatefeeds":
+			self["maxupdatefeeds"] = int(l[1])
+		elif l[0] == "maxperiod":
+			self["maxperiod"] = self.parse_time(l[1])
+		elif l[0] == "maxserverdelay":
+			self["maxserverdelay"] = self.parse_time(l[1])
+		elif l[0] == "maxbackoff":
+			self["maxbackoff"] = self.parse_time(l[1])
+		elif l[0] == "quarantine":
+			self["quarantine"] = int(l[1])
+		elif l[0] == "bodycache":
+			self["bodycache"] = int(l[1])
+		elif l[0] == "statebackend":
+			if l[1] not in ("pickle", "sqlite"):
+				raise ConfigError("Unknown state backend: " + l[1])
+			self["statebackend"] = l[1]
 		else:
 			raise ConfigError("Unknown config command: " + l[0])
 
 		if arglines != [] and not handled_arglines:
 			raise ConfigError("Bad argument lines in config after: " + line)
 
+	def check_compression_level(self):
+		"""Check that statecompressionlevel can be used with the
+		chosen statecompression format."""
+		format = self["statecompression"]
+		if format not in COMPRESSION_LEVELS:
+			return
+		(low, high) = COMPRESSION_LEVELS[format]
+		level = self["statecompressionlevel"]
+		if level < low or level > high:
+			raise ConfigError("statecompressionlevel must be between %d and %d for %s" % (low, high, format))
+
 class ChangeFeedEditor:
 	def __init__(self, oldurl, newurl):
 		self.oldurl = oldurl
@@ -964,57 +2226,332 @@ class ChangeFeedEditor:
 				line = line.replace(self.oldurl, self.newurl, 1)
 			outputfile.write(line)
 
+def make_parse_pool(config):
+	"""Return a ProcessPoolExecutor to parse feeds in, or None if they
+	should be parsed in the threads that fetch them."""
+	if config["parseprocesses"] == 0:
+		return None
+	# Start the processes afresh rather than forking, since we'll
+	# have fetcher threads running.
+	context = multiprocessing.get_context("spawn")
+	return concurrent.futures.ProcessPoolExecutor(config["parseprocesses"], context)
+
+def get_host(url):
+	"""Return the host name in a URL, or "" if it doesn't have one (for
+	example, a local file)."""
+	return six.moves.urllib.parse.urlsplit(url).hostname or ""
+
+def is_fetch_error(result):
+	"""Return True if the result of fetching or downloading a feed
+	shows that it failed."""
+	if "rawdog_timeout" in result or "rawdog_exception" in result:
+		return True
+	responses = result.get("rawdog_responses")
+	return bool(responses) and responses[-1]["status"] >= 400
+
+class HostStats:
+	"""Counts of the feeds fetched from each host, for reporting at the
+	end of an update."""
+
+	def __init__(self):
+		self.feeds = collections.Counter()
+		self.errors = collections.Counter()
+		self.seconds = collections.Counter()
+
+	def add(self, url, result):
+		host = get_host(url)
+		self.feeds[host] += 1
+		if is_fetch_error(result):
+			self.errors[host] += 1
+
+	def add_time(self, host, seconds):
+		self.seconds[host] += seconds
+
+	def report(self):
+		hosts = [host for host in self.feeds if host != ""]
+		if hosts == []:
+			return
+		print("Fetched from", len(hosts), "hosts:")
+		hosts.sort(key=lambda host: (-self.feeds[host], host))
+		for host in hosts:
+			print("  %s: %d feeds, %d errors, %.1fs" % (host, self.feeds[host],
+			      self.errors[host], self.seconds[host]))
+
 class FeedFetcher:
-	"""Class that will handle fetching a set of feeds in parallel."""
+	"""Class that will handle fetching a set of feeds in parallel.
+	Feeds are grouped by host, and taken from each host in turn; no
+	more than hostconnections feeds are fetched from a host at once,
+	and requests to a host are started at least hostinterval apart."""
 
-	def __init__(self, rawdog, feedlist, config):
+	def __init__(self, rawdog, feedlist, config, body_cache=None):
 		self.rawdog = rawdog
 		self.config = config
-		self.lock = threading.Lock()
-		self.jobs = set(feedlist)
-		self.results = {}
+		self.body_cache = body_cache
+		self.lock = threading.Condition()
+		# Host -> deque of URLs waiting to be fetched.
+		self.jobs = {}
+		for url in feedlist:
+			self.jobs.setdefault(get_host(url), collections.deque()).append(url)
+		# Hosts with feeds waiting, in the order they'll be tried.
+		self.hosts = collections.deque(self.jobs.keys())
+		self.num_jobs = len(feedlist)
+		self.jobs_left = self.num_jobs
+		# Host -> number of feeds being fetched from it.
+		self.active = collections.Counter()
+		# Host -> the earliest time the next request can start.
+		self.next_start = {}
+		self.stats = HostStats()
+		self.connections = rawdoglib.httppool.ConnectionPool()
+		self.results = queue.Queue()
+		self.pool = None
+		self.slots = threading.Semaphore(max(config["maxpending"], 1))
+
+	def next_job(self):
+		"""Wait until a feed can be fetched, and return its URL, or
+		None if there are none left. Must be called with the lock
+		held."""
+		limit = max(self.config["hostconnections"], 1)
+		interval = self.config["hostinterval"]
+		while self.jobs_left > 0:
+			now = time.monotonic()
+			wake = None
+			for i in range(len(self.hosts)):
+				host = self.hosts.popleft()
+				start = self.next_start.get(host, now)
+				if host != "" and self.active[host] >= limit:
+					self.hosts.append(host)
+				elif start > now:
+					self.hosts.append(host)
+					wake = start if wake is None else min(wake, start)
+				else:
+					job = self.jobs[host].popleft()
+					if self.jobs[host]:
+						self.hosts.append(host)
+					self.jobs_left -= 1
+					self.active[host] += 1
+					if host != "":
+						self.next_start[host] = now + interval
+					return job
+			# Wait for a fetch to finish, or for a host's interval
+			# to pass.
+			self.lock.wait(None if wake is None else wake - now)
+		return None
 
 	def worker(self, num):
 		rawdog = self.rawdog
 		config = self.config
 
 		while True:
+			# Wait until there's room for another result.
+			self.slots.acquire()
+
 			with self.lock:
-				try:
-					job = self.jobs.pop()
-				except KeyError:
-					# No jobs left.
-					break
+				job = self.next_job()
+			if job is None:
+				# No jobs left.
+				self.slots.release()
+				break
 
 			print(num, "- Fetching feed:", job)
 			feed = rawdog.feeds[job]
-			result = feed.fetch(rawdog, config)
-
+			start = time.monotonic()
+			try:
+				download = feed.download(rawdog, config, self.connections)
+			except Exception as e:
+				download = get_error_result(e)
+			host = get_host(job)
 			with self.lock:
-				self.results[job] = result
+				self.active[host] -= 1
+				self.stats.add(job, download)
+				self.stats.add_time(host, time.monotonic() - start)
+				self.lock.notify_all()
+			# Every job must produce exactly one result, or
+			# iter_results will wait for it forever.
+			try:
+				self.parse(job, feed.check_download(download, config, self.body_cache))
+			except Exception as e:
+				self.results.put((job, get_error_result(e, download)))
+
+	def parse(self, job, download):
+		"""Parse a download, in the process pool if there is one,
+		queueing the result when it's ready."""
+		if self.pool is None or not needs_parsing(download):
+			self.results.put((job, parse_download(download)))
+			return
+		future = self.pool.submit(parse_download, download)
+		future.add_done_callback(lambda f: self.results.put((job, get_parse_result(f, download))))
 
-	def run(self, max_workers):
+	def iter_results(self, max_workers):
+		"""Fetch the feeds, yielding (url, result) for each one as soon
+		as it's ready."""
 		max_workers = max(max_workers, 1)
-		num_workers = min(max_workers, len(self.jobs))
+		num_workers = min(max_workers, self.num_jobs)
 
-		print("Fetching", len(self.jobs), "feeds using", num_workers, "threads.")
+		self.pool = make_parse_pool(self.config)
+		if self.pool is None:
+			print("Fetching", self.num_jobs, "feeds using", num_workers, "threads.")
+		else:
+			print("Fetching", self.num_jobs, "feeds using", num_workers, "threads and",
+			      self.config["parseprocesses"], "parser processes.")
 		workers = []
-		for i in range(1, num_workers):
-			t = threading.Thread(target=self.worker, args=(i,))
+		for i in range(num_workers):
+			t = threading.Thread(target=self.worker, args=(i,), daemon=True)
 			t.start()
 			workers.append(t)
-		self.worker(0)
+		for i in range(self.num_jobs):
+			result = self.results.get()
+			yield result
+			# The caller has finished with the result, so let
+			# another feed be fetched.
+			result = None
+			self.slots.release()
 		for worker in workers:
 			worker.join()
+		self.connections.close()
+		if self.pool is not None:
+			self.pool.shutdown()
+		print("Fetch complete.")
+		self.stats.report()
+
+	def run(self, max_workers):
+		"""Fetch the feeds, returning a dict of results by URL."""
+		return dict(self.iter_results(max_workers))
+
+class AsyncFeedFetcher:
+	"""Class that will handle fetching a set of feeds concurrently using
+	asyncio, which scales to many more simultaneous requests than
+	FeedFetcher's threads."""
+
+	def __init__(self, rawdog, feedlist, config, body_cache=None):
+		self.rawdog = rawdog
+		self.config = config
+		self.body_cache = body_cache
+		self.jobs = list(feedlist)
+		self.results = queue.Queue()
+		self.pool = None
+		self.loop = None
+		self.slots = None
+		self.stats = HostStats()
+
+	async def fetch(self, client, job):
+		# Wait until there's room for another result.
+		await self.slots.acquire()
+
+		print("Fetching feed:", job)
+		feed = self.rawdog.feeds[job]
+		download = None
+		# Every job must produce exactly one result, or iter_results
+		# will wait for it forever (and its slot is only released
+		# once the result's been handled).
+		try:
+			download = await feed.download_async(self.rawdog, self.config, client)
+			self.stats.add(job, download)
+			download = feed.check_download(download, self.config, self.body_cache)
+			if needs_parsing(download):
+				# Parsing is CPU-bound, so keep it out of the
+				# event loop.
+				loop = asyncio.get_running_loop()
+				future = loop.run_in_executor(self.pool, parse_download, download)
+				await asyncio.wait([future])
+				result = get_parse_result(future, download)
+			else:
+				result = parse_download(download)
+		except Exception as e:
+			result = get_error_result(e, download)
+			if download is None:
+				self.stats.add(job, result)
+		self.results.put((job, result))
+
+	async def fetch_all(self, max_connections):
+		self.loop = asyncio.get_running_loop()
+		self.slots = asyncio.Semaphore(max(self.config["maxpending"], 1))
+		client = rawdoglib.asynchttp.Client(max_connections, self.config["hostconnections"],
+		                                    self.config["hostinterval"], self.config["timeout"])
+		# Start the feeds from each host in turn, so that one host
+		# with lots of feeds doesn't hold up the others.
+		by_host = {}
+		for job in self.jobs:
+			by_host.setdefault(get_host(job), []).append(job)
+		jobs = [job for jobs in itertools.zip_longest(*by_host.values())
+		        for job in jobs if job is not None]
+		await asyncio.gather(*[self.fetch(client, job) for job in jobs])
+		client.close()
+		for (host, seconds) in client.host_times.items():
+			self.stats.add_time(host, seconds)
+
+	def iter_results(self, max_connections):
+		"""Fetch the feeds, yielding (url, result) for each one as soon
+		as it's ready."""
+		self.pool = make_parse_pool(self.config)
+		print("Fetching", len(self.jobs), "feeds using up to", max_connections, "connections.")
+		# The event loop runs in its own thread, so that the caller
+		# can deal with each result as it arrives.
+		t = threading.Thread(target=asyncio.run, args=(self.fetch_all(max_connections),), daemon=True)
+		t.start()
+		# Once every feed has had a slot, the event loop may finish
+		# while we're still handing out results.
+		num_waiting = len(self.jobs) - max(self.config["maxpending"], 1)
+		for i in range(len(self.jobs)):
+			result = self.results.get()
+			yield result
+			# The caller has finished with the result, so let
+			# another feed be fetched.
+			result = None
+			if i < num_waiting:
+				self.loop.call_soon_threadsafe(self.slots.release)
+		t.join()
+		if self.pool is not None:
+			self.pool.shutdown()
 		print("Fetch complete.")
-		return self.results
+		self.stats.report()
+
+	def run(self, max_connections):
+		"""Fetch the feeds, returning a dict of results by URL."""
+		return dict(self.iter_results(max_connections))
 
 class FeedState(Persistable):
 	"""The collection of articles in a feed."""
 
 	def __init__(self):
 		Persistable.__init__(self)
-		self.articles = {}
+		self.articles = ArticleStore()
+
+	def modified(self, state=True):
+		Persistable.modified(self, state)
+		if not state:
+			self.articles.clear_changes()
+
+	def get_changes(self):
+		return self.articles.changes
+
+	def apply_changes(self, changes):
+		self.articles.replay(changes)
+
+class RenderCache(Persistable):
+	"""Sanitised HTML for recently-written articles, so it doesn't need
+	to be generated again each time the output file is written. The
+	least recently used entries are discarded once it gets too big."""
+
+	def __init__(self):
+		Persistable.__init__(self)
+		self.entries = collections.OrderedDict()
+
+	def get_key(self, article, fingerprint):
+		return (article.hash, article.last_changed, fingerprint)
+
+	def get(self, key):
+		bits = self.entries.get(key)
+		if bits is not None:
+			# The order has changed, so it needs saving too.
+			self.entries.move_to_end(key)
+			self.modified()
+		return bits
+
+	def add(self, key, bits, size):
+		self.entries[key] = bits
+		while len(self.entries) > size:
+			self.entries.popitem(last=False)
+		self.modified()
 
 class Rawdog(Persistable):
 	"""The aggregator itself."""
@@ -1022,9 +2559,133 @@ class Rawdog(Persistable):
 	def __init__(self):
 		Persistable.__init__(self)
 		self.feeds = {}
-		self.articles = {}
+		self.articles = ArticleStore()
 		self.plugin_storage = {}
 		self.state_version = STATE_VERSION
+		# The number of articles in the state file's articles section,
+		# if it's known and they haven't been loaded.
+		self._article_count = None
+		self._init_changes()
+		self._rewrite = True
+
+	def _init_changes(self):
+		# URLs of feeds that have been added, changed or removed ->
+		# the names of the attributes that changed.
+		self._changed_feeds = {}
+		# Changes made to articles in per-feed state files.
+		self._feedstate_changes = collections.Counter()
+		# Article changes read from the journal, to be made once the
+		# articles have been loaded.
+		self._pending_changes = []
+		# If True, the whole state must be saved rather than just
+		# the changes.
+		self._rewrite = False
+
+	def modified(self, state=True):
+		Persistable.modified(self, state)
+		if not state:
+			# The changes have been saved.
+			self._changed_feeds = {}
+			self._feedstate_changes = collections.Counter()
+			self._rewrite = False
+			if isinstance(self._articles, (ArticleStore, SQLiteArticleStore)):
+				self._articles.clear_changes()
+
+	def __getstate__(self):
+		# The articles are kept in their own section of the state
+		# file, so they don't need to be loaded when they're not used
+		# (for example, by "rawdog -l").
+		if self._pending_changes:
+			# Make the changes from the journal before saving.
+			self.articles
+		state = dict(self.__dict__)
+		for name in ("_changed_feeds", "_feedstate_changes",
+		             "_pending_changes", "_rewrite", "_article_count"):
+			del state[name]
+		articles = state.pop("_articles")
+		if isinstance(articles, SectionRef):
+			state["article_count"] = self._article_count
+		else:
+			state["article_count"] = len(articles)
+			articles = Section(articles)
+		state["articles"] = articles
+		return state
+
+	def __setstate__(self, state):
+		state["_articles"] = state.pop("articles")
+		# State files from older versions don't have a count.
+		article_count = state.pop("article_count", None)
+		self.__dict__.update(state)
+		self._article_count = article_count
+		self._init_changes()
+
+	def get_changes(self):
+		if self._rewrite:
+			return None
+		changes = [("feed", url, self.feeds.get(url))
+		           for url in self._changed_feeds]
+		if isinstance(self._articles, ArticleStore) and self._articles.changes:
+			changes.append(("articles", self._articles.changes))
+		return changes
+
+	def apply_changes(self, changes):
+		for change in changes:
+			if change[0] == "feed":
+				(kind, url, feed) = change
+				if feed is None:
+					self.feeds.pop(url, None)
+				else:
+					self.feeds[url] = feed
+			elif isinstance(self._articles, SectionRef):
+				self._pending_changes.append(change[1])
+			else:
+				self._articles.replay(change[1])
+
+	def feed_changed(self, url, fields):
+		"""Record that a feed has been added, changed or removed;
+		fields names what changed."""
+		self._changed_feeds.setdefault(url, set()).update(fields)
+		self.modified()
+
+	def report_changes(self):
+		"""Describe the changes that will be saved."""
+		fields = collections.Counter()
+		for names in self._changed_feeds.values():
+			fields.update(names)
+		articles = collections.Counter(self._feedstate_changes)
+		if not isinstance(self._articles, SectionRef):
+			articles.update(self.articles.count_changes())
+		if not fields and not articles:
+			print("No changes to save.")
+		if fields:
+			print("Changed", len(self._changed_feeds), "feeds:",
+			      ", ".join("%s %d" % item for item in sorted(fields.items())))
+		if articles:
+			print("Changed articles:",
+			      ", ".join("%s %d" % item for item in sorted(articles.items())))
+
+	@property
+	def articles(self):
+		if isinstance(self._articles, SectionRef):
+			self._articles = self._articles.load()
+			self._article_count = None
+			for changes in self._pending_changes:
+				self._articles.replay(changes)
+			self._pending_changes = []
+		return self._articles
+
+	def has_articles(self):
+		"""Return True if there are any articles, without loading them
+		if the state file says how many there are."""
+		if (isinstance(self._articles, SectionRef)
+		    and self._article_count is not None
+		    and not self._pending_changes):
+			return self._article_count > 0
+		return len(self.articles) > 0
+
+	@articles.setter
+	def articles(self, articles):
+		self._articles = articles
 
 	def check_state_version(self):
 		"""Check the version of the state file."""
@@ -1034,6 +2695,78 @@ class Rawdog(Persistable):
 			version = 1
 		return version == STATE_VERSION
 
+	def load_db(self, db):
+		"""Load the state from an SQLite database."""
+		db.executescript("""
+CREATE TABLE IF NOT EXISTS meta (
+	key TEXT PRIMARY KEY,
+	value BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS feeds (
+	url TEXT PRIMARY KEY,
+	etag TEXT,
+	modified TEXT,
+	last_update REAL NOT NULL,
+	data BLOB NOT NULL);
+""")
+		row = db.execute("SELECT value FROM meta WHERE key = 'rawdog'").fetchone()
+		if row is not None:
+			self.__dict__.update(pickle.loads(row[0]))
+		for (url, etag, modified, last_update, data) in db.execute("SELECT url, etag, modified, last_update, data FROM feeds"):
+			state = pickle.loads(data)
+			state.update({"url": url, "etag": etag, "modified": modified, "last_update": last_update})
+			feed = Feed.__new__(Feed)
+			feed.__setstate__(state)
+			self.feeds[url] = feed
+		self.articles = SQLiteArticleStore(db)
+		self._rewrite = False
+
+	def save_db(self, db):
+		"""Save the state to an SQLite database. Articles have already
+		been saved by SQLiteArticleStore."""
+		state = dict(self.__dict__)
+		for name in ("feeds", "_articles", "_modified", "_changed_feeds",
+		             "_feedstate_changes", "_pending_changes", "_rewrite",
+		             "_article_count"):
+			del state[name]
+		db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('rawdog', ?)",
+		           (pickle.dumps(state, pickle.HIGHEST_PROTOCOL),))
+
+		if self._rewrite:
+			db.execute("DELETE FROM feeds")
+			feeds = self.feeds.values()
+		else:
+			# Only save the feeds that have changed.
+			feeds = []
+			for url in self._changed_feeds:
+				feed = self.feeds.get(url)
+				if feed is None:
+					db.execute("DELETE FROM feeds WHERE url = ?", (url,))
+				else:
+					feeds.append(feed)
+		for feed in feeds:
+			state = dict(feed.__dict__)
+			for name in ("url", "etag", "modified", "last_update"):
+				del state[name]
+			values = (feed.etag, feed.modified, feed.last_update,
+			          pickle.dumps(state, pickle.HIGHEST_PROTOCOL), feed.url)
+			# Update existing rows in place, so that the feeds
+			# stay in the order they were added.
+			cursor = db.execute("UPDATE feeds SET etag = ?, modified = ?, last_update = ?, data = ? WHERE url = ?", values)
+			if cursor.rowcount == 0:
+				db.execute("INSERT INTO feeds (etag, modified, last_update, data, url) VALUES (?, ?, ?, ?, ?)", values)
+
+	def upgrade_state(self):
+		"""Convert parts of the state that were saved by an older
+		version of rawdog into their current form."""
+		if isinstance(self._articles, dict):
+			print("Indexing articles by feed.")
+			articles = ArticleStore()
+			for article in self.articles.values():
+				articles.add(article)
+			self.articles = articles
+			self._rewrite = True
+			self.modified()
+
 	def edit_file(self, filename, editfunc):
 		"""Edit a file in place: for each line in the input file, call
 		editfunc(line, outputfile), then rename the output file over the input
@@ -1064,10 +2797,17 @@ class Rawdog(Persistable):
 		feed.url = newurl
 		del self.feeds[oldurl]
 		self.feeds[newurl] = feed
-
-		for article in list(self.articles.values()):
-			if article.feed == oldurl:
-				article.feed = newurl
+		self.feed_changed(oldurl, ["removed"])
+		self.feed_changed(newurl, ["added"])
+
+		if config["splitstate"]:
+			feedstate_p = persister.get(FeedState, old_state)
+			feedstate_p.rename(feed.get_state_filename())
+			with feedstate_p as feedstate:
+				feedstate.articles.rename_feed(oldurl, newurl)
+				feedstate.modified()
+		else:
+			self.articles.rename_feed(oldurl, newurl)
 
 		error_fn("The config file has been updated automatically.")
 
@@ -1080,6 +2820,16 @@ class Rawdog(Persistable):
 			print("  Hash:", short_hash(url))
 			print("  Title:", feed.get_html_name(config))
 			print("  Link:", feed_info.get("link"))
+			print("  Period:", format_period(feed.period))
+			if config["maxperiod"] > feed.period:
+				print("  Effective period:", format_period(feed.get_period(config)))
+			if feed.failures > 0:
+				print("  Failed", feed.failures, "times since", format_time(feed.failing_since, config))
+			if feed.is_quarantined(config):
+				print("  Quarantined")
+			if feed.last_update != 0:
+				print("  Last updated:", format_time(feed.last_update, config))
+				print("  Next update:", format_time(feed.get_next_update(config), config))
 
 	def sync_from_config(self, config):
 		"""Update rawdog's internal state to match the
@@ -1091,40 +2841,86 @@ class Rawdog(Persistable):
 			if url not in self.feeds:
 				print("Adding new feed: ", url)
 				self.feeds[url] = Feed(url)
-				self.modified()
+				self.feed_changed(url, ["added"])
 			feed = self.feeds[url]
 			if feed.period != period:
 				print("Changed feed period: ", url)
 				feed.period = period
-				self.modified()
+				self.feed_changed(url, ["period"])
 			newargs = {}
 			newargs.update(config["feeddefaults"])
 			newargs.update(args)
 			if feed.args != newargs:
 				print("Changed feed options: ", url)
 				feed.args = newargs
-				self.modified()
+				self.feed_changed(url, ["args"])
 		for url in list(self.feeds.keys()):
 			if url not in seen_feeds:
 				print("Removing feed: ", url)
 
-				for key, article in list(self.articles.items()):
-					if article.feed == url:
-						del self.articles[key]
+				if config["splitstate"]:
+					persister.delete(self.feeds[url].get_state_filename())
+				else:
+					self.articles.remove_feed(url)
 
 				del self.feeds[url]
-				self.modified()
+				self.feed_changed(url, ["removed"])
+
+		if config["splitstate"] and self.has_articles():
+			self.split_articles()
+		elif not config["splitstate"]:
+			self.unsplit_articles()
+
+	def split_articles(self):
+		"""Move articles from the main state file into per-feed state
+		files."""
+		print("Moving articles into per-feed state files.")
+		for url in list(self.articles.feeds()):
+			feed = self.feeds.get(url)
+			if feed is None:
+				# Left over from a removed feed.
+				continue
+			with persister.get(FeedState, feed.get_state_filename()) as feedstate:
+				for hash in self.articles.hashes_for_feed(url):
+					feedstate.articles.add(self.articles[hash])
+				feedstate.modified()
+				feed.index_articles(feedstate.articles)
+		self.articles = ArticleStore()
+		self._rewrite = True
+		self.modified()
+
+	def unsplit_articles(self):
+		"""Move articles from per-feed state files back into the main
+		state file."""
+		for feed in list(self.feeds.values()):
+			if feed.article_keys is None:
+				continue
+			print("Moving articles from per-feed state file: ", feed.url)
+			filename = feed.get_state_filename()
+			with persister.get(FeedState, filename) as feedstate:
+				for article in feedstate.articles.values():
+					# The state file is about to be deleted.
+					article.load_body()
+					self.articles.add(article)
+			persister.delete(filename)
+			feed.article_keys = None
+			self.feed_changed(feed.url, ["article_keys"])
 
 	def update(self, config, feedurl=None):
 		"""Check feeds for new articles and expire old ones."""
 		print("Updating...")
 		now = time.time()
 
-		socket.setdefaulttimeout(config["timeout"])
-
 		if feedurl is None:
 			update_feeds = [url for url in list(self.feeds.keys())
-			                    if self.feeds[url].needs_update(now)]
+			                    if self.feeds[url].needs_update(now, config)]
+			limit = config["maxupdatefeeds"]
+			if limit > 0 and len(update_feeds) > limit:
+				# Update the feeds that have been waiting
+				# longest, and leave the rest for next time.
+				print(len(update_feeds) - limit, "feeds will be updated next time.")
+				update_feeds = heapq.nsmallest(limit, update_feeds,
+					key=lambda url: self.feeds[url].get_next_update(config))
 		elif feedurl in self.feeds:
 			update_feeds = [feedurl]
 			self.feeds[feedurl].etag = None
@@ -1133,63 +2929,122 @@ class Rawdog(Persistable):
 			print("No such feed: ", feedurl)
 			update_feeds = []
 
-		numfeeds = len(update_feeds)
-		print("Will update", numfeeds, "feeds.")
+		self.update_feeds(config, update_feeds, now)
 
-		fetcher = FeedFetcher(self, update_feeds, config)
-		fetched = fetcher.run(config["numthreads"])
+	def expire_articles(self, articles, config, now, updated_feeds):
+		"""Expire articles from a collection: those from feeds that no
+		longer exist, and those from the feeds in updated_feeds that
+		haven't been seen recently (keeping at least keepmin for each
+		feed). Return the number of articles expired."""
 
-		seen_some_items = set()
-		def do_expiry(articles):
-			"""Expire articles from a list. Return True if any
-			articles were expired."""
-
-			feedcounts = {}
-			for key, article in list(articles.items()):
-				url = article.feed
-				feedcounts[url] = feedcounts.get(url, 0) + 1
-
-			expiry_list = []
-			feedcounts = {}
-			for key, article in list(articles.items()):
-				url = article.feed
-				feedcounts[url] = feedcounts.get(url, 0) + 1
-				expiry_list.append((article.added, article.sequence, key, article))
-			expiry_list.sort()
-
-			count = 0
-			for date, seq, key, article in expiry_list:
-				url = article.feed
-				if url not in self.feeds:
-					print("Expired article for nonexistent feed: ", url)
-					count += 1
-					del articles[key]
-					continue
-				if (url in seen_some_items
-				    and url in self.feeds
-				    and article.can_expire(now, config)
-				    and feedcounts[url] > self.feeds[url].get_keepmin(config)):
+		count = 0
+		gone_list = []
+		for url in list(articles.feeds()):
+			if url not in self.feeds:
+				for key in articles.hashes_for_feed(url):
+					article = articles[key]
+					gone_list.append((article.added, article.sequence, key, url))
+			elif url in updated_feeds:
+				# Only articles from feeds that have just been
+				# updated can be expired, and only those that
+				# haven't been seen recently need to be looked
+				# at.
+				feedcount = articles.count_for_feed(url)
+				keepmin = self.feeds[url].get_keepmin(config)
+				for (added, seq, key) in articles.expiry_candidates(url, now, config):
+					if feedcount <= keepmin:
+						break
 					count += 1
-					feedcounts[url] -= 1
-					del articles[key]
+					feedcount -= 1
+					articles.remove(key)
 
-			print("Expired", count, "articles, leaving", len(articles))
-			return count > 0
+		gone_list.sort()
+		for (added, seq, key, url) in gone_list:
+			print("Expired article for nonexistent feed: ", url)
+			count += 1
+			articles.remove(key)
+		return count
+
+	def update_feeds(self, config, update_feeds, now):
+		"""Fetch the feeds with the given URLs, add their articles, and
+		expire old ones."""
+		socket.setdefaulttimeout(config["timeout"])
 
+		numfeeds = len(update_feeds)
+		print("Will update", numfeeds, "feeds.")
+
+		# Feeds are updated as their results arrive, while the others
+		# are still being fetched; only this thread changes the state.
+		# At most maxpending results are held in memory at once.
+		if config["bodycache"] > 0:
+			body_cache = BodyCache(config["bodycache"] * 1024 * 1024)
+		else:
+			body_cache = None
+		if config["fetchengine"] == "async":
+			fetcher = AsyncFeedFetcher(self, update_feeds, config, body_cache)
+			results = fetcher.iter_results(config["maxconnections"])
+		else:
+			fetcher = FeedFetcher(self, update_feeds, config, body_cache)
+			results = fetcher.iter_results(config["numthreads"])
+
+		seen_some_items = set()
+		body_matches = 0
+		expired = 0
 		count = 0
-		for url in update_feeds:
+		for (url, content) in results:
 			count += 1
 			print("Updating feed ", count, " of ", numfeeds, ": ", url)
 			feed = self.feeds[url]
-			articles = self.articles
-			content = fetched[url]
+			old_state = dict(feed.__dict__)
+			# If the feed's body hasn't changed, its articles won't
+			# be looked at.
+			unchanged = "rawdog_body_match" in content
+			if unchanged:
+				body_matches += 1
+				articles = None
+			elif config["splitstate"]:
+				feedstate_p = persister.get(FeedState, feed.get_state_filename())
+				feedstate = feedstate_p.open()
+				articles = feedstate.articles
+			else:
+				articles = self.articles
 			rc = feed.update(self, now, config, articles, content)
+			# Let the feedparser result be freed before the next
+			# one arrives.
+			content = None
 			url = feed.url
 			if rc:
 				seen_some_items.add(url)
 
-		do_expiry(self.articles)
-		self.modified()
+			if config["splitstate"] and not unchanged:
+				expired += self.expire_articles(articles, config, now, seen_some_items)
+				changes = articles.count_changes()
+				if changes:
+					feedstate.modified()
+					feed.index_articles(articles)
+				self._feedstate_changes.update(changes)
+				feedstate_p.close()
+
+			fields = feed.get_changed_fields(old_state)
+			if fields:
+				self.feed_changed(url, fields)
+
+		if config["splitstate"]:
+			remaining = sum(len(feed.article_keys or []) for feed in self.feeds.values())
+		else:
+			expired += self.expire_articles(self.articles, config, now, seen_some_items)
+			remaining = len(self.articles)
+			if self.articles.count_changes():
+				self.modified()
+		print("Expired", expired, "articles, leaving", remaining)
+		if body_cache is not None:
+			body_cache.trim()
+		if body_matches:
+			print(body_matches, "feeds unchanged (body match).")
+		self.report_changes()
+		quarantined = [feed for feed in self.feeds.values() if feed.is_quarantined(config)]
+		if quarantined:
+			print(len(quarantined), "feeds are quarantined; \"rawdog --list\" shows which.")
 
 	def get_page_template(self, config):
 		template = """<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01//EN"
@@ -1257,70 +3112,55 @@ __feeditems__
 </tr>
 """
 
-	def write_article(self, f, article, config):
+	def get_article_html(self, article, feed, config, render_cache):
+		"""As article_to_html, using the HTML stored by
+		sanitiseonupdate or the render cache if possible."""
+		fingerprint = get_render_fingerprint(feed)
+		if article.html_key == fingerprint:
+			return article.html[1]
+		if render_cache is None:
+			return article_to_html(article, feed, config)
+
+		key = render_cache.get_key(article, fingerprint)
+		bits = render_cache.get(key)
+		if bits is None:
+			bits = article_to_html(article, feed, config)
+			render_cache.add(key, bits, config["rendercache"])
+		return bits
+
+	def write_article(self, f, article, config, render_cache=None):
 		"""Write an article to the given file."""
 		feed = self.feeds[article.feed]
-		entry_info = article.entry_info
-
-		link = entry_info.get("link")
-		if link == "":
-			link = None
-
-		guid = entry_info.get("id")
-		if guid == "":
-			guid = None
 
 		itembits = self.get_feed_bits(config, feed)
 		for name, value in list(feed.args.items()):
 			if name.startswith("define_"):
 				itembits[name[7:]] = sanitise_html(value, "", True, config)
 
-		title = detail_to_html(entry_info.get("title_detail"), True, config)
-
-		key = None
-		for k in ["content", "summary_detail"]:
-			if k in entry_info:
-				key = k
-				break
-		if key is None:
-			description = None
-		else:
-			force_preformatted = (feed.args.get("format", "default") == "text")
-			description = detail_to_html(entry_info[key], False, config, force_preformatted)
+		bits = self.get_article_html(article, feed, config, render_cache)
+		title = bits["title"]
+		url = bits["url"]
 
 		date = article.date
 		if title is None:
-			if link is None:
+			if url is None:
 				title = "Article"
 			else:
 				title = "Link"
 
 		itembits["title_no_link"] = title
-		if link is not None:
-			itembits["url"] = string_to_html(link, config)
-		else:
-			itembits["url"] = ""
-		if guid is not None:
-			itembits["guid"] = string_to_html(guid, config)
-		else:
-			itembits["guid"] = ""
-		if link is None:
+		if url is None:
 			itembits["title"] = title
 		else:
-			itembits["title"] = '<a href="' + string_to_html(link, config) + '">' + title + '</a>'
+			itembits["title"] = '<a href="' + url + '">' + title + '</a>'
 
 		itembits["hash"] = short_hash(article.hash)
 
-		if description is not None:
-			itembits["description"] = description
-		else:
-			itembits["description"] = ""
-
-		author = author_to_html(entry_info, feed.url, config)
-		if author is not None:
-			itembits["author"] = author
-		else:
-			itembits["author"] = ""
+		for name in ("url", "guid", "description", "author"):
+			if bits[name] is not None:
+				itembits[name] = bits[name]
+			else:
+				itembits[name] = ""
 
 		itembits["added"] = format_time(article.added, config)
 		if date is not None:
@@ -1331,9 +3171,11 @@ __feeditems__
 		itemtemplate = self.get_item_template()
 		f.write(fill_template(itemtemplate, itembits))
 
-	def write_remove_dups(self, articles, config, now):
+	def write_remove_dups(self, articles, config, now, limit=0):
 		"""Filter the list of articles to remove articles that are too
-		old or are duplicates."""
+		old or are duplicates, stopping once limit articles have been
+		kept (if limit isn't 0). articles may be an iterator, in which
+		case no more of it is used than necessary."""
 		kept_articles = []
 		seen_links = set()
 		seen_guids = set()
@@ -1346,13 +3188,11 @@ __feeditems__
 			if maxage != 0 and age > maxage:
 				continue
 
-			entry_info = article.entry_info
-
-			link = entry_info.get("link")
+			link = article.link
 			if link == "":
 				link = None
 
-			guid = entry_info.get("id")
+			guid = article.id
 			if guid == "":
 				guid = None
 
@@ -1367,6 +3207,8 @@ __feeditems__
 					continue
 
 			kept_articles.append(article)
+			if limit != 0 and len(kept_articles) >= limit:
+				break
 		return (kept_articles, dup_count)
 
 	def get_feed_bits(self, config, feed):
@@ -1421,14 +3263,14 @@ __feeditems__
 
 		return bits
 
-	def write_output_file(self, articles, article_dates, config):
+	def write_output_file(self, articles, article_dates, config, render_cache=None):
 		"""Write a regular rawdog HTML output file."""
 		f = StringIO()
 		dw = DayWriter(f, config)
 
 		for article in articles:
 			dw.time(article_dates[article])
-			self.write_article(f, article, config)
+			self.write_article(f, article, config, render_cache)
 
 		dw.close()
 
@@ -1452,27 +3294,203 @@ __feeditems__
 		print("Writing...")
 		now = time.time()
 
-		def list_articles(articles):
-			return [(-a.get_sort_date(config), a.feed, a.sequence, a.hash) for a in list(articles.values())]
-		article_list = list_articles(self.articles)
-		numarticles = len(article_list)
-		article_list.sort()
-
-		if config["maxarticles"] != 0:
-			article_list = article_list[:config["maxarticles"]]
+		# Articles are read in order until there are enough to write,
+		# so ones that write_remove_dups discards are replaced by the
+		# next ones along.
+		if config["splitstate"]:
+			keys = []
+			for url, feed in self.feeds.items():
+				for (hash, seq, added, date) in feed.article_keys or []:
+					keys.append((-get_sort_date(added, date, config), url, seq, hash))
+			numarticles = len(keys)
+			sorted_keys = iter_sorted(keys)
+		else:
+			numarticles = len(self.articles)
+			sorted_keys = self.articles.iter_sorted_keys(config)
 
-		found = self.articles
-		articles = []
+		# With splitstate, only load the state files for feeds that
+		# have articles to be written.
+		feedstates = {}
 		article_dates = {}
-		for (date, feed, seq, hash) in article_list:
-			a = found.get(hash)
-			if a is not None:
-				articles.append(a)
-				article_dates[a] = -date
+		def iter_articles():
+			for (date, url, seq, hash) in sorted_keys:
+				if config["splitstate"]:
+					if url not in feedstates:
+						feedstate_p = persister.get(FeedState, self.feeds[url].get_state_filename())
+						feedstates[url] = (feedstate_p, feedstate_p.open())
+					a = feedstates[url][1].articles.get(hash)
+				else:
+					a = self.articles.get(hash)
+				if a is not None:
+					article_dates[a] = -date
+					yield a
+
+		(articles, dup_count) = self.write_remove_dups(iter_articles(), config, now, config["maxarticles"])
+		for (feedstate_p, feedstate) in feedstates.values():
+			feedstate_p.close()
 
-		(articles, dup_count) = self.write_remove_dups(articles, config, now)
 		print("Selected", len(articles), "of", numarticles, "articles. Ignored", dup_count, "duplicates.")
-		self.write_output_file(articles, article_dates, config)
+		if config["rendercache"] > 0:
+			with persister.get(RenderCache, "rendercache") as render_cache:
+				self.write_output_file(articles, article_dates, config, render_cache)
+		else:
+			self.write_output_file(articles, article_dates, config)
+
+# In daemon mode, the shortest time between updates of a feed, whatever
+# its period.
+DAEMON_MIN_INTERVAL = 60
+
+class Daemon:
+	"""Keeps rawdog running, updating each feed as it becomes due and
+	writing the output file once feeds have stopped changing for a
+	while."""
+
+	def __init__(self, rawdog_p, rawdog, config):
+		self.rawdog_p = rawdog_p
+		self.rawdog = rawdog
+		self.config = config
+		# Heap of (time due, feed URL).
+		self.schedule = []
+		# Feed URL -> the time it's in the schedule for. Entries in
+		# the heap that don't match are left over from before the
+		# feed was rescheduled, and are ignored.
+		self.scheduled = {}
+		# When the first and most recent changes that haven't been
+		# written out yet were made.
+		self.first_change = None
+		self.last_change = None
+		self.wakeup = threading.Event()
+		self.reload_pending = False
+		self.stop_pending = False
+
+	def schedule_feed(self, feed):
+		due = max(feed.get_next_update(self.config),
+		          feed.last_update + DAEMON_MIN_INTERVAL)
+		if self.scheduled.get(feed.url) != due:
+			self.scheduled[feed.url] = due
+			heapq.heappush(self.schedule, (due, feed.url))
+
+	def schedule_new_feeds(self):
+		"""Schedule any feeds that aren't already scheduled."""
+		for feed in self.rawdog.feeds.values():
+			if feed.url not in self.scheduled:
+				self.schedule_feed(feed)
+
+	def pop_due(self, now):
+		"""Remove the feeds that are due from the schedule, and return
+		their URLs. No more than maxupdatefeeds are returned at once."""
+		limit = self.config["maxupdatefeeds"]
+		urls = []
+		while (self.schedule and self.schedule[0][0] <= now
+		       and (limit <= 0 or len(urls) < limit)):
+			(due, url) = heapq.heappop(self.schedule)
+			if self.scheduled.get(url) != due:
+				continue
+			del self.scheduled[url]
+			if url in self.rawdog.feeds:
+				urls.append(url)
+		return urls
+
+	def get_write_time(self):
+		if self.first_change is None:
+			return None
+		return min(self.last_change + self.config["writedelay"],
+		           self.first_change + self.config["maxwritedelay"])
+
+	def reload_config(self):
+		"""Read the config file again, and bring the state into line
+		with it."""
+		global entry_info_keys
+		print("Reloading config.")
+		config = Config(self.config.locking)
+		try:
+			config.load("config")
+		except ConfigError as err:
+			print("In config :")
+			print(err)
+			print("Carrying on with the old config.")
+			return
+		if config["statebackend"] != self.config["statebackend"]:
+			print("statebackend can't be changed while the daemon is running.")
+			config["statebackend"] = self.config["statebackend"]
+		if config["statebackend"] == "sqlite":
+			config["splitstate"] = False
+		if config["splitstate"] and not os.path.isdir("feeds"):
+			os.mkdir("feeds")
+		persister.configure(config)
+		entry_info_keys = ENTRY_INFO_KEYS | set(config["keepfields"])
+		self.config = config
+
+		self.rawdog.sync_from_config(config)
+		# Periods may have changed, so schedule everything again.
+		self.schedule = []
+		self.scheduled = {}
+		self.schedule_new_feeds()
+		self.changed(time.time())
+
+	def changed(self, now):
+		if self.first_change is None:
+			self.first_change = now
+		self.last_change = now
+
+	def handle_signal(self, signum, frame):
+		if signum == signal.SIGHUP:
+			self.reload_pending = True
+		else:
+			self.stop_pending = True
+		self.wakeup.set()
+
+	def run_once(self):
+		"""Update the feeds that are due, save the state, and write the
+		output if it's time to. Returns how long to wait before doing
+		so again, or None if nothing's scheduled."""
+		if self.reload_pending:
+			self.reload_pending = False
+			self.reload_config()
+
+		now = time.time()
+		urls = self.pop_due(now)
+		if urls:
+			self.rawdog.update_feeds(self.config, urls, now)
+			self.schedule_new_feeds()
+			if self.rawdog.is_modified():
+				self.changed(time.time())
+		self.rawdog_p.save()
+
+		write_time = self.get_write_time()
+		if write_time is not None and time.time() >= write_time:
+			self.rawdog.write(self.config)
+			self.first_change = None
+
+		wake_times = [self.schedule[0][0]] if self.schedule else []
+		write_time = self.get_write_time()
+		if write_time is not None:
+			wake_times.append(write_time)
+		if wake_times:
+			return max(0, min(wake_times) - time.time())
+		else:
+			return None
+
+	def run(self):
+		"""Run until interrupted or terminated."""
+		print("Running as a daemon.")
+		handlers = {}
+		for signum in (signal.SIGHUP, signal.SIGINT, signal.SIGTERM):
+			handlers[signum] = signal.signal(signum, self.handle_signal)
+		try:
+			self.schedule_new_feeds()
+			while not self.stop_pending:
+				# Sleep until the next feed's due, or the
+				# output needs writing, or a signal arrives.
+				self.wakeup.wait(self.run_once())
+				self.wakeup.clear()
+
+			if self.first_change is not None:
+				self.rawdog.write(self.config)
+		finally:
+			for (signum, handler) in handlers.items():
+				signal.signal(signum, handler)
+		print("Daemon stopped.")
 
 def usage():
 	"""Display usage information."""
@@ -1483,7 +3501,64 @@ Usage: rawdog [OPTION]...
 Actions (performed in order given):
 -l, --list                   List feeds known at time of last update
 -u, --update                 Fetch data from feeds and store it
--w, --write                  Write out HTML output""")
+-w, --write                  Write out HTML output
+--daemon                     Keep running, updating feeds as they become
+                             due and writing the output after changes
+                             (SIGHUP reloads the config file)
+
+Special actions (all other actions are performed after these):
+--migrate-state              Copy the pickled state file into the state
+                             database (with statebackend sqlite)""")
+
+def migrate_state(config):
+	"""Copy the contents of the pickled state file (and any per-feed
+	state files) into the SQLite state database."""
+	if config["statebackend"] != "sqlite":
+		print("To migrate the state file, set statebackend to sqlite in the config file.")
+		return 1
+	if not os.path.exists("state"):
+		print("There is no state file to migrate.")
+		return 1
+
+	old_p = persister.get(Rawdog, "state")
+	old = old_p.open()
+	if old is None:
+		return 1
+	if not old.check_state_version():
+		print("The state file was created by an older version of rawdog, and cannot be migrated.")
+		old_p.close()
+		return 1
+	old.upgrade_state()
+
+	new_p = persister.get(Rawdog, "state.db", SQLitePersisted)
+	new = new_p.open()
+	if new is None:
+		old_p.close()
+		return 1
+	if len(new.feeds) != 0:
+		print("The state database already contains feeds; remove state.db to migrate again.")
+		new_p.close()
+		old_p.close()
+		return 1
+
+	print("Migrating state to state.db.")
+	for feed in list(old.feeds.values()):
+		if feed.article_keys is not None:
+			with persister.get(FeedState, feed.get_state_filename()) as feedstate:
+				for article in feedstate.articles.values():
+					new.articles.add(article)
+			feed.article_keys = None
+		new.feeds[feed.url] = feed
+		new.feed_changed(feed.url, ["added"])
+	for article in old.articles.values():
+		new.articles.add(article)
+	new.plugin_storage = old.plugin_storage
+	new.modified()
+	print("Migrated", len(new.feeds), "feeds and", len(new.articles), "articles.")
+	new_p.close()
+	old_p.close()
+	print("The old state file is no longer used, and can be removed.")
+	return 0
 
 def main(argv):
 	"""The command-line interface to the aggregator."""
@@ -1498,7 +3573,9 @@ def main(argv):
 	try:
 		SHORTOPTS = "luw"
 		LONGOPTS = [
+			"daemon",
 			"list",
+			"migrate-state",
 			"update",
 			"write",
 			]
@@ -1547,10 +3624,23 @@ def main(argv):
 	if rc != 0:
 		return rc
 
-	global persister
+	global persister, entry_info_keys
 	persister = Persister(config)
+	entry_info_keys = ENTRY_INFO_KEYS | set(config["keepfields"])
 
-	rawdog_p = persister.get(Rawdog, "state")
+	for o, a in optlist:
+		if o == "--migrate-state":
+			rc = migrate_state(config)
+			if rc != 0:
+				return rc
+
+	if config["statebackend"] == "sqlite":
+		# The database already stores articles separately for each
+		# feed.
+		config["splitstate"] = False
+		rawdog_p = persister.get(Rawdog, "state.db", SQLitePersisted)
+	else:
+		rawdog_p = persister.get(Rawdog, "state")
 	rawdog = rawdog_p.open(no_block=no_lock_wait)
 	if rawdog is None:
 		return 0
@@ -1560,6 +3650,10 @@ def main(argv):
 		print("Removing the state file will fix it.")
 		return 1
 
+	if config["splitstate"] and not os.path.isdir("feeds"):
+		os.mkdir("feeds")
+
+	rawdog.upgrade_state()
 	rawdog.sync_from_config(config)
 
 	for o, a in optlist:
@@ -1569,6 +3663,8 @@ def main(argv):
 			rawdog.update(config)
 		elif o in ("-w", "--write"):
 			rawdog.write(config)
+		elif o == "--daemon":
+			Daemon(rawdog_p, rawdog, config).run()
 
 	rawdog_p.close()
 	return 0
@@ -0,0 +1,170 @@
+# Fixtures shared by rawdog's tests.
+
+import gzip
+import http.server
+import threading
+import time
+
+import pytest
+
+from rawdoglib import rawdog as rawdog_mod
+
+class Route:
+	"""What the server sends for one path. If etag is given, a request
+	with a matching If-None-Match gets a 304 instead. delay is how long
+	to wait before replying."""
+
+	def __init__(self, body=b"", status=200, headers=None, delay=0,
+	             etag=None, chunked=False, gzip=False, close=False):
+		self.body = body
+		self.status = status
+		self.headers = headers or {}
+		self.delay = delay
+		self.etag = etag
+		self.chunked = chunked
+		self.gzip = gzip
+		self.close = close
+
+class FeedServer:
+	"""A local HTTP/1.1 server that stands in for the servers feeds are
+	fetched from. It keeps connections alive, and records the requests
+	and connections it's seen."""
+
+	def __init__(self):
+		self.routes = {}
+		self.requests = []
+		self.connections = 0
+		self.lock = threading.Lock()
+
+		server = self
+		class Handler(http.server.BaseHTTPRequestHandler):
+			protocol_version = "HTTP/1.1"
+
+			def setup(self):
+				http.server.BaseHTTPRequestHandler.setup(self)
+				with server.lock:
+					server.connections += 1
+
+			def do_GET(self):
+				server.handle(self)
+
+			def log_message(self, format, *args):
+				pass
+
+		class Server(http.server.ThreadingHTTPServer):
+			daemon_threads = True
+			request_queue_size = 100
+
+			def handle_error(self, request, client_address):
+				# Clients that time out close their
+				# connections before the reply's sent.
+				pass
+
+		self.httpd = Server(("127.0.0.1", 0), Handler)
+		self.port = self.httpd.server_address[1]
+		self.thread = threading.Thread(target=self.httpd.serve_forever,
+		                               kwargs={"poll_interval": 0.05}, daemon=True)
+		self.thread.start()
+
+	def url(self, path):
+		return "http://127.0.0.1:%d%s" % (self.port, path)
+
+	def add(self, path, *args, **kwargs):
+		self.routes[path] = Route(*args, **kwargs)
+		return self.url(path)
+
+	def redirect(self, path, target, status=301):
+		return self.add(path, status=status, headers={"Location": self.url(target)})
+
+	def handle(self, handler):
+		with self.lock:
+			self.requests.append((handler.path, dict(handler.headers)))
+		route = self.routes.get(handler.path)
+		if route is None:
+			route = Route(b"Not found", status=404)
+		if route.delay:
+			time.sleep(route.delay)
+
+		status = route.status
+		body = route.body
+		headers = dict(route.headers)
+		if route.etag is not None:
+			headers["ETag"] = route.etag
+			if handler.headers.get("If-None-Match") == route.etag:
+				status = 304
+				body = b""
+		if route.gzip and body:
+			body = gzip.compress(body)
+			headers["Content-Encoding"] = "gzip"
+		if route.close:
+			headers["Connection"] = "close"
+			handler.close_connection = True
+
+		handler.send_response(status)
+		for (name, value) in headers.items():
+			handler.send_header(name, value)
+		if status == 304:
+			handler.end_headers()
+		elif route.chunked:
+			handler.send_header("Transfer-Encoding", "chunked")
+			handler.end_headers()
+			for i in range(0, len(body), 100):
+				chunk = body[i:i + 100]
+				handler.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+			handler.wfile.write(b"0\r\n\r\n")
+		else:
+			handler.send_header("Content-Length", str(len(body)))
+			handler.end_headers()
+			handler.wfile.write(body)
+
+	def close(self):
+		self.httpd.shutdown()
+		self.httpd.server_close()
+
+@pytest.fixture
+def server():
+	server = FeedServer()
+	yield server
+	server.close()
+
+FEED = """<?xml version="1.0"?>
+<rss version="2.0"><channel><title>Test feed</title><link>http://example.com/</link>
+%s
+</channel></rss>
+"""
+
+ITEM = """<item><title>%s</title><link>http://example.com/%s</link>
+<guid>http://example.com/%s</guid><description>%s</description></item>
+"""
+
+def make_feed(items):
+	"""Return an RSS feed containing items, a list of (name, body)
+	pairs."""
+	return (FEED % "".join(ITEM % (name, name, name, body) for (name, body) in items)).encode("UTF-8")
+
+class Clock:
+	"""A replacement for time.time that only moves when it's told to."""
+
+	def __init__(self):
+		self.now = time.time()
+
+	def __call__(self):
+		return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+	clock = Clock()
+	monkeypatch.setattr(time, "time", clock)
+	return clock
+
+@pytest.fixture
+def statedir(tmp_path, monkeypatch):
+	"""An empty state directory, where main expects to find it. The
+	test writes its config file."""
+	statedir = tmp_path / ".rawdog"
+	statedir.mkdir()
+	monkeypatch.setenv("HOME", str(tmp_path))
+	monkeypatch.chdir(tmp_path)
+	for name in ("persister", "entry_info_keys", "system_encoding"):
+		monkeypatch.setattr(rawdog_mod, name, getattr(rawdog_mod, name))
+	return statedir
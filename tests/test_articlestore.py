@@ -0,0 +1,84 @@
+# Tests for the collection of articles.
+
+import pickle
+
+from rawdoglib.rawdog import Article, ArticleStore, Config
+
+URL = "http://example.com/feed.rss"
+
+def make_article(name, now, url=URL):
+	entry_info = {"id": name, "link": "http://example.com/" + name, "title": name}
+	return Article(url, entry_info, now, 0)
+
+def seen_order(store, url=URL):
+	return [store[hash].id for hash in store._get_seen(url)]
+
+def test_seen_order():
+	store = ArticleStore()
+	for (i, name) in enumerate("abc"):
+		store.add(make_article(name, 1000 + i))
+	assert seen_order(store) == ["a", "b", "c"]
+	a = store[next(iter(store.hashes_for_feed(URL)))]
+	store.seen(a.hash, 0, None, 2000)
+	assert seen_order(store) == ["b", "c", "a"]
+
+def test_seen_out_of_order(monkeypatch):
+	# Articles added in bulk, out of last_seen order, are only sorted
+	# once when the order's needed.
+	store = ArticleStore()
+	sorts = []
+	real_sort_seen = store._sort_seen
+	def sort_seen(url, hashes):
+		sorts.append(url)
+		real_sort_seen(url, hashes)
+	monkeypatch.setattr(store, "_sort_seen", sort_seen)
+	for i in range(100):
+		store.add(make_article("a%d" % i, 2000 - i))
+	store.add(make_article("other", 3000, "http://example.com/other.rss"))
+	assert sorts == []
+	assert seen_order(store) == ["a%d" % i for i in reversed(range(100))]
+	assert sorts == [URL]
+	assert seen_order(store) == ["a%d" % i for i in reversed(range(100))]
+	assert sorts == [URL]
+
+def test_expiry_candidates():
+	config = Config(False)
+	config["expireage"] = 100
+	store = ArticleStore()
+	for (i, name) in enumerate("dcba"):
+		store.add(make_article(name, 1030 - 10 * i))
+	candidates = store.expiry_candidates(URL, 1115, config)
+	# c and d have been seen too recently.
+	assert [store[hash].id for (added, seq, hash) in candidates] == ["a", "b"]
+
+def test_pickle_sorts_seen():
+	store = ArticleStore()
+	for (i, name) in enumerate("abc"):
+		store.add(make_article(name, 1000 - i))
+	store = pickle.loads(pickle.dumps(store))
+	assert store.unsorted_seen == set()
+	assert [store[hash].id for hash in store.feed_seen[URL]] == ["c", "b", "a"]
+
+def test_rename_and_remove_unsorted():
+	store = ArticleStore()
+	for (i, name) in enumerate("abc"):
+		store.add(make_article(name, 1000 - i))
+	store.rename_feed(URL, "http://example.com/new.rss")
+	assert seen_order(store, "http://example.com/new.rss") == ["c", "b", "a"]
+
+	store.add(make_article("d", 500, "http://example.com/new.rss"))
+	store.remove_feed("http://example.com/new.rss")
+	assert store.unsorted_seen == set()
+	assert len(store) == 0
+
+def test_replay():
+	store = ArticleStore()
+	for (i, name) in enumerate("abc"):
+		store.add(make_article(name, 1000 + i))
+	b = [hash for hash in store.keys() if store[hash].id == "b"][0]
+	store.seen(b, 1, None, 2000)
+	store.remove([hash for hash in store.keys() if store[hash].id == "a"][0])
+
+	copy = ArticleStore()
+	copy.replay(store.changes)
+	assert seen_order(copy) == seen_order(store) == ["c", "b"]
@@ -0,0 +1,144 @@
+# Tests for the asyncio HTTP client.
+
+import asyncio
+import time
+
+import pytest
+
+from rawdoglib.asynchttp import Client, HTTPError
+
+def run(coro):
+	return asyncio.run(coro)
+
+async def get_all(client, urls):
+	try:
+		return await asyncio.gather(*[client.get(url, {}) for url in urls],
+		                            return_exceptions=True)
+	finally:
+		client.close()
+
+@pytest.mark.parametrize("options", [
+	{},
+	{"chunked": True},
+	{"gzip": True},
+	{"close": True},
+	])
+def test_get(server, options):
+	body = b"x" * 1000
+	url = server.add("/feed", body, headers={"X-Test": "yes"}, **options)
+	[responses] = run(get_all(Client(10, 10), [url]))
+	[response] = responses
+	assert response.status == 200
+	assert response.body == body
+	assert response.headers["x-test"] == "yes"
+	assert "content-encoding" not in response.headers
+
+def test_redirects(server):
+	url = server.redirect("/old", "/middle", 301)
+	server.redirect("/middle", "/new", 302)
+	server.add("/new", b"feed")
+	[responses] = run(get_all(Client(10, 10), [url]))
+	assert [r.status for r in responses] == [301, 302, 200]
+	assert responses[-1].url == server.url("/new")
+	assert responses[-1].body == b"feed"
+
+def test_redirect_loop(server):
+	url = server.redirect("/loop", "/loop")
+	[responses] = run(get_all(Client(10, 10), [url]))
+	assert len(responses) == 11
+	assert responses[-1].status == 301
+
+def test_not_modified(server):
+	url = server.add("/feed", b"feed", etag='"1"')
+	async def fetch():
+		client = Client(10, 10)
+		try:
+			first = await client.get(url, {})
+			second = await client.get(url, {"If-None-Match": '"1"'})
+			return (first, second)
+		finally:
+			client.close()
+	(first, second) = run(fetch())
+	assert first[-1].status == 200
+	assert second[-1].status == 304
+	assert second[-1].body == b""
+	# The 304 didn't stop the connection being reused.
+	assert server.connections == 1
+
+def test_keep_alive(server):
+	urls = [server.add("/%d" % i, b"feed") for i in range(5)]
+	async def fetch():
+		client = Client(10, 10)
+		try:
+			for url in urls:
+				await client.get(url, {})
+		finally:
+			client.close()
+	run(fetch())
+	assert len(server.requests) == 5
+	assert server.connections == 1
+
+def test_connection_close(server):
+	urls = [server.add("/%d" % i, b"feed", close=True) for i in range(3)]
+	async def fetch():
+		client = Client(10, 10)
+		try:
+			for url in urls:
+				await client.get(url, {})
+		finally:
+			client.close()
+	run(fetch())
+	assert server.connections == 3
+
+def test_idle_connection_closed(server):
+	# If the server's closed an idle connection, the request is made
+	# again on a new one.
+	url = server.add("/feed", b"feed")
+	async def fetch():
+		client = Client(10, 10)
+		try:
+			await client.get(url, {})
+			for connections in client.idle.values():
+				for (reader, writer) in connections:
+					writer.transport.abort()
+			return await client.get(url, {})
+		finally:
+			client.close()
+	responses = run(fetch())
+	assert responses[-1].body == b"feed"
+
+def test_host_connections(server):
+	# Requests to the same host are made one at a time.
+	urls = [server.add("/%d" % i, b"feed", delay=0.2) for i in range(3)]
+	start = time.monotonic()
+	results = run(get_all(Client(10, 1), urls))
+	assert all(r[-1].status == 200 for r in results)
+	assert time.monotonic() - start >= 0.6
+
+def test_host_interval(server):
+	urls = [server.add("/%d" % i, b"feed") for i in range(3)]
+	start = time.monotonic()
+	run(get_all(Client(10, 10, host_interval=0.2), urls))
+	assert time.monotonic() - start >= 0.4
+
+def test_timeout(server):
+	url = server.add("/slow", b"feed", delay=1)
+	[result] = run(get_all(Client(10, 10, timeout=0.2), [url]))
+	assert isinstance(result, asyncio.TimeoutError)
+
+def test_timeout_excludes_waiting(server):
+	# Requests queued behind others to the same host don't time out
+	# while they're waiting for their turn, only if the server's slow
+	# to answer them.
+	urls = [server.add("/%d" % i, b"feed", delay=0.3) for i in range(4)]
+	results = run(get_all(Client(100, 1, timeout=0.6), urls))
+	assert [r[-1].status for r in results] == [200, 200, 200, 200]
+
+def test_timeout_excludes_host_interval(server):
+	urls = [server.add("/%d" % i, b"feed") for i in range(3)]
+	results = run(get_all(Client(100, 10, host_interval=0.3, timeout=0.2), urls))
+	assert [r[-1].status for r in results] == [200, 200, 200]
+
+def test_bad_url():
+	[result] = run(get_all(Client(10, 10), ["ftp://example.com/feed"]))
+	assert isinstance(result, HTTPError)
@@ -0,0 +1,101 @@
+# Tests for spotting feeds whose bodies haven't changed.
+
+import os
+
+import pytest
+
+from conftest import make_feed
+from rawdoglib import rawdog as rawdog_mod
+from rawdoglib.rawdog import BodyCache, Config, Feed
+
+URL = "http://example.com/feed.rss"
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+	monkeypatch.chdir(tmp_path)
+	return BodyCache(1000)
+
+def make_download(data):
+	return {
+		"data": data,
+		"headers": {},
+		"url": URL,
+		"status": 200,
+		"rawdog_responses": [{"url": URL, "status": 200}],
+		}
+
+def test_get_save(cache):
+	assert cache.get(URL) is None
+	cache.save(URL, b"body")
+	assert cache.get(URL) == b"body"
+	cache.save(URL, b"new body")
+	assert cache.get(URL) == b"new body"
+	assert os.listdir(cache.dirname) == [os.path.basename(cache.get_filename(URL))]
+
+def test_trim(cache):
+	for i in range(5):
+		url = "http://example.com/%d" % i
+		cache.save(url, b"x" * 300)
+		# Make the files' ages distinct.
+		os.utime(cache.get_filename(url), (1000 + i, 1000 + i))
+	# Using a body makes it the most recently used.
+	assert cache.get("http://example.com/0") is not None
+	cache.trim()
+	assert len(os.listdir(cache.dirname)) == 3
+	assert cache.get("http://example.com/0") is not None
+	assert cache.get("http://example.com/1") is None
+	assert cache.get("http://example.com/2") is None
+	assert cache.get("http://example.com/4") is not None
+
+def test_check_download_digest():
+	config = Config(False)
+	feed = Feed(URL)
+	download = feed.check_download(make_download(b"body"), config)
+	assert "rawdog_body_match" not in download
+	feed.body_digest = download["rawdog_body_digest"]
+
+	assert "rawdog_body_match" in feed.check_download(make_download(b"body"), config)
+	assert "rawdog_body_match" not in feed.check_download(make_download(b"other"), config)
+
+	# Settings that change how the body is turned into articles
+	# change the digest too.
+	config["sanitiseonupdate"] = not config["sanitiseonupdate"]
+	assert "rawdog_body_match" not in feed.check_download(make_download(b"body"), config)
+
+def test_check_download_cache(cache):
+	config = Config(False)
+	feed = Feed(URL)
+	download = feed.check_download(make_download(b"body"), config, cache)
+	assert cache.get(URL) == b"body"
+	feed.body_digest = download["rawdog_body_digest"]
+	assert "rawdog_body_match" in feed.check_download(make_download(b"body"), config, cache)
+
+	# If the cached body doesn't match, the digest isn't trusted.
+	cache.save(URL, b"something else")
+	download = feed.check_download(make_download(b"body"), config, cache)
+	assert "rawdog_body_match" not in download
+	assert cache.get(URL) == b"body"
+
+def test_check_download_error():
+	feed = Feed(URL)
+	download = make_download(b"Not found")
+	download["status"] = download["rawdog_responses"][0]["status"] = 404
+	download = feed.check_download(download, Config(False))
+	assert "rawdog_body_digest" not in download
+
+def test_update_with_cache(statedir, clock, server, capsys):
+	url = server.add("/feed.rss", make_feed([("a", "first")]))
+	with open(statedir / "config", "w") as f:
+		f.write("bodycache 1\nfeed 1m " + url + "\n")
+	assert rawdog_mod.main(["-u"]) == 0
+	assert len(os.listdir(statedir / "bodycache")) == 1
+	clock.now += 3600
+	assert rawdog_mod.main(["-u"]) == 0
+	assert "1 feeds unchanged (body match)." in capsys.readouterr().out
+
+	server.add("/feed.rss", make_feed([("a", "first"), ("b", "second")]))
+	clock.now += 3600
+	assert rawdog_mod.main(["-u"]) == 0
+	out = capsys.readouterr().out
+	assert "body match" not in out
+	assert "Changed articles: add 1" in out
@@ -0,0 +1,41 @@
+# Tests for reading the config file.
+
+import pytest
+
+from rawdoglib.persister import COMPRESSION_LEVELS, compress
+from rawdoglib.rawdog import Config, ConfigError
+
+def load(tmp_path, *lines):
+	filename = tmp_path / "config"
+	with open(filename, "w") as f:
+		for line in lines:
+			f.write(line + "\n")
+	config = Config(False)
+	config.load(str(filename))
+	return config
+
+@pytest.mark.parametrize("format", sorted(COMPRESSION_LEVELS))
+def test_compression_levels_usable(format):
+	# Every level that the config allows can be used to compress.
+	(low, high) = COMPRESSION_LEVELS[format]
+	for level in (low, high):
+		compress(b"some data " * 100, (format, level))
+
+@pytest.mark.parametrize("lines", [
+	("statecompression gzip", "statecompressionlevel 0"),
+	("statecompressionlevel 9", "statecompression lzma"),
+	("statecompression none", "statecompressionlevel 100"),
+	])
+def test_compression_level(tmp_path, lines):
+	load(tmp_path, *lines)
+
+@pytest.mark.parametrize("lines", [
+	("statecompression bz2", "statecompressionlevel 0"),
+	# The level is checked whichever order they're given in.
+	("statecompressionlevel 0", "statecompression bz2"),
+	("statecompression gzip", "statecompressionlevel 10"),
+	("statecompression lzma", "statecompressionlevel -1"),
+	])
+def test_bad_compression_level(tmp_path, lines):
+	with pytest.raises(ConfigError, match="statecompressionlevel must be between"):
+		load(tmp_path, *lines)
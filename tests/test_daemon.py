@@ -0,0 +1,126 @@
+# Tests for rawdog's daemon mode.
+
+import os
+
+from conftest import make_feed
+from rawdoglib import persister as persister_mod
+from rawdoglib import rawdog as rawdog_mod
+from rawdoglib.persister import Persister, SectionRef
+from rawdoglib.rawdog import Config, Daemon, Rawdog
+
+def write_config(statedir, *lines):
+	with open(statedir / "config", "w") as f:
+		for line in ("outputfile output.html",) + lines:
+			f.write(line + "\n")
+
+def write_feed(path, items):
+	with open(path, "wb") as f:
+		f.write(make_feed(items))
+
+def open_daemon(statedir):
+	"""Load the state as main does, and return a Daemon for it."""
+	os.chdir(statedir)
+	config = Config(True)
+	config.load("config")
+	rawdog_mod.persister = Persister(config)
+	rawdog_p = rawdog_mod.persister.get(Rawdog, "state")
+	rawdog = rawdog_p.open()
+	rawdog.sync_from_config(config)
+	return Daemon(rawdog_p, rawdog, config)
+
+def test_schedule(statedir, clock, server):
+	urls = [server.add("/%d.rss" % i, make_feed([("a%d" % i, "body")])) for i in range(3)]
+	write_config(statedir, "maxupdatefeeds 2", *["feed 1h " + url for url in urls])
+	daemon = open_daemon(statedir)
+	try:
+		daemon.schedule_new_feeds()
+		# New feeds are due straight away, but only two can be
+		# updated at once.
+		due = daemon.pop_due(clock.now)
+		assert len(due) == 2
+		assert daemon.pop_due(clock.now) == [url for url in urls if url not in due]
+		assert daemon.pop_due(clock.now) == []
+
+		# Once a feed has been updated, it isn't due again until its
+		# period's passed.
+		daemon.rawdog.update_feeds(daemon.config, urls, clock.now)
+		daemon.schedule_new_feeds()
+		assert daemon.pop_due(clock.now + 60) == []
+		assert len(daemon.pop_due(clock.now + 2 * 3600)) == 2
+	finally:
+		daemon.rawdog_p.close()
+
+def test_write_delay(statedir, clock, server):
+	url = server.add("/feed.rss", make_feed([("a", "body")]))
+	write_config(statedir, "writedelay 30", "maxwritedelay 100", "feed 1h " + url)
+	daemon = open_daemon(statedir)
+	try:
+		assert daemon.get_write_time() is None
+		daemon.changed(clock.now)
+		assert daemon.get_write_time() == clock.now + 30
+		# Changes keep putting off the write, but only for so long.
+		for i in range(5):
+			daemon.changed(clock.now + 25 * i)
+		assert daemon.get_write_time() == clock.now + 100
+
+		# run_once updates the feed, but doesn't write the output
+		# until writedelay has passed since the change.
+		daemon = Daemon(daemon.rawdog_p, daemon.rawdog, daemon.config)
+		daemon.schedule_new_feeds()
+		assert daemon.run_once() == 30
+		assert len(server.requests) == 1
+		assert not os.path.exists("output.html")
+		clock.now += 30
+		daemon.run_once()
+		assert os.path.exists("output.html")
+		assert daemon.get_write_time() is None
+	finally:
+		daemon.rawdog_p.close()
+
+def test_compaction_between_iterations(statedir, clock, monkeypatch):
+	feed = statedir.parent / "feed.rss"
+	write_config(statedir, "journalratio 0", "feed 1m file://%s" % feed)
+
+	# Leave plenty of unused blobs behind without compacting them.
+	monkeypatch.setattr(persister_mod, "BLOB_WASTE_LIMIT", 1 << 30)
+	write_feed(feed, [("a", "x" * 10000)])
+	assert rawdog_mod.main(["-u"]) == 0
+	write_feed(feed, [("a", "short")])
+	clock.now += 3600
+	assert rawdog_mod.main(["-u"]) == 0
+
+	monkeypatch.setattr(persister_mod, "BLOB_WASTE_LIMIT", 0)
+	daemon = open_daemon(statedir)
+	old_gen = daemon.rawdog_p.blobs.gen
+	daemon.schedule_new_feeds()
+	try:
+		# Changing the feed's period makes the state be rewritten
+		# (and its blobs compacted) without the articles being
+		# loaded.
+		with open("config") as f:
+			config = f.read()
+		with open("config", "w") as f:
+			f.write(config.replace("feed 1m", "feed 3h"))
+		daemon.reload_pending = True
+		clock.now += 10
+		daemon.run_once()
+		assert isinstance(daemon.rawdog._articles, SectionRef)
+		assert daemon.rawdog_p.blobs.gen > old_gen
+		assert daemon.rawdog_p.blobs.generations() == [daemon.rawdog_p.blobs.gen]
+
+		# The next update loads the articles, and their bodies, from
+		# the new file.
+		write_feed(feed, [("a", "short"), ("b", "another")])
+		clock.now += 4 * 3600
+		daemon.run_once()
+		articles = daemon.rawdog.articles
+		links = sorted(article.entry_info["link"] for article in articles.values())
+		assert links == ["http://example.com/a", "http://example.com/b"]
+	finally:
+		daemon.rawdog_p.close()
+
+	daemon = open_daemon(statedir)
+	try:
+		assert len(daemon.rawdog.articles) == 2
+	finally:
+		daemon.rawdog_p.close()
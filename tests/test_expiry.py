@@ -0,0 +1,88 @@
+# Tests for expiring old articles.
+
+import random
+import sqlite3
+
+import pytest
+
+from conftest import make_feed
+from rawdoglib import rawdog as rawdog_mod
+from rawdoglib.rawdog import Article, ArticleStore, Config, Rawdog, SQLiteArticleStore
+
+def old_expire_articles(rawdog, articles, config, now, updated_feeds):
+	"""Return the hashes of the articles that rawdog expired before
+	articles were indexed by feed, when it looked at all of them."""
+	feedcounts = {}
+	expiry_list = []
+	for key, article in list(articles.items()):
+		url = article.feed
+		feedcounts[url] = feedcounts.get(url, 0) + 1
+		expiry_list.append((article.added, article.sequence, key, article))
+	expiry_list.sort()
+
+	expired = []
+	for date, seq, key, article in expiry_list:
+		url = article.feed
+		if url not in rawdog.feeds:
+			expired.append(key)
+			continue
+		if (url in updated_feeds
+		    and article.can_expire(now, config)
+		    and feedcounts[url] > rawdog.feeds[url].get_keepmin(config)):
+			expired.append(key)
+			feedcounts[url] -= 1
+	return expired
+
+def make_store(kind):
+	if kind == "sqlite":
+		return SQLiteArticleStore(sqlite3.connect(":memory:"))
+	return ArticleStore()
+
+@pytest.mark.parametrize("kind", ["pickle", "sqlite"])
+@pytest.mark.parametrize("seed", range(20))
+def test_same_as_full_scan(kind, seed):
+	rng = random.Random(seed)
+	config = Config(False)
+	config["expireage"] = 1000
+	urls = ["http://example.com/%d.rss" % i for i in range(4)]
+	# The last feed has been removed from the config.
+	for url in urls[:-1]:
+		config.load_line("feed 1h %s keepmin=%d" % (url, rng.randint(0, 5)), [])
+	rawdog = Rawdog()
+	rawdog.sync_from_config(config)
+
+	now = 100000
+	store = make_store(kind)
+	for i in range(200):
+		url = rng.choice(urls)
+		entry_info = {"id": "a%d" % i, "link": "http://example.com/a%d" % i}
+		article = Article(url, entry_info, now - rng.randint(0, 5000), rng.randint(0, 3))
+		article.last_seen = article.added + rng.randint(0, 5000)
+		if article.hash not in store:
+			store.add(article)
+	updated_feeds = set(rng.sample(urls, 2))
+
+	expected = old_expire_articles(rawdog, store, config, now, updated_feeds)
+	before = set(store.keys())
+	count = rawdog.expire_articles(store, config, now, updated_feeds)
+	assert count == len(expected)
+	assert before - set(store.keys()) == set(expected)
+
+@pytest.mark.parametrize("splitstate", [0, 1])
+def test_total_printed_once(statedir, clock, server, capsys, splitstate):
+	urls = [server.add("/%d.rss" % i, make_feed([("a%d" % i, "body"), ("b%d" % i, "body")]))
+	        for i in range(3)]
+	with open(statedir / "config", "w") as f:
+		f.write("splitstate %d\n" % splitstate)
+		f.write("keepmin 0\n")
+		f.write("expireage 1h\n")
+		for url in urls:
+			f.write("feed 1h %s\n" % url)
+	assert rawdog_mod.main(["-u"]) == 0
+	for i in range(2):
+		server.add("/%d.rss" % i, make_feed([("c%d" % i, "body")]))
+	clock.now += 7200
+	capsys.readouterr()
+	assert rawdog_mod.main(["-u"]) == 0
+	lines = [line for line in capsys.readouterr().out.split("\n") if line.startswith("Expired")]
+	assert lines == ["Expired 4 articles, leaving 4"]
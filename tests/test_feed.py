@@ -0,0 +1,72 @@
+# Tests for how rawdog handles the results of fetching a feed.
+
+import email.utils
+
+import pytest
+
+from rawdoglib.rawdog import ArticleStore, Config, Rawdog, get_server_delay
+
+OLD_URL = "http://example.com/old.rss"
+NEW_URL = "http://example.com/new.rss"
+
+@pytest.fixture
+def rawdog(tmp_path, monkeypatch):
+	"""A Rawdog with one feed, and a config file it can edit."""
+	monkeypatch.chdir(tmp_path)
+	with open("config", "w") as f:
+		f.write("feed 1h " + OLD_URL + "\n")
+	config = Config(False)
+	config.load("config")
+	rawdog = Rawdog()
+	rawdog.sync_from_config(config)
+	return (rawdog, config)
+
+@pytest.mark.parametrize("last", [
+	{"status": 304},
+	{"status": 200},
+	])
+def test_moved_feed_unchanged(rawdog, capsys, last):
+	# A permanent redirect to a feed that hasn't changed still moves
+	# the feed, and says so.
+	(rawdog, config) = rawdog
+	feed = rawdog.feeds[OLD_URL]
+	p = {
+		"rawdog_responses": [{"status": 301, "location": NEW_URL}, last],
+		}
+	if last["status"] == 200:
+		p["rawdog_body_match"] = True
+	assert not feed.update(rawdog, 1000.0, config, ArticleStore(), p)
+
+	out = capsys.readouterr().out
+	assert "The feed has moved permanently to a new URL." in out
+	assert "The config file has been updated automatically." in out
+	assert list(rawdog.feeds) == [NEW_URL]
+	with open("config") as f:
+		assert NEW_URL in f.read()
+
+def http_date(t):
+	return email.utils.formatdate(t, usegmt=True)
+
+NOW = 1700000000.0
+
+@pytest.mark.parametrize("entry, delay", [
+	({"status": 200}, None),
+	({"status": 200, "cache-control": "max-age=600"}, 600),
+	({"status": 304, "cache-control": "max-age=600", "age": "100"}, 500),
+	({"status": 200, "cache-control": "no-cache, max-age=600"}, None),
+	({"status": 200, "expires": http_date(NOW + 300)}, 300),
+	# The server's clock is an hour fast.
+	({"status": 200, "expires": http_date(NOW + 3900), "date": http_date(NOW + 3600)}, 300),
+	({"status": 200, "expires": "0"}, None),
+	({"status": 404, "cache-control": "max-age=600"}, None),
+	({"status": 503, "retry-after": "120"}, 120),
+	({"status": 429, "retry-after": http_date(NOW + 120)}, 120),
+	({"status": 503, "retry-after": http_date(NOW + 3720), "date": http_date(NOW + 3600)}, 120),
+	({"status": 503, "retry-after": "soon"}, None),
+	({"status": 500, "retry-after": "120"}, None),
+	])
+def test_server_delay(entry, delay):
+	if delay is None:
+		assert get_server_delay(entry, NOW) is None
+	else:
+		assert get_server_delay(entry, NOW) == NOW + delay
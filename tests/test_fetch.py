@@ -0,0 +1,102 @@
+# Tests for fetching feeds with each of rawdog's fetch engines.
+
+import pytest
+
+from conftest import make_feed
+from rawdoglib import rawdog as rawdog_mod
+
+ENGINES = ["threads", "async"]
+
+def write_config(statedir, engine, *lines):
+	with open(statedir / "config", "w") as f:
+		for line in ("outputfile output.html", "fetchengine " + engine) + lines:
+			f.write(line + "\n")
+
+def read_output(statedir):
+	with open(statedir / "output.html") as f:
+		return f.read()
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_update(statedir, clock, server, engine):
+	url = server.add("/feed.rss", make_feed([("a", "first"), ("b", "second")]))
+	write_config(statedir, engine, "feed 1m " + url)
+	assert rawdog_mod.main(["-u", "-w"]) == 0
+	output = read_output(statedir)
+	assert "first" in output and "second" in output
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_not_modified(statedir, clock, server, engine, capsys):
+	url = server.add("/feed.rss", make_feed([("a", "first")]), etag='"1"')
+	write_config(statedir, engine, "feed 1m " + url)
+	assert rawdog_mod.main(["-u"]) == 0
+	clock.now += 3600
+	assert rawdog_mod.main(["-u"]) == 0
+	assert server.requests[-1][1].get("If-None-Match") == '"1"'
+	assert "Changed articles" not in capsys.readouterr().out.split("Will update")[-1]
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_body_match(statedir, clock, server, engine, capsys):
+	url = server.add("/feed.rss", make_feed([("a", "first")]))
+	write_config(statedir, engine, "feed 1m " + url)
+	assert rawdog_mod.main(["-u"]) == 0
+	clock.now += 3600
+	assert rawdog_mod.main(["-u"]) == 0
+	assert "1 feeds unchanged (body match)." in capsys.readouterr().out
+
+@pytest.mark.parametrize("engine", ENGINES)
+@pytest.mark.parametrize("parseprocesses", [0, 1])
+def test_moved(statedir, clock, server, engine, parseprocesses, capsys):
+	url = server.redirect("/old.rss", "/new.rss")
+	new_url = server.add("/new.rss", make_feed([("a", "moved")]))
+	write_config(statedir, engine, "parseprocesses %d" % parseprocesses, "feed 1m " + url)
+	assert rawdog_mod.main(["-u", "-w"]) == 0
+	assert "The feed has moved permanently to a new URL." in capsys.readouterr().out
+	with open(statedir / "config") as f:
+		assert ("feed 1m " + new_url) in f.read()
+	assert "moved" in read_output(statedir)
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_keep_alive(statedir, clock, server, engine):
+	urls = [server.add("/%d.rss" % i, make_feed([("a%d" % i, "body")])) for i in range(4)]
+	write_config(statedir, engine, "numthreads 1", "hostconnections 1",
+	             *["feed 1m " + url for url in urls])
+	assert rawdog_mod.main(["-u"]) == 0
+	assert len(server.requests) == 4
+	assert server.connections == 1
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_timeout_while_queued(statedir, clock, server, engine):
+	# Feeds that have to wait for others on the same host don't time
+	# out because of the wait.
+	urls = [server.add("/%d.rss" % i, make_feed([("a%d" % i, "body%d" % i)]), delay=0.6)
+	        for i in range(4)]
+	write_config(statedir, engine, "timeout 1s", "hostconnections 1",
+	             *["feed 1m " + url for url in urls])
+	assert rawdog_mod.main(["-u", "-w"]) == 0
+	output = read_output(statedir)
+	for i in range(4):
+		assert ("body%d" % i) in output
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_timeout(statedir, clock, server, engine, capsys):
+	url = server.add("/slow.rss", make_feed([("a", "body")]), delay=2)
+	write_config(statedir, engine, "timeout 1s", "feed 1m " + url)
+	assert rawdog_mod.main(["-u"]) == 0
+	assert "Timeout while reading feed." in capsys.readouterr().out
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_unexpected_error(statedir, clock, server, engine, monkeypatch, capsys):
+	# An exception while handling one feed is reported for that feed,
+	# rather than leaving the update waiting for its result.
+	urls = [server.add("/%d.rss" % i, make_feed([("a%d" % i, "body%d" % i)])) for i in range(3)]
+	write_config(statedir, engine, "maxpending 1", "feed 1m " + urls[0], "feed 1m " + urls[1], "feed 1m " + urls[2])
+	real_check_download = rawdog_mod.Feed.check_download
+	def check_download(feed, download, config, cache=None):
+		if feed.url == urls[1]:
+			raise OSError("disk on fire")
+		return real_check_download(feed, download, config, cache)
+	monkeypatch.setattr(rawdog_mod.Feed, "check_download", check_download)
+	assert rawdog_mod.main(["-u", "-w"]) == 0
+	assert "disk on fire" in capsys.readouterr().out
+	output = read_output(statedir)
+	assert "body0" in output and "body2" in output
@@ -0,0 +1,118 @@
+# Tests for the pooled urllib handlers.
+
+import socket
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+from rawdoglib.httppool import ConnectionPool, DNSCache, PooledHTTPHandler, Response
+
+@pytest.fixture
+def pool():
+	pool = ConnectionPool()
+	yield pool
+	pool.close()
+
+def open_url(pool, url, headers={}):
+	opener = urllib.request.build_opener(PooledHTTPHandler(pool))
+	return opener.open(urllib.request.Request(url, headers=headers))
+
+def test_get(server, pool):
+	url = server.add("/feed", b"feed", headers={"X-Test": "yes"})
+	response = open_url(pool, url)
+	assert isinstance(response, Response)
+	assert response.status == 200
+	assert response.headers["X-Test"] == "yes"
+	assert response.read() == b"feed"
+
+def test_status_settable(server, pool):
+	# feedparser changes the status of responses after redirects.
+	url = server.add("/feed", b"feed")
+	response = open_url(pool, url)
+	response.status = 301
+	assert response.status == 301
+
+def test_keep_alive(server, pool):
+	urls = [server.add("/%d" % i, b"feed", chunked=(i % 2 == 0)) for i in range(5)]
+	for url in urls:
+		assert open_url(pool, url).read() == b"feed"
+	assert server.connections == 1
+
+def test_not_modified(server, pool):
+	url = server.add("/feed", b"feed", etag='"1"')
+	open_url(pool, url).read()
+	with pytest.raises(urllib.error.HTTPError) as info:
+		open_url(pool, url, {"If-None-Match": '"1"'})
+	assert info.value.code == 304
+	open_url(pool, url).read()
+	assert server.connections == 1
+
+def test_redirect(server, pool):
+	url = server.redirect("/old", "/new")
+	server.add("/new", b"feed")
+	response = open_url(pool, url)
+	assert response.geturl() == server.url("/new")
+	assert response.read() == b"feed"
+	assert server.connections == 1
+
+def test_proxy(server, pool):
+	# Requests through a proxy use a new connection each time.
+	server.add("http://example.com/feed", b"feed")
+	proxy = urllib.request.ProxyHandler({"http": server.url("")})
+	opener = urllib.request.build_opener(proxy, PooledHTTPHandler(pool))
+	for i in range(2):
+		assert opener.open("http://example.com/feed").read() == b"feed"
+	assert server.requests[-1][0] == "http://example.com/feed"
+	assert server.connections == 2
+	assert pool.idle == {}
+
+def test_connection_close(server, pool):
+	urls = [server.add("/%d" % i, b"feed", close=True) for i in range(3)]
+	for url in urls:
+		assert open_url(pool, url).read() == b"feed"
+	assert server.connections == 3
+	assert pool.idle == {}
+
+def test_idle_connection_closed(server, pool):
+	url = server.add("/feed", b"feed")
+	open_url(pool, url).read()
+	# Close the idle connection from the client's end, as if the
+	# server had dropped it.
+	for connections in pool.idle.values():
+		for conn in connections:
+			conn.sock.shutdown(socket.SHUT_RDWR)
+	assert open_url(pool, url).read() == b"feed"
+	assert server.connections == 2
+
+def test_threads(server, pool):
+	urls = [server.add("/%d" % i, b"feed %d" % i, delay=0.05) for i in range(20)]
+	results = {}
+	def fetch(url):
+		results[url] = open_url(pool, url).read()
+	threads = [threading.Thread(target=fetch, args=(url,)) for url in urls]
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+	assert results == {url: b"feed %d" % i for (i, url) in enumerate(urls)}
+
+def test_timeout(server, pool):
+	url = server.add("/slow", b"feed", delay=1)
+	opener = urllib.request.build_opener(PooledHTTPHandler(pool))
+	with pytest.raises(urllib.error.URLError) as info:
+		opener.open(url, timeout=0.2)
+	assert isinstance(info.value.reason, socket.timeout)
+
+def test_dns_cache(monkeypatch):
+	calls = []
+	real_getaddrinfo = socket.getaddrinfo
+	def getaddrinfo(*args):
+		calls.append(args[:2])
+		return real_getaddrinfo(*args)
+	monkeypatch.setattr(socket, "getaddrinfo", getaddrinfo)
+	cache = DNSCache()
+	first = cache.getaddrinfo("localhost", 80)
+	assert cache.getaddrinfo("localhost", 80) == first
+	assert calls == [("localhost", 80)]
@@ -0,0 +1,384 @@
+# Tests for saving and loading persisted objects.
+
+import os
+import pickle
+
+import pytest
+
+from rawdoglib import persister as persister_mod
+from rawdoglib.persister import (Blob, BlobFile, BlobRef, JOURNAL_MAGIC,
+	JOURNAL_RECORD, Persistable, Persister, SECTIONED_MAGIC, Section,
+	SectionRef, SQLitePersisted, compress, decompress, open_compressor, open_decompressor)
+from rawdoglib.rawdog import Config
+
+FORMATS = ["none", "gzip", "bz2", "lzma"]
+
+class Note(Blob):
+	"""Some text that's kept in the blob file."""
+
+	__slots__ = ("text",)
+
+	def __init__(self, text):
+		self.text = text
+		self.ref = None
+
+	def __getstate__(self):
+		return self.text
+
+	def __setstate__(self, state):
+		self.text = state
+		self.ref = None
+
+class Notebook(Persistable):
+	"""A Persistable with some values, notes kept as Blobs, and a
+	section, that records its changes for the journal."""
+
+	def __init__(self):
+		Persistable.__init__(self)
+		self.values = {}
+		self.notes = {}
+		self.extra = {}
+		self.changes = []
+
+	def set(self, key, value):
+		self.values[key] = value
+		self.changes.append((key, value))
+		self.modified()
+
+	def apply_changes(self, changes):
+		for (key, value) in changes:
+			self.values[key] = value
+
+	def get_changes(self):
+		return self.changes
+
+	def modified(self, state=True):
+		Persistable.modified(self, state)
+		if not state:
+			self.changes = []
+
+	def get_note(self, key):
+		note = self.notes[key]
+		if isinstance(note, BlobRef):
+			note = self.notes[key] = note.load()
+		return note.text
+
+	def get_extra(self):
+		if isinstance(self.extra, SectionRef):
+			self.extra = self.extra.load()
+		return self.extra
+
+	def __getstate__(self):
+		state = dict(self.__dict__)
+		del state["changes"]
+		notes = {}
+		for (key, note) in self.notes.items():
+			if isinstance(note, Note) and note.ref is not None:
+				note = note.ref
+			notes[key] = note
+		state["notes"] = notes
+		if not isinstance(self.extra, SectionRef):
+			state["extra"] = Section(self.extra)
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self.changes = []
+
+class Tally(Persistable):
+	"""A Persistable that uses the default ways of being stored."""
+
+	def __init__(self):
+		Persistable.__init__(self)
+		self.counts = {}
+
+	def add(self, key):
+		self.counts[key] = self.counts.get(key, 0) + 1
+		self.modified()
+
+def make_persister(journalratio=0.5, **options):
+	config = Config(False)
+	config["journalratio"] = journalratio
+	for (name, value) in options.items():
+		config[name] = value
+	return Persister(config)
+
+@pytest.fixture
+def filename(tmp_path):
+	return str(tmp_path / "state")
+
+def save(filename, fn, **kwargs):
+	"""Open a Notebook, call fn on it, and save it."""
+	p = make_persister(**kwargs).get(Notebook, filename)
+	notebook = p.open()
+	fn(notebook)
+	p.close()
+
+def load(filename, **kwargs):
+	p = make_persister(**kwargs).get(Notebook, filename)
+	notebook = p.open()
+	return (p, notebook)
+
+def test_new_file(filename):
+	def fill(notebook):
+		notebook.set("a", 1)
+		notebook.notes["n"] = Note("note text")
+		notebook.extra["x"] = [1, 2, 3]
+	save(filename, fill)
+
+	with open(filename, "rb") as f:
+		assert f.read(len(SECTIONED_MAGIC)) == SECTIONED_MAGIC
+	(p, notebook) = load(filename)
+	assert notebook.values == {"a": 1}
+	assert isinstance(notebook.notes["n"], BlobRef)
+	assert notebook.get_note("n") == "note text"
+	assert isinstance(notebook.extra, SectionRef)
+	assert notebook.get_extra() == {"x": [1, 2, 3]}
+	p.close()
+
+def test_plain_pickle(filename):
+	# Files written before sections were added are plain pickles.
+	notebook = Notebook()
+	notebook.values["a"] = 1
+	with open(filename, "wb") as f:
+		pickle.dump(notebook, f, pickle.HIGHEST_PROTOCOL)
+	(p, notebook) = load(filename)
+	assert notebook.values == {"a": 1}
+	p.close()
+
+def test_unmodified_not_saved(filename):
+	save(filename, lambda notebook: notebook.set("a", 1))
+	mtime = os.stat(filename).st_mtime_ns
+	save(filename, lambda notebook: None)
+	assert os.stat(filename).st_mtime_ns == mtime
+	assert not os.path.exists(filename + ".journal")
+
+def test_unloaded_section_copied(filename):
+	save(filename, lambda notebook: notebook.extra.update({"x": 1}))
+	save(filename, lambda notebook: notebook.set("a", 1), journalratio=0)
+	(p, notebook) = load(filename)
+	assert notebook.values == {"a": 1}
+	assert notebook.get_extra() == {"x": 1}
+	p.close()
+
+def test_journal(filename):
+	save(filename, lambda notebook: notebook.set("a", 1))
+	size = os.path.getsize(filename)
+	save(filename, lambda notebook: notebook.set("b", 2))
+	save(filename, lambda notebook: notebook.set("a", 3))
+	# The changes were appended to the journal.
+	assert os.path.getsize(filename) == size
+	assert os.path.exists(filename + ".journal")
+
+	(p, notebook) = load(filename)
+	assert notebook.values == {"a": 3, "b": 2}
+	p.close()
+
+def test_journal_too_big(filename):
+	save(filename, lambda notebook: notebook.set("a", 1))
+	save(filename, lambda notebook: notebook.set("b", "x" * 10000))
+	# The change is bigger than the file, so it was rewritten.
+	assert not os.path.exists(filename + ".journal")
+	(p, notebook) = load(filename)
+	assert notebook.values == {"a": 1, "b": "x" * 10000}
+	p.close()
+
+def test_journal_corrupt_record(filename):
+	save(filename, lambda notebook: notebook.set("a", 1))
+	save(filename, lambda notebook: notebook.set("b", 2))
+	save(filename, lambda notebook: notebook.set("c", 3))
+
+	# Damage the last record, as if its save had been interrupted.
+	with open(filename + ".journal", "r+b") as f:
+		f.seek(-1, os.SEEK_END)
+		last = f.read(1)
+		f.seek(-1, os.SEEK_END)
+		f.write(bytes([last[0] ^ 0xff]))
+
+	(p, notebook) = load(filename)
+	assert notebook.values == {"a": 1, "b": 2}
+	# Saving again replaces the damaged record.
+	notebook.set("d", 4)
+	p.close()
+	(p, notebook) = load(filename)
+	assert notebook.values == {"a": 1, "b": 2, "d": 4}
+	p.close()
+
+def test_journal_truncated_record(filename):
+	save(filename, lambda notebook: notebook.set("a", 1))
+	save(filename, lambda notebook: notebook.set("b", 2))
+	with open(filename + ".journal", "ab") as f:
+		f.write(JOURNAL_RECORD.pack(100, 0) + b"partial")
+	(p, notebook) = load(filename)
+	assert notebook.values == {"a": 1, "b": 2}
+	p.close()
+
+def test_journal_left_over(filename):
+	save(filename, lambda notebook: notebook.set("a", 1))
+	save(filename, lambda notebook: notebook.set("b", 2))
+	with open(filename + ".journal", "rb") as f:
+		journal = f.read()
+	save(filename, lambda notebook: notebook.set("c", 3), journalratio=0)
+	assert not os.path.exists(filename + ".journal")
+
+	# A journal for an older version of the file is ignored.
+	with open(filename + ".journal", "wb") as f:
+		f.write(journal)
+	assert journal.startswith(JOURNAL_MAGIC)
+	(p, notebook) = load(filename)
+	assert notebook.values == {"a": 1, "b": 2, "c": 3}
+	p.close()
+
+def test_journal_disabled(filename):
+	save(filename, lambda notebook: notebook.set("a", 1))
+	save(filename, lambda notebook: notebook.set("b", 2), journalratio=0)
+	assert not os.path.exists(filename + ".journal")
+
+def test_blob_reused(filename):
+	save(filename, lambda notebook: notebook.notes.update({"n": Note("text")}))
+	blobs = BlobFile(filename)
+	size = blobs.size()
+	# An unchanged blob isn't written again.
+	save(filename, lambda notebook: notebook.set("a", 1), journalratio=0)
+	assert blobs.size() == size
+
+def test_blob_compaction(filename, monkeypatch):
+	monkeypatch.setattr(persister_mod, "BLOB_WASTE_LIMIT", 100)
+	def fill(notebook):
+		for i in range(10):
+			notebook.notes[i] = Note("x" * 1000 + str(i))
+	save(filename, fill)
+	assert BlobFile(filename).generations() == [0]
+
+	def remove(notebook):
+		for i in range(9):
+			del notebook.notes[i]
+		notebook.modified()
+	save(filename, remove, journalratio=0)
+	# The one remaining blob has been copied into a new generation.
+	blobs = BlobFile(filename)
+	assert blobs.generations() == [1]
+	assert blobs.size() < 2000
+
+	(p, notebook) = load(filename)
+	assert notebook.get_note(9) == "x" * 1000 + "9"
+	p.close()
+
+def test_compaction_updates_sections(filename, monkeypatch):
+	# An unloaded section that refers to blobs is still usable after
+	# the file's been rewritten and its blobs compacted.
+	monkeypatch.setattr(persister_mod, "BLOB_WASTE_LIMIT", 0)
+	def fill(notebook):
+		notebook.extra["note"] = Note("in a section")
+		notebook.notes["big"] = Note("x" * 10000)
+	save(filename, fill)
+
+	p = make_persister(journalratio=0).get(Notebook, filename)
+	notebook = p.open()
+	del notebook.notes["big"]
+	notebook.modified()
+	p.save()
+	assert isinstance(notebook.extra, SectionRef)
+	assert BlobFile(filename).generations() == [1]
+	notebook.set("a", 1)
+	p.save()
+	assert notebook.get_extra()["note"].load().text == "in a section"
+	p.close()
+
+	(p, notebook) = load(filename)
+	assert notebook.get_extra()["note"].load().text == "in a section"
+	p.close()
+
+def test_rename(filename, tmp_path):
+	save(filename, lambda notebook: notebook.notes.update({"n": Note("text")}))
+	new_filename = str(tmp_path / "renamed")
+	persister = make_persister()
+	persister.get(Notebook, filename).rename(new_filename)
+	assert not os.path.exists(filename)
+	(p, notebook) = load(new_filename)
+	assert notebook.get_note("n") == "text"
+	p.close()
+
+def test_delete(filename):
+	save(filename, lambda notebook: notebook.notes.update({"n": Note("text")}))
+	make_persister().delete(filename)
+	assert os.listdir(os.path.dirname(filename)) == []
+
+@pytest.mark.parametrize("format", FORMATS)
+def test_compress(format):
+	data = b"some data " * 100
+	compressed = compress(data, (format, 6))
+	if format != "none":
+		assert len(compressed) < len(data)
+		assert compressed.startswith(persister_mod.COMPRESSION_MAGIC[format])
+	assert decompress(compressed) == data
+
+@pytest.mark.parametrize("format", FORMATS)
+def test_compress_short(format):
+	# Data that doesn't get any smaller is left alone.
+	assert compress(b"x", (format, 6)) == b"x"
+
+@pytest.mark.parametrize("format", FORMATS)
+def test_compressor(tmp_path, format):
+	data = b"some data " * 100
+	with open(tmp_path / "f", "w+b") as f:
+		f.write(b"header")
+		out = open_compressor(f, (format, 6))
+		if format == "none":
+			assert out is None
+			f.write(data)
+		else:
+			out.write(data)
+			out.close()
+		f.write(b"trailer")
+
+		f.seek(len(b"header"))
+		assert open_decompressor(f).read(len(data)) == data
+
+@pytest.mark.parametrize("format", FORMATS)
+def test_compressed_file(filename, format):
+	def fill(notebook):
+		notebook.set("a", "value " * 100)
+		notebook.notes["n"] = Note("note " * 100)
+		notebook.extra["x"] = "extra " * 100
+	save(filename, fill, statecompression=format)
+	save(filename, lambda notebook: notebook.set("b", "change " * 100), statecompression=format)
+
+	# The file can be read whatever the compression setting is now.
+	(p, notebook) = load(filename, statecompression="none")
+	assert notebook.values == {"a": "value " * 100, "b": "change " * 100}
+	assert notebook.get_note("n") == "note " * 100
+	assert notebook.get_extra() == {"x": "extra " * 100}
+	p.close()
+
+def test_compression_smaller(tmp_path):
+	sizes = {}
+	for format in FORMATS:
+		filename = str(tmp_path / format)
+		save(filename, lambda notebook: notebook.set("a", "value " * 1000), statecompression=format)
+		sizes[format] = os.path.getsize(filename)
+	for format in FORMATS[1:]:
+		assert sizes[format] < sizes["none"]
+
+def test_default_persistable(filename):
+	for i in range(2):
+		p = make_persister().get(Tally, filename)
+		tally = p.open()
+		tally.add("a")
+		p.close()
+	p = make_persister().get(Tally, filename)
+	assert p.open().counts == {"a": 2}
+	p.close()
+
+def test_default_persistable_sqlite(tmp_path):
+	filename = str(tmp_path / "state.db")
+	for i in range(2):
+		p = make_persister().get(Tally, filename, SQLitePersisted)
+		tally = p.open()
+		tally.add("a")
+		p.close()
+	p = make_persister().get(Tally, filename, SQLitePersisted)
+	tally = p.open()
+	assert tally.counts == {"a": 2}
+	assert not tally.is_modified()
+	p.close()
@@ -0,0 +1,63 @@
+# Tests for the cache of sanitised article HTML.
+
+import os
+
+from conftest import make_feed
+from rawdoglib import rawdog as rawdog_mod
+from rawdoglib.persister import Persister
+from rawdoglib.rawdog import Config, RenderCache
+
+def test_hit_miss_eviction():
+	cache = RenderCache()
+	assert cache.get("a") is None
+	cache.add("a", {"title": "A"}, 2)
+	cache.add("b", {"title": "B"}, 2)
+	assert cache.get("a") == {"title": "A"}
+	# b is now the least recently used, so it's discarded first.
+	cache.add("c", {"title": "C"}, 2)
+	assert cache.get("b") is None
+	assert list(cache.entries) == ["a", "c"]
+
+def test_order_saved(tmp_path):
+	filename = str(tmp_path / "rendercache")
+	persister = Persister(Config(False))
+	with persister.get(RenderCache, filename) as cache:
+		cache.add("a", {}, 2)
+		cache.add("b", {}, 2)
+	# Using an entry changes the order, which is saved even though
+	# nothing was added.
+	with persister.get(RenderCache, filename) as cache:
+		cache.get("a")
+		assert cache.is_modified()
+	with persister.get(RenderCache, filename) as cache:
+		assert list(cache.entries) == ["b", "a"]
+
+def write_config(statedir, *lines):
+	with open(statedir / "config", "w") as f:
+		for line in ("outputfile output.html",) + lines:
+			f.write(line + "\n")
+
+def test_write(statedir, clock, server, monkeypatch):
+	url = server.add("/feed.rss", make_feed([("a", "first"), ("b", "second")]))
+	write_config(statedir, "feed 1m " + url)
+	assert rawdog_mod.main(["-u", "-w"]) == 0
+	# The cache is off by default.
+	assert not os.path.exists(statedir / "rendercache")
+
+	write_config(statedir, "rendercache 10", "feed 1m " + url)
+	assert rawdog_mod.main(["-w"]) == 0
+	assert os.path.exists(statedir / "rendercache")
+	with open(statedir / "output.html") as f:
+		output = f.read()
+
+	# The second time, the articles' HTML comes from the cache.
+	real_article_to_html = rawdog_mod.article_to_html
+	converted = []
+	def article_to_html(article, feed, config):
+		converted.append(article)
+		return real_article_to_html(article, feed, config)
+	monkeypatch.setattr(rawdog_mod, "article_to_html", article_to_html)
+	assert rawdog_mod.main(["-w"]) == 0
+	assert converted == []
+	with open(statedir / "output.html") as f:
+		assert f.read() == output
@@ -0,0 +1,163 @@
+# Tests for working out when feeds should be updated.
+
+import pytest
+
+from rawdoglib.rawdog import ArticleStore, Config, Feed, MIN_BACKOFF, Rawdog
+
+HOUR = 3600
+
+def make_feed(url="http://example.com/feed.rss", period=HOUR, last_update=0):
+	feed = Feed(url)
+	feed.period = period
+	feed.last_update = last_update
+	return feed
+
+def make_config(**options):
+	config = Config(False)
+	for (name, value) in options.items():
+		config[name] = value
+	return config
+
+def test_no_spread(clock):
+	feed = make_feed(last_update=clock.now)
+	assert feed.get_update_offset(make_config()) == 0
+	assert feed.get_next_update(make_config()) == clock.now + HOUR
+
+@pytest.mark.parametrize("spread", [0.1, 0.5, 1.0])
+def test_offset(clock, spread):
+	config = make_config(updatespread=spread)
+	urls = ["http://example.com/%d.rss" % i for i in range(100)]
+	offsets = []
+	for url in urls:
+		feed = make_feed(url, last_update=clock.now)
+		offset = feed.get_update_offset(config)
+		assert 0 <= offset < spread * HOUR
+		# The offset doesn't depend on when the feed was updated.
+		for i in range(10):
+			feed.last_update += 1234
+			assert feed.get_update_offset(config) == offset
+		offsets.append(offset)
+	# Feeds with the same period are spread out.
+	assert len(set(offsets)) == len(urls)
+	assert max(offsets) - min(offsets) > 0.8 * spread * HOUR
+
+def test_phase(clock):
+	config = make_config(updatespread=1.0)
+	feed = make_feed(last_update=clock.now)
+	offset = feed.get_update_offset(config)
+	due = feed.get_next_update(config)
+	# The update moves to the feed's offset into a period, by no more
+	# than half a period.
+	periods = (due - offset) / HOUR
+	assert periods == pytest.approx(round(periods))
+	assert abs(due - (clock.now + HOUR)) <= HOUR / 2
+
+	# Once it's in step, it's updated every period, even if each run
+	# is a little late; the lateness doesn't build up.
+	for i in range(24):
+		clock.now = due + 100
+		feed.last_update = clock.now
+		assert feed.get_next_update(config) == pytest.approx(due + HOUR)
+		due += HOUR
+
+DAY = 24 * HOUR
+
+def test_period_without_maxperiod(clock):
+	feed = make_feed(last_update=clock.now)
+	feed.record_changes([clock.now - 10 * DAY, clock.now - 5 * DAY])
+	assert feed.get_period(make_config()) == HOUR
+	assert feed.get_period(make_config(maxperiod=30 * 60)) == HOUR
+
+def test_period_no_changes(clock):
+	feed = make_feed(last_update=clock.now)
+	assert feed.get_period(make_config(maxperiod=DAY)) == HOUR
+
+@pytest.mark.parametrize("changes, period", [
+	# Half the usual time between changes.
+	([-12 * HOUR, -8 * HOUR, -4 * HOUR], 2 * HOUR),
+	# Half the time since it last changed, if that's longer.
+	([-12 * HOUR, -11 * HOUR, -10 * HOUR], 5 * HOUR),
+	# No shorter than the feed's period...
+	([-3 * HOUR, -2 * HOUR, -1 * HOUR], HOUR),
+	# ... and no longer than maxperiod.
+	([-30 * DAY, -20 * DAY, -10 * DAY], DAY),
+	# One change only tells us how long it's been since.
+	([-6 * HOUR], 3 * HOUR),
+	])
+def test_period(clock, changes, period):
+	config = make_config(maxperiod=DAY)
+	feed = make_feed(last_update=clock.now)
+	feed.record_changes([clock.now + t for t in changes])
+	assert feed.get_period(config) == period
+	assert feed.get_next_update(config) == clock.now + period
+
+def test_change_history(clock):
+	feed = make_feed(last_update=clock.now)
+	feed.record_changes([clock.now - i * HOUR for i in range(20)])
+	feed.record_changes([clock.now - HOUR])
+	assert len(feed.change_times) == 10
+	assert feed.change_times == sorted(feed.change_times)
+	assert feed.change_times[-1] == clock.now
+
+def fail(feed, config, now):
+	p = {"rawdog_responses": [{"status": 500}]}
+	assert not feed.update(Rawdog(), now, config, ArticleStore(), p)
+
+def test_backoff(clock):
+	config = make_config(maxbackoff=DAY, quarantine=0)
+	feed = make_feed(last_update=clock.now)
+	for failures in range(1, 10):
+		fail(feed, config, clock.now)
+		assert feed.failures == failures
+		backoff = min(HOUR * 2 ** (failures - 1), DAY)
+		assert feed.get_next_update(config) == clock.now + backoff
+
+def test_backoff_short_period(clock):
+	config = make_config(maxbackoff=DAY)
+	feed = make_feed(period=60, last_update=clock.now)
+	fail(feed, config, clock.now)
+	assert feed.get_next_update(config) == clock.now + MIN_BACKOFF
+	fail(feed, config, clock.now)
+	assert feed.get_next_update(config) == clock.now + 2 * MIN_BACKOFF
+
+def test_no_backoff(clock):
+	config = make_config(maxbackoff=0)
+	feed = make_feed(last_update=clock.now)
+	for i in range(5):
+		fail(feed, config, clock.now)
+	assert feed.get_next_update(config) == clock.now + HOUR
+
+def test_quarantine(clock, capsys):
+	config = make_config(maxbackoff=6 * HOUR, quarantine=3)
+	feed = make_feed(last_update=clock.now)
+	for failures in range(1, 3):
+		fail(feed, config, clock.now)
+		assert not feed.is_quarantined(config)
+	assert "will only be" not in capsys.readouterr().out
+
+	clock.now += HOUR
+	fail(feed, config, clock.now)
+	assert feed.is_quarantined(config)
+	assert feed.get_next_update(config) == clock.now + 6 * HOUR
+	assert "has failed 3 times in a row" in capsys.readouterr().out
+
+	fail(feed, config, clock.now)
+	assert "Quarantined feed failed again:" in capsys.readouterr().out
+	assert not feed.is_quarantined(make_config(quarantine=0))
+
+def test_recovery(clock, capsys):
+	config = make_config(maxbackoff=DAY, quarantine=3)
+	feed = make_feed(last_update=clock.now)
+	first = clock.now
+	for i in range(4):
+		fail(feed, config, clock.now)
+		clock.now += HOUR
+	assert feed.failing_since == first
+	assert feed.is_quarantined(config)
+
+	p = {"rawdog_responses": [{"status": 304}]}
+	assert not feed.update(Rawdog(), clock.now, config, ArticleStore(), p)
+	assert "Feed recovered after 4 failures" in capsys.readouterr().out
+	assert (feed.failures, feed.failing_since) == (0, None)
+	assert not feed.is_quarantined(config)
+	assert feed.get_next_update(config) == clock.now + HOUR
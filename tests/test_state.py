@@ -0,0 +1,146 @@
+# Tests for how rawdog keeps its state.
+
+import os
+import pickle
+
+import pytest
+
+from conftest import make_feed
+from rawdoglib import rawdog as rawdog_mod
+from rawdoglib.persister import Persister, SectionRef, SQLitePersisted
+from rawdoglib.rawdog import Config, Rawdog
+
+def write_config(statedir, *lines):
+	with open(statedir / "config", "w") as f:
+		for line in ("outputfile output.html",) + lines:
+			f.write(line + "\n")
+
+def open_state(statedir):
+	"""Load the state as main does."""
+	os.chdir(statedir)
+	config = Config(False)
+	config.load("config")
+	rawdog_mod.persister = Persister(config)
+	rawdog_p = rawdog_mod.persister.get(Rawdog, "state")
+	return (rawdog_p, rawdog_p.open(), config)
+
+@pytest.mark.parametrize("splitstate", [False, True])
+def test_sync_doesnt_load_articles(statedir, clock, server, splitstate):
+	url = server.add("/feed.rss", make_feed([("a", "body")]))
+	write_config(statedir, "splitstate %d" % splitstate, "feed 1m " + url)
+	assert rawdog_mod.main(["-u"]) == 0
+
+	(rawdog_p, rawdog, config) = open_state(statedir)
+	rawdog.sync_from_config(config)
+	assert isinstance(rawdog._articles, SectionRef)
+	assert rawdog.has_articles() == (not splitstate)
+	assert isinstance(rawdog._articles, SectionRef)
+	rawdog_p.close()
+
+def test_split_existing_articles(statedir, clock, server):
+	url = server.add("/feed.rss", make_feed([("a", "body")]))
+	write_config(statedir, "feed 1m " + url)
+	assert rawdog_mod.main(["-u"]) == 0
+
+	# Turning splitstate on moves the articles out of the main state.
+	write_config(statedir, "splitstate 1", "feed 1m " + url)
+	assert rawdog_mod.main(["-w"]) == 0
+	(rawdog_p, rawdog, config) = open_state(statedir)
+	assert not rawdog.has_articles()
+	assert rawdog.feeds[url].article_keys is not None
+	rawdog_p.close()
+
+def test_article_count_unknown(statedir, clock, server):
+	# State files written before the count was stored still work.
+	url = server.add("/feed.rss", make_feed([("a", "body")]))
+	write_config(statedir, "feed 1m " + url)
+	assert rawdog_mod.main(["-u"]) == 0
+	(rawdog_p, rawdog, config) = open_state(statedir)
+	rawdog._article_count = None
+	assert rawdog.has_articles()
+	assert not isinstance(rawdog._articles, SectionRef)
+	rawdog_p.close()
+
+def test_article_count_with_journal(statedir, clock, server):
+	# Articles added since the file was written are in the journal.
+	url = server.add("/feed.rss", make_feed([("a", "body")]))
+	write_config(statedir, "journalratio 100", "feed 1m " + url)
+	assert rawdog_mod.main(["-u"]) == 0
+	server.add("/feed.rss", make_feed([("a", "body"), ("b", "more")]))
+	clock.now += 3600
+	assert rawdog_mod.main(["-u"]) == 0
+	assert os.path.exists(statedir / "state.journal")
+
+	(rawdog_p, rawdog, config) = open_state(statedir)
+	assert rawdog._pending_changes
+	assert rawdog.has_articles()
+	assert len(rawdog.articles) == 2
+	rawdog_p.close()
+
+def test_sqlite(statedir, clock, server, monkeypatch):
+	url = server.add("/feed.rss", make_feed([("a", "first"), ("b", "second")]))
+	write_config(statedir, "statebackend sqlite", "feed 1m " + url)
+	assert rawdog_mod.main(["-u", "-w"]) == 0
+	with open(statedir / "output.html") as f:
+		output = f.read()
+	assert "first" in output and "second" in output
+
+	# Articles loaded from the database were compacted before they
+	# were saved, so they aren't compacted again.
+	compacted = []
+	real_compact = rawdog_mod.compact_entry_info
+	def compact_entry_info(entry_info):
+		compacted.append(entry_info)
+		return real_compact(entry_info)
+	monkeypatch.setattr(rawdog_mod, "compact_entry_info", compact_entry_info)
+	os.chdir(statedir)
+	config = Config(False)
+	config.load("config")
+	rawdog_mod.persister = Persister(config)
+	rawdog_p = rawdog_mod.persister.get(Rawdog, "state.db", SQLitePersisted)
+	rawdog = rawdog_p.open()
+	articles = sorted(rawdog.articles.values(), key=lambda article: article.link)
+	assert [article.link for article in articles] == ["http://example.com/a", "http://example.com/b"]
+	assert articles[0].entry_info["title_detail"]["value"] == "a"
+	assert articles[0].digest == rawdog_mod.get_entry_digest(articles[0].entry_info)
+	assert compacted == []
+	rawdog_p.close()
+
+def test_compact_entry_info(monkeypatch):
+	entry_info = {
+		"title": "Title",
+		"title_detail": {"type": "text/plain", "value": "Title"},
+		"summary": "Summary",
+		"tags": [{"term": "tag"}],
+		}
+	# "title" is kept for templates and plugins, although rawdog itself
+	# only uses title_detail.
+	assert sorted(rawdog_mod.compact_entry_info(entry_info)) == ["title", "title_detail"]
+	monkeypatch.setattr(rawdog_mod, "entry_info_keys", rawdog_mod.ENTRY_INFO_KEYS | {"tags"})
+	assert sorted(rawdog_mod.compact_entry_info(entry_info)) == ["tags", "title", "title_detail"]
+
+def test_article_old_format():
+	# Versions before 3.4 pickled articles as a dict of attributes.
+	entry_info = {"id": "a", "link": "http://example.com/a", "summary": "dropped",
+	              "title_detail": {"type": "text/plain", "value": "A"}}
+	article = rawdog_mod.Article.__new__(rawdog_mod.Article)
+	article.__setstate__({
+		"feed": "http://example.com/feed.rss",
+		"entry_info": entry_info,
+		"sequence": 3,
+		"date": None,
+		"hash": "hash",
+		"last_seen": 1000,
+		"added": 900,
+		})
+	assert (article.feed, article.sequence, article.added, article.last_seen) == \
+		("http://example.com/feed.rss", 3, 900, 1000)
+	assert article.last_changed is None
+	assert article.id == "a"
+	assert "summary" not in article.entry_info
+
+	copy = pickle.loads(pickle.dumps(article))
+	for name in rawdog_mod.Article.__slots__:
+		if name != "body":
+			assert getattr(copy, name) == getattr(article, name)
+	assert copy.entry_info == article.entry_info
@@ -0,0 +1,60 @@
+# Tests for filling in templates.
+
+import random
+
+import pytest
+
+from rawdoglib.rawdog import fill_template, template_re
+
+def simple_fill_template(template, bits):
+	"""fill_template as it was before templates were compiled, which
+	the compiled version must match."""
+	out = []
+	if_stack = []
+	for part in template_re.split(template):
+		if part.startswith("__") and part.endswith("__"):
+			key = part[2:-2]
+			if key.startswith("if_"):
+				k = key[3:]
+				if_stack.append(k in bits and bits[k] != "")
+			elif key == "endif":
+				if if_stack != []:
+					if_stack.pop()
+			elif key == "else":
+				if if_stack != []:
+					if_stack.append(not if_stack.pop())
+			elif key in bits and not False in if_stack:
+				out.append(bits[key])
+		elif not False in if_stack:
+			out.append(part)
+	return "".join(out)
+
+BITS = {"a": "A", "b": "", "c": "C"}
+
+@pytest.mark.parametrize("template, expected", [
+	("plain text", "plain text"),
+	("x__a__y__b__z__missing__", "xAyz"),
+	("__if_a__yes__endif__", "yes"),
+	("__if_b__yes__else__no__endif__", "no"),
+	("__if_missing__yes__else__no__endif__", "no"),
+	("__if_a__1__if_b__2__else__3__endif__4__else__5__endif__6", "1346"),
+	("__if_b__1__if_a__2__else__3__endif__4__else__5__endif__6", "56"),
+	("__if_a__1__else__2__else__3__endif__", "13"),
+	("__if_b__never closed __a__", ""),
+	("stray__endif__ and__else__ __a__", "stray and A"),
+	("__if_a____if_c____a____c____endif____endif__", "AC"),
+	])
+def test_fill(template, expected):
+	assert fill_template(template, BITS) == expected
+	assert simple_fill_template(template, BITS) == expected
+
+PARTS = ["text", " ", "__a__", "__b__", "__c__", "__missing__",
+         "__if_a__", "__if_b__", "__if_c__", "__if_missing__",
+         "__else__", "__endif__"]
+
+def test_fuzz():
+	rng = random.Random(1)
+	for i in range(5000):
+		template = "".join(rng.choice(PARTS) for j in range(rng.randint(0, 20)))
+		bits = {key: rng.choice(["", "X", "Y"]) for key in "abc" if rng.random() < 0.8}
+		assert fill_template(template, bits) == simple_fill_template(template, bits), template
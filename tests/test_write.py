@@ -0,0 +1,89 @@
+# Tests for writing the output file.
+
+import os
+import re
+import shutil
+
+import pytest
+
+from conftest import make_feed
+from rawdoglib import rawdog as rawdog_mod
+
+def write_config(statedir, *lines):
+	with open(statedir / "config", "w") as f:
+		for line in ("outputfile output.html",) + lines:
+			f.write(line + "\n")
+
+def read_output(statedir):
+	with open(statedir / "output.html") as f:
+		return f.read()
+
+def written(statedir):
+	"""Return the names of the articles in the output file."""
+	return re.findall(r'<span class="itemtitle"><a href="http://example\.com/(\w+)">', read_output(statedir))
+
+def clear_state(statedir):
+	"""Remove everything apart from the config file."""
+	for name in os.listdir(statedir):
+		path = statedir / name
+		if name == "config":
+			continue
+		elif os.path.isdir(path):
+			shutil.rmtree(path)
+		else:
+			os.remove(path)
+
+HTML_ITEMS = [
+	("plain", "Just text."),
+	("markup", "&lt;p&gt;Some &lt;b&gt;bold&lt;/b&gt; and &lt;a href=\"/rel\"&gt;a link&lt;/a&gt;.&lt;/p&gt;"),
+	("unsafe", "&lt;script&gt;alert(1)&lt;/script&gt;&lt;img src=\"x.png\" onerror=\"evil()\"&gt;"),
+	("unclosed", "&lt;div&gt;&lt;i&gt;never closed"),
+	]
+
+@pytest.mark.parametrize("args", ["", " format=text"])
+def test_sanitise_on_update(statedir, clock, server, args):
+	# Articles sanitised when they're stored are written just as they
+	# would be if they were sanitised when the output's written.
+	url = server.add("/feed.rss", make_feed(HTML_ITEMS))
+	outputs = []
+	for sanitise in (0, 1):
+		clear_state(statedir)
+		write_config(statedir, "sanitiseonupdate %d" % sanitise, "feed 1m " + url + args)
+		assert rawdog_mod.main(["-u", "-w"]) == 0
+		outputs.append(read_output(statedir))
+	assert outputs[0] == outputs[1]
+	assert "<script" not in outputs[0]
+	assert "never closed" in outputs[0]
+
+@pytest.mark.parametrize("splitstate", [0, 1])
+def test_maxarticles_after_duplicates(statedir, clock, server, splitstate):
+	# Duplicates don't count towards maxarticles; the next articles
+	# along are written instead.
+	dups = [("d%d" % i, "body") for i in range(5)]
+	url1 = server.add("/1.rss", make_feed(dups))
+	url2 = server.add("/2.rss", make_feed(dups + [("e%d" % i, "body") for i in range(5)]))
+	write_config(statedir, "splitstate %d" % splitstate, "maxarticles 8",
+	             "feed 1m " + url1, "feed 1m " + url2)
+	assert rawdog_mod.main(["-u", "-w"]) == 0
+	names = written(statedir)
+	assert len(names) == 8
+	assert len(set(names)) == 8
+
+@pytest.mark.parametrize("splitstate", [0, 1])
+def test_maxarticles_after_maxage(statedir, clock, server, splitstate):
+	# Nor do articles that are too old to be written.
+	url1 = server.add("/1.rss", make_feed([("old%d" % i, "body") for i in range(5)]))
+	url2 = server.add("/2.rss", make_feed([("new%d" % i, "body") for i in range(5)]))
+	write_config(statedir, "splitstate %d" % splitstate, "maxarticles 5",
+	             "feed 1h " + url1 + " maxage=1m", "feed 1h " + url2)
+	assert rawdog_mod.main(["-u"]) == 0
+	clock.now += 120
+	assert rawdog_mod.main(["-w"]) == 0
+	assert sorted(written(statedir)) == ["new%d" % i for i in range(5)]
+
+def test_maxarticles_0(statedir, clock, server):
+	# maxarticles 0 writes every article.
+	url = server.add("/feed.rss", make_feed([("a%d" % i, "body") for i in range(30)]))
+	write_config(statedir, "maxarticles 0", "feed 1m " + url)
+	assert rawdog_mod.main(["-u", "-w"]) == 0
+	assert sorted(written(statedir)) == sorted("a%d" % i for i in range(30))